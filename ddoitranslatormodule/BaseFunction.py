@@ -1,10 +1,21 @@
 from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import *
+from ddoitranslatormodule.execution_context import ExecutionContext, active_contexts, notify
+from ddoitranslatormodule.argspec import compiled_schema
+from ddoitranslatormodule.arg_records import ArgRecord, record_type
+from ddoitranslatormodule import resource_locks, ktl_access, clock
+# Enables tracing of executions when DDOI_TRACE_FILE is set
+from ddoitranslatormodule import tracing
+# Enables the execution history when DDOI_HISTORY_DB is set
+from ddoitranslatormodule import execution_history
 
 from logging import getLogger
 from argparse import Namespace, ArgumentTypeError
 import configparser
+import contextvars
+import threading
 import traceback
 import copy
+import os
 
 
 # clean up the exceptions printed
@@ -16,6 +27,22 @@ def excepthook(type, value, traceback):
 
 help_str = ""
 
+# Parsed config files, {tuple of paths: (tuple of mtimes, raw values)},
+# least recently used first
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+# Number of config file sets kept parsed
+CONFIG_CACHE_SIZE = 32
+# Longest real time the phase watchdog waits before looking at the clock again
+WATCHDOG_POLL = 0.05
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
 
 class TranslatorModuleFunction:
     """ 
@@ -26,9 +53,39 @@ class TranslatorModuleFunction:
     abortable = False
     help_string = help_str
     min_args = {}
+    # Leading phases that may run while the previous sequence of an OB is
+    # still exposing/reading out (see sequence_runner.SequenceRunner), e.g.
+    # ('pre_condition',)
+    overlap_phases = ()
+    # If True, the arguments of execute() are checked against (and coerced
+    # to) the types of add_cmdline_args and min_args before the pre-condition
+    validate_args = False
+    # Seconds allowed for the whole execution and for each phase, e.g.
+    # {'perform': 600}. A [deadlines] config section overrides them (keys
+    # timeout, pre_condition, perform, post_condition, optionally prefixed
+    # with the class name, e.g. Expose.perform), and the arguments of
+    # execute() override both.  None or missing means no limit.
+    timeout = None
+    phase_timeouts = {}
+    # Seconds a phase that overran its deadline is given to return after
+    # abort_execution was called, before it is abandoned
+    abort_grace = 5.0
+    # (service, keyword) pairs the function writes. Executions writing
+    # common keywords run one at a time, also across processes (see
+    # resource_locks); override locked_keywords when the set depends on the
+    # arguments.  The locks are taken before the first phase that is not
+    # an overlap phase.
+    writes_keywords = ()
+    # Seconds to wait for the keyword locks, None waits until the deadline
+    lock_timeout = None
+    # If True, SequenceRunner runs perform_delta instead of perform for the
+    # second and later sequences of an OB, with the arguments that changed
+    # since the previous sequence (see sequence_diff)
+    apply_delta = False
 
     @classmethod
-    def execute(cls, args, logger=None, cfg=None):
+    def execute(cls, args, logger=None, cfg=None, timeout=None,
+                phase_timeouts=None):
         """Carries out this function in its entirety (pre and post conditions
            included)
 
@@ -41,6 +98,12 @@ class TranslatorModuleFunction:
             a generic name specified in the config, by default None
         cfg : filepath, optional
             File path to the config that should be used, by default None
+        timeout : float, optional
+            Seconds allowed for the whole execution, by default the
+            function's timeout (see the class attributes)
+        phase_timeouts : dict, optional
+            {phase: seconds} allowed for each phase, by default the
+            function's phase_timeouts
 
         Returns
         -------
@@ -53,111 +116,386 @@ class TranslatorModuleFunction:
             If any changes to the input arguments are detected, this exception
             is raised. Code within a TranslatorModuleFunction should **NOT**
             change the input arguments
+        DDOIInvalidArguments
+            If a required argument is missing or has the wrong type
+        DDOIExecutionCancelled
+            If the execution was cancelled (e.g. by abort) before a phase
+            started
+        DDOIPhaseTimeout
+            If a phase did not finish before its deadline
+        DDOIResourceLockTimeout
+            If the keywords the function writes stayed locked by other
+            executions for longer than lock_timeout
+        """
+        ctx = cls._create_context(args, logger, timeout=timeout,
+                                  phase_timeouts=phase_timeouts)
+        with ctx:
+            try:
+                cls._setup_context(ctx, cfg)
+
+                cls._run_phase(ctx, 'pre_condition')
+                return_value = cls._run_phase(ctx, 'perform')
+                cls._run_phase(ctx, 'post_condition')
+            except BaseException as e:
+                cls._finish_context(ctx, e)
+                raise
+            cls._finish_context(ctx)
+
+        return return_value
+
+    @classmethod
+    def _create_context(cls, args, logger=None, timeout=None,
+                        phase_timeouts=None):
+        """Check the arguments and create the ExecutionContext of a run.
+
+        Parameters
+        ----------
+        args : dict, ArgRecord or Namespace
+            The OB (or portion of OB)
+        logger : DDOILoggerClient, optional
+            The logger to use, by default the root logger
+        timeout : float, optional
+            Seconds allowed for the whole execution, by default None
+        phase_timeouts : dict, optional
+            {phase: seconds} allowed for each phase, by default None
+
+        Returns
+        -------
+        ExecutionContext
+            The (not yet entered) context of the run
         """
         if type(args) == Namespace:
             args = vars(args)
-        elif type(args) != dict:
-            msg = "argument type must be either Dict or Argparser.Namespace"
+        elif type(args) != dict and not isinstance(args, ArgRecord):
+            msg = "argument type must be either Dict, ArgRecord or Argparser.Namespace"
             raise DDOIInvalidArguments(msg)
 
         # Access the logger and pass it into each method
         if logger is None:
             logger = getLogger("")
 
+        return ExecutionContext(cls, args, logger, timeout=timeout,
+                                phase_timeouts=phase_timeouts)
+
+    @classmethod
+    def _setup_context(cls, ctx, cfg=None):
+        """Load the config into an entered context and store a copy of the
+        initial arguments, ready for the first phase to run.
+
+        Parameters
+        ----------
+        ctx : ExecutionContext
+            The context of the run
+        cfg : filepath or ConfigParser, optional
+            The config to use, by default the function's default location
+        """
+        notify('on_start', ctx)
+        logger = ctx.logger
+        args = ctx.args
+
         # read the config file
-        if isinstance(cfg, str):
-            logger.info(f"Loading config from string {str}")
-            cfg = cls._load_config(cls, cfg, args=args)
-        elif cfg is None:
-            cfg_loc = cls._cfg_location(cls, args=args)[0]
-            logger.info(f"Loading config from default location: {cfg_loc}")
-            cfg = cls._load_config(cls, cfg_loc, args=args) 
-        # Store a copy of the initial args
-        initial_args = copy.deepcopy(args)
-
-
-        #################
-        # PRE CONDITION #
-        #################
-        try:
-            cls.pre_condition(args, logger, cfg)
-        except Exception as e:
-            logger.error(f"Exception encountered in pre-condition: {e}", exc_info=True)
-            raise DDOIPreConditionFailed()
-        
-        args_diff = cls._diff_args(initial_args, args)
-
-        if args_diff:
-            logger.debug(f"Args changed after pre-condition")
-            logger.debug(f"Before: {initial_args}")
-            logger.debug(f"After: {args}")
-#             raise DDOIArgumentsChangedException(f"Args changed after pre-condition")
-
-
-        ###########
-        # EXECUTE #
-        ###########
-        
-        try:
-            return_value = cls.perform(args, logger, cfg)
-        except Exception as e:
-            logger.error(f"Exception encountered in perform: {e}", exc_info=True)
-            raise DDOIPerformFailed()
-        
-        args_diff = cls._diff_args(initial_args, args)
+        with ctx.timings.time('load_config'):
+            if isinstance(cfg, str):
+                logger.info(f"Loading config from string {cfg}")
+                cfg = cls._load_config(cls, cfg, args=args)
+            elif cfg is None:
+                cfg_loc = cls._cfg_location(cls, args=args)[0]
+                logger.info(f"Loading config from default location: {cfg_loc}")
+                cfg = cls._load_config(cls, cfg_loc, args=args)
+        ctx.cfg = cfg
+        cls._set_deadlines(ctx, cfg)
+        if isinstance(cfg, configparser.ConfigParser):
+            ktl_access.load_config(cfg)
+
+        # Fail before anything moves if the arguments can't work
+        if cls.validate_args:
+            schema = compiled_schema(cls, cfg)
+            if schema is not None:
+                ctx.args = schema.validate(ctx.args)
+
+        # Store a copy of the initial (validated) args
+        ctx.initial_args = copy.deepcopy(ctx.args)
+
+    @classmethod
+    def _deadlines(cls, cfg=None):
+        """The timeout and phase timeouts of the function, from the class
+        attributes and the [deadlines] section of the config
+
+        Parameters
+        ----------
+        cfg : ConfigParser, optional
+            The loaded config, by default None
+
+        Returns
+        -------
+        dict
+            {'timeout' or phase name: seconds}
+        """
+        limits = dict(cls.phase_timeouts)
+        if cls.timeout is not None:
+            limits['timeout'] = cls.timeout
+        if isinstance(cfg, configparser.ConfigParser) \
+                and cfg.has_section('deadlines'):
+            section = cfg['deadlines']
+            for name in ('timeout', *cls._phases):
+                # the class specific key wins over the generic one
+                for key in (name, f"{cls.__name__}.{name}"):
+                    if key in section:
+                        limits[name] = section.getfloat(key)
+        return {name: seconds for name, seconds in limits.items()
+                if seconds is not None and seconds > 0}
 
-        if args_diff:
-            logger.debug(f"Args changed after perform")
-            logger.debug(f"Before: {initial_args}")
-            logger.debug(f"After: {args}")
-#             raise DDOIArgumentsChangedException(f"Args changed after perform")
+    @classmethod
+    def _set_deadlines(cls, ctx, cfg=None):
+        """Apply the function's deadlines to a context, keeping the ones
+        given to execute()
+        """
+        limits = cls._deadlines(cfg)
+        timeout = limits.pop('timeout', None)
+        if ctx.timeout is None and timeout is not None:
+            ctx.set_timeout(timeout)
+        # like the configured ones, limits <= 0 given to execute() mean none
+        ctx.phase_timeouts = {phase: seconds for phase, seconds
+                              in ctx.phase_timeouts.items()
+                              if seconds is not None and seconds > 0}
+        for phase, seconds in limits.items():
+            ctx.phase_timeouts.setdefault(phase, seconds)
+
+    @classmethod
+    def _finish_context(cls, ctx, error=None):
+        """Tell the execution observers that a run is over
+
+        Parameters
+        ----------
+        ctx : ExecutionContext
+            The context of the run
+        error : Exception, optional
+            The exception that ended the run, by default None
+        """
+        if ctx.locks:
+            resource_locks.locks.release(ctx.locks)
+            ctx.locks = []
+        notify('on_finish', ctx, error)
 
-        
+    @classmethod
+    def locked_keywords(cls, args, cfg):
+        """The keywords locked while the function runs
 
-        ##################
-        # POST CONDITION #
-        ##################
+        Parameters
+        ----------
+        args : dict
+            The arguments of the execution
+        cfg : ConfigParser
+            The loaded config
 
+        Returns
+        -------
+        iterable
+            (service, keyword) pairs, by default writes_keywords
+        """
+        return cls.writes_keywords
+
+    @classmethod
+    def _lock_keywords(cls, ctx):
+        """Take the keyword locks of an execution, recording the wait in
+        ctx.timings as "lock_wait"
+        """
+        keywords = cls.locked_keywords(ctx.args, ctx.cfg)
+        if not keywords:
+            ctx.locks = []
+            return
+        timeout = cls.lock_timeout
+        remaining = ctx.remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = max(remaining, 0)
+        ctx.locks, wait = resource_locks.locks.acquire(ctx, keywords, timeout)
+        ctx.timings.record('lock_wait', wait)
+        if wait > 0.1:
+            ctx.logger.info(f"Waited {wait:.2f} s for the locks of "
+                            f"{', '.join(ctx.locks)}")
+
+    # phase name: (name used in log messages, exception raised on failure)
+    _phases = {
+        'pre_condition': ('pre-condition', DDOIPreConditionFailed),
+        'perform': ('perform', DDOIPerformFailed),
+        'post_condition': ('post-condition', DDOIPostConditionFailed),
+    }
+
+    @classmethod
+    def _run_phase(cls, ctx, phase):
+        """Run one phase (pre_condition, perform or post_condition) of an
+        execution, timing it in the context and checking the arguments were
+        not altered. The context must be entered and set up (see
+        _setup_context).
+
+        Parameters
+        ----------
+        ctx : ExecutionContext
+            The context of the execution
+        phase : str
+            Name of the phase method
+
+        Returns
+        -------
+        The return value of the phase method
+        """
+        label, failure = cls._phases[phase]
+        ctx.check_cancelled()
+        logger = ctx.logger
+        if ctx.locks is None and phase not in cls.overlap_phases:
+            cls._lock_keywords(ctx)
+
+        limit = cls._phase_limit(ctx, phase)
+        notify('on_phase_start', ctx, phase)
         try:
-            cls.post_condition(args, logger, cfg)
+            with ctx.timings.time(phase):
+                if limit is None:
+                    result = cls._phase_method(ctx, phase)(ctx.args, logger,
+                                                           ctx.cfg)
+                else:
+                    result = cls._run_with_watchdog(ctx, phase, limit)
+        except DDOIPhaseTimeout as e:
+            notify('on_phase_end', ctx, phase, e)
+            logger.error(f"Deadline exceeded in {label}: {e}")
+            raise
         except Exception as e:
-            logger.error(f"Exception encountered in post-condition: {e}")
-            logger.error(traceback.format_exc(), exc_info=True)
-            raise DDOIPostConditionFailed()
-        
-        args_diff = cls._diff_args(initial_args, args)
-
-        if args_diff:
-            logger.debug(f"Args changed after post-condition")
-            logger.debug(f"Before: {initial_args}")
-            logger.debug(f"After: {args}")
-#             raise DDOIArgumentsChangedException(f"Args changed after post-condition")
-
-        
-        return return_value
-    
-        # # Check the pre-condition
-        # if not cls.pre_condition(args, logger, cfg):
-        #     return False
-
-        # # Make sure that the pre-condition did not alter the arguments
-        # args_diff = cls._diff_args(args, initial_args)
-        # if args_diff:
-        #     raise DDOIArgumentsChangedException(
-        #         f"Arguments changed after executing pre-condition: {args_diff}")
-
-        # cls.perform(args, logger, cfg)
-        # args_diff = cls._diff_args(args, initial_args)
-        # if args_diff:
-        #     raise DDOIArgumentsChangedException(
-        #         f"Arguments changed after executing perform: {args_diff}")
-
-        # pst = cls.post_condition(args, logger, cfg)
-        # args_diff = cls._diff_args(args, initial_args)
-        # if args_diff:
-        #     raise DDOIArgumentsChangedException(
-        #         f"Arguments changed after executing post-condition: {args_diff}")
-        # return pst
+            notify('on_phase_end', ctx, phase, e)
+            logger.error(f"Exception encountered in {label}: {e}", exc_info=True)
+            raise failure()
+        notify('on_phase_end', ctx, phase, None)
+
+        if cls._diff_args(ctx.initial_args, ctx.args):
+            logger.debug(f"Args changed after {label}")
+            logger.debug(f"Before: {ctx.initial_args}")
+            logger.debug(f"After: {ctx.args}")
+            # raise DDOIArgumentsChangedException(f"Args changed after {label}")
+
+        return result
+
+    @classmethod
+    def _phase_method(cls, ctx, phase):
+        """The method run for a phase: perform_delta instead of perform when
+        the context carries the delta from the previous sequence"""
+        if phase == 'perform' and ctx.delta is not None and cls.apply_delta:
+            delta = ctx.delta
+            return lambda args, logger, cfg: cls.perform_delta(args, delta,
+                                                               logger, cfg)
+        return getattr(cls, phase)
+
+    @classmethod
+    def _phase_limit(cls, ctx, phase):
+        """Seconds the phase may run, the sooner of its own timeout and the
+        execution's deadline; None if neither is set
+        """
+        own = ctx.phase_timeouts.get(phase)
+        limit = own
+        remaining = ctx.remaining()
+        if remaining is not None and (limit is None or remaining < limit):
+            limit = remaining
+        if limit is not None and limit <= 0:
+            # the execution's deadline passed before the phase could start
+            ctx.timings.record(f"{phase}_overrun", -limit)
+            if own is None:
+                own = ctx.deadline - ctx.start_time
+            raise DDOIPhaseTimeout(cls.__name__, phase, own, -limit)
+        return limit
+
+    @staticmethod
+    def _join_until(worker, expires):
+        """Wait for a thread to end or for clock.monotonic() to reach
+        expires, whichever comes first.  The limit is judged on the clock in
+        use, so a phase sleeping on a VirtualClock runs into it as well.
+        """
+        while worker.is_alive():
+            left = expires - clock.monotonic()
+            if left <= 0:
+                return
+            worker.join(min(left, WATCHDOG_POLL))
+
+    @classmethod
+    def _run_with_watchdog(cls, ctx, phase, limit):
+        """Run a phase in a worker thread and enforce its deadline: when it
+        passes, the execution is cancelled, abort_execution is called (if the
+        function is abortable) and the phase gets abort_grace seconds to
+        return before DDOIPhaseTimeout is raised.  The overrun is recorded in
+        ctx.timings as "<phase>_overrun".
+
+        Parameters
+        ----------
+        ctx : ExecutionContext
+            The context of the execution
+        phase : str
+            Name of the phase method
+        limit : float
+            Seconds the phase may run
+
+        Returns
+        -------
+        The return value of the phase method
+        """
+        outcome = {}
+        # Guards the hand over of the keyword locks to an abandoned worker
+        handover = threading.Lock()
+
+        def run():
+            # Observers that work per thread (e.g. the profiler) follow the
+            # phase into the worker
+            notify('on_worker_start', ctx, phase)
+            try:
+                outcome['result'] = cls._phase_method(ctx, phase)(
+                    ctx.args, ctx.logger, ctx.cfg)
+            except BaseException as e:
+                outcome['error'] = e
+            finally:
+                notify('on_worker_end', ctx, phase)
+                with handover:
+                    outcome['done'] = True
+                    abandoned = outcome.pop('locks', None)
+                if abandoned:
+                    resource_locks.locks.release(abandoned)
+
+        # The worker runs in this context, so nested executions and KTL
+        # calls still belong to this execution
+        context = contextvars.copy_context()
+        worker = threading.Thread(target=context.run, args=(run,),
+                                  daemon=True,
+                                  name=f"{cls.__name__}.{phase}")
+        expires = clock.monotonic() + limit
+        worker.start()
+        cls._join_until(worker, expires)
+
+        if worker.is_alive():
+            logger = ctx.logger
+            logger.error(f"{phase} did not finish within {limit:.1f} s, "
+                         f"aborting")
+            ctx.cancel(f"{phase} deadline exceeded")
+            if cls.abortable:
+                try:
+                    cls.abort_execution(ctx.args, logger, ctx.cfg)
+                except Exception as e:
+                    logger.error(f"abort_execution failed: {e}")
+            cls._join_until(worker, clock.monotonic() + cls.abort_grace)
+            with handover:
+                if not outcome.get('done'):
+                    # The worker may still be writing the locked keywords:
+                    # it keeps the locks and releases them when it returns
+                    logger.error(f"{phase} still running {cls.abort_grace} s "
+                                 f"after abort, abandoning it")
+                    outcome['locks'], ctx.locks = ctx.locks, []
+            overrun = clock.monotonic() - expires
+            ctx.timings.record(f"{phase}_overrun", overrun)
+            raise DDOIPhaseTimeout(cls.__name__, phase, limit, overrun)
+
+        overrun = clock.monotonic() - expires
+        if overrun > 0:
+            # the phase returned, but after its deadline (on a VirtualClock
+            # a sleep moves the time past it at once)
+            ctx.timings.record(f"{phase}_overrun", overrun)
+            raise DDOIPhaseTimeout(cls.__name__, phase, limit, overrun)
+
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('result')
 
     @classmethod
     def pre_condition(cls, args, logger, cfg):
@@ -169,11 +507,86 @@ class TranslatorModuleFunction:
         # This is where the bulk of instrument code lives
         raise NotImplementedError()
     
+    @classmethod
+    def perform_delta(cls, args, delta, logger, cfg):
+        """Perform a sequence of an OB right after the previous sequence was
+        performed, reconfiguring only what changed (see apply_delta).  By
+        default the whole perform runs.
+
+        Parameters
+        ----------
+        args : dict
+            The full arguments of this sequence
+        delta : sequence_diff.ArgDelta
+            The arguments that changed since the previous sequence
+        logger : DDOILoggerClient
+            The logger
+        cfg : ConfigParser
+            The config
+        """
+        return cls.perform(args, logger, cfg)
+
     @classmethod
     def post_condition(cls, args, logger, cfg):
         # post-checks go here
         raise NotImplementedError()
 
+    @classmethod
+    def verify_completed(cls, args, logger, cfg):
+        """Check that the hardware is still in the state a completed run with
+        these arguments left it in, before a resumed OB skips the run (see
+        checkpoint).  By default nothing is verified and completed runs are
+        run again; override it where the state can be checked.
+
+        Parameters
+        ----------
+        args : dict
+            The arguments of the completed run
+        logger : DDOILoggerClient
+            The logger
+        cfg : ConfigParser
+            The config
+
+        Returns
+        -------
+        bool
+            True if the run can be skipped, False to run it again
+        """
+        return False
+
+    @classmethod
+    def check_completed(cls, args, logger=None, cfg=None):
+        """Run verify_completed with the config loaded.  It is not an
+        execution, so the execution observers (history, metrics, tracing) do
+        not see it.  A failing check counts as not verified.
+
+        Parameters
+        ----------
+        args : dict
+            The arguments of the completed run
+        logger : DDOILoggerClient, optional
+            The logger, by default the root logger
+        cfg : filepath or ConfigParser, optional
+            The config, by default the function's default
+
+        Returns
+        -------
+        bool
+            True if the run can be skipped
+        """
+        if logger is None:
+            logger = getLogger("")
+        if type(args) == Namespace:
+            args = vars(args)
+        try:
+            if not isinstance(cfg, configparser.ConfigParser):
+                cfg = cls._load_config(cls, cfg, args=args)
+            return bool(cls.verify_completed(args, logger, cfg))
+        except Exception as e:
+            logger.warning(f"Could not verify the completed run, running it "
+                           f"again: {e}")
+            return False
+
     @classmethod
     def abort_execution(cls, args, logger, cfg):
         # Code to abort execution goes here
@@ -184,6 +597,10 @@ class TranslatorModuleFunction:
         if logger is None:
             logger = getLogger("")
 
+        # Stop any in-flight executions of this function before their next phase
+        for ctx in active_contexts(cls):
+            ctx.cancel("abort requested")
+
         if cls.abortable:
             cls.abort_execution(args, logger, cfg)
         else:
@@ -215,6 +632,35 @@ class TranslatorModuleFunction:
                 return True
         return False
 
+    @classmethod
+    def read_many(cls, keywords, timeout=ktl_access.DEFAULT_TIMEOUT,
+                  binary=False, strict=True):
+        """Read several KTL keywords as one snapshot, reading the services
+        concurrently (see ktl_access.read_many)
+
+            status = cls.read_many([('mfcs', 'ACTIVE'), ('mfcs', 'ENABLE')])
+            active = bool(int(status['mfcs', 'ACTIVE']))
+
+        Parameters
+        ----------
+        keywords : iterable
+            (service, keyword) pairs or "service.keyword" names
+        timeout : float, optional
+            Seconds allowed for the whole set, by default
+            ktl_access.DEFAULT_TIMEOUT
+        binary : bool, optional
+            Return the binary instead of the ascii values, by default False
+        strict : bool, optional
+            Raise if any keyword could not be read, by default True
+
+        Returns
+        -------
+        ktl_access.Snapshot
+            The values, with the time each was received
+        """
+        return ktl_access.read_many(keywords, timeout=timeout, binary=binary,
+                                    strict=strict)
+
     """
     Configuration File Read Section
     """
@@ -244,8 +690,34 @@ class TranslatorModuleFunction:
         elif isinstance(cfg, str):
             config_files = [cfg]
 
+        # re-use the parsed values while none of the files have changed.
+        # Every call gets its own ConfigParser, so changes made to it by one
+        # execution are not seen by the others.
+        cache_key = tuple(config_files)
+        mtimes = tuple(_mtime(f) for f in config_files)
+        with _config_cache_lock:
+            cached = _config_cache.pop(cache_key, None)
+            if cached is not None and cached[0] == mtimes:
+                _config_cache[cache_key] = cached
+                config = configparser.ConfigParser(
+                    inline_comment_prefixes=(';','#',))
+                config.read_dict(cached[1])
+                # identifies the config to caches keyed on it (see
+                # argspec.compiled_schema)
+                config.source_key = (cache_key, mtimes)
+                return config
+
         config = configparser.ConfigParser(inline_comment_prefixes=(';','#',))
         config.read(config_files)
+        values = {section: dict(config.items(section, raw=True))
+                  for section in config.sections()}
+        values[config.default_section] = dict(config.defaults())
+        config.source_key = (cache_key, mtimes)
+
+        with _config_cache_lock:
+            _config_cache[cache_key] = (mtimes, values)
+            while len(_config_cache) > CONFIG_CACHE_SIZE:
+                del _config_cache[next(iter(_config_cache))]
 
         return config
 
@@ -368,7 +840,7 @@ class TranslatorModuleFunction:
         return parser
 
     @classmethod
-    def map_OB(cls, OB, sequence_number, cfg=None):
+    def map_OB(cls, OB, sequence_number, cfg=None, compact=False):
         """Maps values in an OB to a dictionary of arguments to be parsed 
         by the translator module functions. The parameters are loaded in the
         following order, with each subsequent step overwriting any keys with
@@ -388,10 +860,13 @@ class TranslatorModuleFunction:
             Observing Block, in dictionary form
         cfg : path or pathlike
             Location of the config file to use to map the OB
+        compact : bool, optional
+            Return a compact ArgRecord (see arg_records) instead of a dict,
+            for holding many sequences in memory, by default False
 
         Returns
         -------
-        dict
+        dict or ArgRecord
             Dictionary of arguments to be passed into the translator
         """
 
@@ -475,4 +950,7 @@ class TranslatorModuleFunction:
                 out_args[newkey] = in_args[key]
             except KeyError:
                 out_args[key] = in_args[key]
+
+        if compact:
+            return record_type(cls, config).from_dict(out_args)
         return out_args
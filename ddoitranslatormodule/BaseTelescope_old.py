@@ -1,13 +1,19 @@
 from ddoitranslatormodule.BaseFunction import TranslatorModuleFunction
 from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIInvalidArguments, DDOIKTLTimeOut
 from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOINotSelectedInstrument, DDOINoInstrumentDefined
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIServiceUnavailable
+from ddoitranslatormodule import ktl_access, offset_patterns
 
 import os
-import ktl
 
 
 class TelescopeBase(TranslatorModuleFunction):
 
+    # If True, _write_to_kw skips writes of values the keyword already has.
+    # The "enabled" option of the [write_elision] config section takes
+    # precedence.
+    elide_writes = False
+
     def _cfg_location(cls, args):
         """
         Return the fullpath + filename of default configuration file.
@@ -73,7 +79,7 @@ class TelescopeBase(TranslatorModuleFunction):
         return val
 
     def _write_to_kw(cls, cfg, ktl_service, key_val, logger, cls_name,
-                     cfg_key=False, retry=True):
+                     cfg_key=False, retry=True, elide=None):
         """
         Write to KTL keywords while handling the Timeout Exception
 
@@ -86,9 +92,15 @@ class TelescopeBase(TranslatorModuleFunction):
             defaults to a generic name specified in the config, by
             default None
         :param cls_name: The name of the calling class
+        :param elide: <bool> skip writes of values that are already set,
+            by default cls.elide_writes or the [write_elision] config
 
         :return: None
         """
+        if elide is None:
+            elide = ktl_access.elision_enabled(cfg, cls.elide_writes)
+        # the real ktl module or a simulator (see ktl_access.set_backend)
+        ktl = ktl_access.backend()
 
         for ktl_key, new_val in key_val.items():
             if cfg_key:
@@ -97,9 +109,16 @@ class TelescopeBase(TranslatorModuleFunction):
                 logger.info(f"KTL write: {ktl_service} {ktl_key} {new_val}")
 
             try:
-                ktl.write(ktl_service, ktl_key, new_val, wait=True, timeout=2)
+                ktl_access.write(ktl_service, ktl_key, new_val, wait=True,
+                                 timeout=2, elide=elide, logger=logger)
                 # print(ktl_key, new_val, type(new_val))
                 # print(f'reading {ktl_service} {ktl_key}:', ktl.read(ktl_service, ktl_key))
+            except DDOIServiceUnavailable as err:
+                # the service keeps failing, don't wait (or retry) for it
+                if logger:
+                    logger.error(f"{cls_name} not writing {ktl_service} "
+                                 f"{ktl_key}: {err}")
+                raise
             except ktl.TimeoutException as err:
                 msg = f"{cls_name} timeout writing to service: {ktl_service}, " \
                       f"keyword: {ktl_key}, new value: {new_val}. Error: {err}."
@@ -110,7 +129,8 @@ class TelescopeBase(TranslatorModuleFunction):
                 if retry:
                     logger.info(f"retrying,  KTL error: {err}")
                     cls._write_to_kw(cls, cfg, ktl_service, key_val, logger,
-                                     cls_name, cfg_key=cfg_key, retry=False)
+                                     cls_name, cfg_key=cfg_key, retry=False,
+                                     elide=elide)
                 else:
                     line_str = "="*80
                     msg = f"\n\n{line_str}\n{cls_name} error writing to " \
@@ -122,6 +142,53 @@ class TelescopeBase(TranslatorModuleFunction):
                         logger.error(msg)
                     raise ktl.ktlError(msg)
 
+    def offset_pattern(cls, args):
+        """
+        Build the dither / offset pattern of a sequence from the arguments.
+
+        :param args: <dict> the command arguments, with 'pattern' a dict of
+            the pattern 'type' (box, abba, random or custom) and the
+            arguments of offset_patterns.<type>, e.g.
+            {'type': 'box', 'size': 20, 'points': 5}
+
+        :return: <OffsetPattern> all positions of the sequence
+        """
+        spec = cls._get_arg_value(args, 'pattern')
+        params = {key: val for key, val in spec.items() if key != 'type'}
+        try:
+            return offset_patterns.make_pattern(spec['type'], **params)
+        except (KeyError, TypeError, ValueError) as err:
+            msg = f'invalid offset pattern {spec}: {err}'
+            raise DDOIInvalidArguments(msg)
+
+    def run_offset_pattern(cls, cfg, pattern, move, logger=None,
+                           return_to_start=False):
+        """
+        Check every position of a pattern against the [offset_limits] of the
+        config, then stream the relative moves to the move function, so a
+        long pattern fails before the first move instead of partway through.
+
+        :param cfg: <class 'configparser.ConfigParser'> the config file parser.
+        :param pattern: <OffsetPattern> the positions
+        :param move: callable(dx, dy) making one relative move in arcseconds
+        :param logger: <DDOILoggerClient>, optional
+        :param return_to_start: <bool> move back to the starting position
+            after the last one
+
+        :return: <int> the number of moves made
+        """
+        offset_patterns.OffsetLimits.from_config(cfg).check(
+            pattern, return_to_start=return_to_start)
+        cls.write_msg(logger, f"offset pattern {pattern.name}: "
+                              f"{len(pattern)} positions within the limits")
+
+        count = 0
+        for dx, dy in pattern.moves(return_to_start=return_to_start):
+            move(dx, dy)
+            count += 1
+
+        return count
+
     def get_inst_name(cls, args, cfg, allow_current=True):
         """
         Get the instrument name from the arguments,  if not defined get from
@@ -164,8 +231,9 @@ class TelescopeBase(TranslatorModuleFunction):
         else:
             ktl_instrument = 'instrume'
 
+        ktl = ktl_access.backend()
         try:
-            inst = ktl.read(serv_name, ktl_instrument, timeout=2)
+            inst = ktl_access.read(serv_name, ktl_instrument, timeout=2)
         except ktl.TimeoutException:
             msg = f'timeout reading,  service {serv_name}, ' \
                   f'keyword: {ktl_instrument}'
@@ -0,0 +1,343 @@
+"""
+Compact argument records for holding many mapped sequences in memory.
+
+``map_OB`` returns a plain dict per sequence that merges the target,
+acquisition, common and observation parameters.  When a whole semester of
+OBs is expanded for planning, these dicts (and the copies made by
+``execute()``) dominate memory.  ``record_type(function)`` generates a
+``__slots__`` record class per translator function whose instances store only
+a list of values; the key table is shared by (and interned for) every
+record with the same keys.  Records behave like dicts for existing ``perform``
+code (``args['exptime']``, ``args.get(...)``, ``in``, iteration, ``items()``)
+and are accepted by ``execute()``.
+
+    args = Expose.map_OB(OB, 1, compact=True)
+
+Every set of keys outside the argument spec (a shape, e.g. the parameters
+of one program) gets its own key table, the spec's keys followed by those
+keys, so a record only has slots for the keys of its shape.  Records still
+hold one value per key; what they save is the hash table of a dict.  After
+``MAX_SHAPES`` shapes per function, the keys outside the spec of further
+shapes are kept in a small dict per record.
+
+Run this module to compare the memory of records and dicts:
+
+    python -m ddoitranslatormodule.arg_records
+"""
+
+import sys
+import copy
+import threading
+import tracemalloc
+from collections.abc import MutableMapping
+
+from ddoitranslatormodule.argspec import function_arg_spec, _config_key
+
+# Marks a key of the table that has no value in a record
+_MISSING = object()
+
+# Key tables per function beyond its argument spec's
+MAX_SHAPES = 64
+
+
+class ArgRecord(MutableMapping):
+    """Base class of the generated record types
+    """
+    __slots__ = ('_values', '_extra')
+
+    # Shared by every instance of a generated class
+    _keys = []
+    _index = {}
+    _lock = None
+    # The class generated for the function, and its key tables by shape:
+    # {frozenset of keys outside the spec: subclass}
+    _base = None
+    _shapes = None
+
+    def __init__(self, *args, **kwargs):
+        self._values = []
+        self._extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a record from a dict, of the record type of its keys
+
+        Parameters
+        ----------
+        data : dict
+            The arguments
+
+        Returns
+        -------
+        ArgRecord
+        """
+        base = cls._base
+        index = base._index
+        extra = [key for key in data if key not in index]
+        rec_type = base._shape(extra) if extra else base
+        record = rec_type.__new__(rec_type)
+        index = rec_type._index
+        values = [_MISSING] * len(rec_type._keys)
+        overflow = None
+        for key, value in data.items():
+            idx = index.get(key)
+            if idx is None:
+                if overflow is None:
+                    overflow = {}
+                overflow[key] = value
+            else:
+                values[idx] = value
+        record._values = values
+        record._extra = overflow
+        return record
+
+    @classmethod
+    def _shape(cls, extra):
+        """The record type of the keys extra (outside the spec), the base
+        type once MAX_SHAPES types exist"""
+        shape = frozenset(extra)
+        rec_type = cls._shapes.get(shape)
+        if rec_type is not None:
+            return rec_type
+        with cls._lock:
+            rec_type = cls._shapes.get(shape)
+            if rec_type is None:
+                if len(cls._shapes) >= MAX_SHAPES:
+                    return cls
+                keys = cls._keys + [sys.intern(key) if isinstance(key, str)
+                                    else key for key in extra]
+                rec_type = type(cls.__name__, (cls,), {
+                    '__slots__': (),
+                    '__module__': __name__,
+                    '_keys': keys,
+                    '_index': {key: idx for idx, key in enumerate(keys)},
+                })
+                cls._shapes[shape] = rec_type
+        return rec_type
+
+    def __getitem__(self, key):
+        idx = self._index.get(key)
+        if idx is not None and idx < len(self._values):
+            value = self._values[idx]
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        idx = self._index.get(key)
+        if idx is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+        values = self._values
+        if idx >= len(values):
+            values.extend([_MISSING] * (idx + 1 - len(values)))
+        values[idx] = value
+
+    def __delitem__(self, key):
+        idx = self._index.get(key)
+        if idx is not None and idx < len(self._values) \
+                and self._values[idx] is not _MISSING:
+            self._values[idx] = _MISSING
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        keys = self._keys
+        for idx, value in enumerate(self._values):
+            if value is not _MISSING:
+                yield keys[idx]
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        count = sum(1 for value in self._values if value is not _MISSING)
+        return count + (len(self._extra) if self._extra else 0)
+
+    def __contains__(self, key):
+        idx = self._index.get(key)
+        if idx is not None:
+            return idx < len(self._values) and self._values[idx] is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        idx = self._index.get(key)
+        if idx is not None:
+            if idx < len(self._values):
+                value = self._values[idx]
+                if value is not _MISSING:
+                    return value
+            return default
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def to_dict(self):
+        """A plain dict with the same contents"""
+        return dict(self.items())
+
+    def copy(self):
+        record = type(self).__new__(type(self))
+        record._values = list(self._values)
+        record._extra = dict(self._extra) if self._extra else None
+        return record
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        record = type(self).__new__(type(self))
+        record._values = [value if value is _MISSING
+                          else copy.deepcopy(value, memo)
+                          for value in self._values]
+        record._extra = copy.deepcopy(self._extra, memo)
+        return record
+
+    def __reduce__(self):
+        # The generated classes are not importable, pickle as a plain dict
+        return dict, (self.to_dict(),)
+
+
+# {function: (config key, generated record class)}
+_record_types = {}
+_record_types_lock = threading.Lock()
+
+
+def record_type(function, cfg=None):
+    """The record class of a translator function, generated on first use
+
+    Parameters
+    ----------
+    function : class
+        The TranslatorModuleFunction
+    cfg : filepath or ConfigParser, optional
+        Config passed to add_cmdline_args when the argument spec is read; the
+        class is generated again when the config changes, by default None
+
+    Returns
+    -------
+    class
+        Subclass of ArgRecord whose key table holds the function's
+        arguments, from_dict returns records of its key tables by shape
+    """
+    cfg_key = _config_key(cfg)
+    with _record_types_lock:
+        cached = _record_types.get(function)
+        if cached is not None and cached[0] == cfg_key:
+            return cached[1]
+        try:
+            keys = list(function_arg_spec(function, cfg))
+            spec_read = True
+        except Exception:
+            # every key goes to the shapes; not kept, so the next call tries
+            # to read the spec again
+            keys = []
+            spec_read = False
+        keys = [sys.intern(key) for key in keys]
+        rec_type = type(f"{function.__name__}Args", (ArgRecord,), {
+            '__slots__': (),
+            '__module__': __name__,
+            '_keys': keys,
+            '_index': {key: idx for idx, key in enumerate(keys)},
+            '_lock': threading.Lock(),
+            '_shapes': {},
+        })
+        rec_type._base = rec_type
+        if spec_read:
+            _record_types[function] = (cfg_key, rec_type)
+        return rec_type
+
+
+def _sample_args(n_keys=40):
+    """Mapped arguments resembling map_OB output: mostly shared target,
+    acquisition and common parameters plus a few per sequence values
+    """
+    args = {f"param_{i}": float(i) for i in range(n_keys - 4)}
+    args.update({'exptime': 10.0, 'coadds': 1, 'object': 'target',
+                 'sequence_number': 1})
+    return args
+
+
+def benchmark_memory(n=20000, n_keys=40, n_unique=4):
+    """Compare the memory used by n dicts and n records (with the copies
+    execute() makes), with the same keys in every sequence and with keys
+    unique to each sequence
+
+    Parameters
+    ----------
+    n : int, optional
+        Number of sequences, by default 20000
+    n_keys : int, optional
+        Keys per sequence, by default 40
+    n_unique : int, optional
+        Keys only one sequence has, in the heterogeneous case, by default 4
+
+    Returns
+    -------
+    dict
+        Bytes per sequence for dicts and records ('dict', 'record', and
+        '..._heterogeneous'), with and without the deepcopy made by execute()
+    """
+    from ddoitranslatormodule.BaseFunction import TranslatorModuleFunction
+
+    class _Benchmark(TranslatorModuleFunction):
+        pass
+
+    template = _sample_args(n_keys)
+    rec_type = record_type(_Benchmark)
+    results = {}
+
+    def measure(name, build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        items = build()
+        held = tracemalloc.get_traced_memory()[0] - before
+        copies = [copy.deepcopy(item) for item in items]
+        with_copies = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results[name] = {'bytes_per_sequence': held / n,
+                         'with_execute_copy': with_copies / n}
+        del items, copies
+
+    def sequence(i, unique):
+        args = dict(template)
+        args['sequence_number'] = i
+        for j in range(unique):
+            args[f"note_{i}_{j}"] = j
+        return args
+
+    def dicts(unique=0):
+        return [sequence(i, unique) for i in range(n)]
+
+    def records(unique=0):
+        return [rec_type.from_dict(sequence(i, unique)) for i in range(n)]
+
+    measure('dict', dicts)
+    measure('record', records)
+    measure('dict_heterogeneous', lambda: dicts(n_unique))
+    measure('record_heterogeneous', lambda: records(n_unique))
+    for case in ('', '_heterogeneous'):
+        results[f'ratio{case}'] = \
+            results[f'record{case}']['bytes_per_sequence'] \
+            / results[f'dict{case}']['bytes_per_sequence']
+    return results
+
+
+if __name__ == "__main__":
+    res = benchmark_memory()
+    for case in ('', '_heterogeneous'):
+        for name in ('dict', 'record'):
+            name += case
+            print(f"{name:>20}: {res[name]['bytes_per_sequence']:8.0f} bytes/sequence, "
+                  f"{res[name]['with_execute_copy']:8.0f} with the execute() copy")
+        print(f"records use {res['ratio' + case]:.0%} of the memory of dicts")
@@ -0,0 +1,450 @@
+"""
+Argument specifications of translator module functions.
+
+A function declares its arguments for the command line through
+``add_cmdline_args`` (usually with ``_add_args``), and its minimum
+programmatic arguments through ``min_args``.  ``function_arg_spec`` turns both
+into a plain description of every argument so that argument dicts (e.g. the
+output of ``map_OB``) can be checked without running the function.
+
+``compiled_schema`` compiles the spec of a function once into a
+``CompiledSchema``, which ``execute()`` of functions with ``validate_args``
+uses to check and coerce the arguments of every call before the
+pre-condition runs.
+
+The specs are read from a parser that records what ``add_cmdline_args``
+adds and never parses the command line, so describing a function does not
+depend on (or exit because of) ``sys.argv``.
+"""
+
+import threading
+from argparse import ArgumentParser, Namespace, _HelpAction, _StoreTrueAction, _StoreFalseAction, SUPPRESS
+
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIInvalidArguments
+
+
+class ArgSpec:
+    """Description of one argument of a translator function
+    """
+    __slots__ = ('name', 'type', 'required', 'choices', 'default',
+                 'positional', 'multiple')
+
+    def __init__(self, name, type=None, required=False, choices=None,
+                 default=None, positional=False, multiple=False):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.choices = choices
+        self.default = default
+        self.positional = positional
+        # True if the argument takes a list of values (nargs)
+        self.multiple = multiple
+
+    def __repr__(self):
+        type_name = getattr(self.type, '__name__', self.type)
+        return f"<ArgSpec {self.name} {type_name}" \
+               f"{' required' if self.required else ''}>"
+
+    def check(self, value):
+        """Check a value against the spec
+
+        Parameters
+        ----------
+        value :
+            The value given for the argument
+
+        Returns
+        -------
+        str or None
+            Description of the problem, None if the value is valid
+        """
+        if value is None:
+            if self.required:
+                return f"{self.name} is required"
+            return None
+        values = value if self.multiple and isinstance(value, (list, tuple)) \
+            else [value]
+        for value in values:
+            try:
+                converted = coerce(value, self.type)
+            except (TypeError, ValueError) as e:
+                type_name = getattr(self.type, '__name__', self.type)
+                return f"{self.name}={value!r} is not a valid {type_name}: {e}"
+            if self.choices is not None and converted not in self.choices:
+                return f"{self.name}={value!r} is not one of {list(self.choices)}"
+        return None
+
+
+def coerce(value, arg_type):
+    """Convert a value to an argument type the way argparse would, while
+    accepting values that already have (or exactly represent) the type
+
+    Parameters
+    ----------
+    value :
+        The value to convert
+    arg_type : callable or None
+        The argparse type of the argument
+
+    Returns
+    -------
+    The converted value
+
+    Raises
+    ------
+    ValueError, TypeError
+        If the value can not be converted
+    """
+    if arg_type is bool:
+        return _to_bool(value)
+    if arg_type is None or isinstance(value, str):
+        return value if arg_type is None else arg_type(value)
+    if arg_type is int:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(f"expected a number, got {type(value).__name__}")
+        if value != int(value):
+            raise ValueError(f"{value} is not an integer")
+        return int(value)
+    if arg_type is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(f"expected a number, got {type(value).__name__}")
+        return float(value)
+    if isinstance(arg_type, type) and isinstance(value, arg_type):
+        return value
+    return arg_type(value)
+
+
+class SpecParser(ArgumentParser):
+    """ArgumentParser that only records the arguments added to it.  Parsing
+    never reads sys.argv: every argument gets its default, so functions whose
+    add_cmdline_args parses (e.g. _add_args with print_only) can be described
+    anywhere.
+    """
+
+    def __init__(self):
+        super().__init__(add_help=False, exit_on_error=False)
+
+    def parse_known_args(self, args=None, namespace=None):
+        if namespace is None:
+            namespace = Namespace()
+        for action in self._actions:
+            if action.dest != SUPPRESS and not hasattr(namespace, action.dest):
+                setattr(namespace, action.dest, action.default)
+        return namespace, []
+
+    def error(self, message):
+        raise DDOIInvalidArguments(message)
+
+
+def _multiple(action):
+    """True if an argparse action takes a list of values"""
+    return action.nargs in ('*', '+') or \
+        (isinstance(action.nargs, int) and action.nargs > 1)
+
+
+def parser_arg_specs(parser):
+    """Describe the arguments added to an ArgumentParser
+
+    Parameters
+    ----------
+    parser : ArgumentParser
+        Parser the function's add_cmdline_args was applied to
+
+    Returns
+    -------
+    dict
+        {argument name: ArgSpec}
+    """
+    specs = {}
+    for action in parser._actions:
+        if isinstance(action, _HelpAction) or action.dest == SUPPRESS:
+            continue
+        positional = not action.option_strings
+        arg_type = action.type
+        if isinstance(action, (_StoreTrueAction, _StoreFalseAction)):
+            arg_type = bool
+        required = action.required if not positional \
+            else action.nargs not in ('?', '*')
+        specs[action.dest] = ArgSpec(action.dest, arg_type, required,
+                                     action.choices, action.default,
+                                     positional, _multiple(action))
+    return specs
+
+
+def function_arg_spec(function, cfg=None, preset_args=None):
+    """Describe all the arguments of a translator function
+
+    Parameters
+    ----------
+    function : class
+        The TranslatorModuleFunction
+    cfg : filepath or ConfigParser, optional
+        Config passed to add_cmdline_args, by default None
+    preset_args : list, optional
+        (index, value) default positional arguments from the linking table
+        (LinkingTable.get_link_and_args); the matching positional arguments
+        are no longer required, by default None
+
+    Returns
+    -------
+    dict
+        {argument name: ArgSpec}, including the min_args of the function
+    """
+    parser = function.add_cmdline_args(SpecParser(), cfg)
+    specs = parser_arg_specs(parser)
+
+    if preset_args:
+        positionals = [spec for spec in specs.values() if spec.positional]
+        for idx, value in preset_args:
+            if 0 <= idx < len(positionals):
+                positionals[idx].required = False
+                positionals[idx].default = value
+
+    for name, arg_type in function.min_args.items():
+        if not callable(arg_type):
+            arg_type = None
+        spec = specs.get(name)
+        if spec is None:
+            specs[name] = ArgSpec(name, arg_type, required=True)
+        else:
+            spec.required = True
+            if spec.type is None:
+                spec.type = arg_type
+    return specs
+
+
+def check_args(specs, args):
+    """Check an argument dict against argument specs
+
+    Parameters
+    ----------
+    specs : dict
+        {argument name: ArgSpec}, from function_arg_spec
+    args : dict
+        The arguments
+
+    Returns
+    -------
+    list
+        Descriptions of every problem found, empty if the args are valid
+    """
+    errors = []
+    for name, spec in specs.items():
+        error = spec.check(args.get(name))
+        if error:
+            errors.append(error)
+    return errors
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        if value.lower() in ('yes', 'true', 't', 'y', '1'):
+            return True
+        if value.lower() in ('no', 'false', 'f', 'n', '0'):
+            return False
+    raise ValueError(f"boolean value expected, got {value!r}")
+
+
+def _to_int(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return coerce(value, int)
+
+
+def _to_float(value):
+    if type(value) is float:
+        return value
+    return coerce(value, float)
+
+
+def _to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple, dict)):
+        # structured OB values are left for the function to interpret
+        return value
+    raise TypeError(f"expected a string, got {type(value).__name__}")
+
+
+def _each(convert):
+    """Conversion of every value of a list argument"""
+    def convert_each(value):
+        if not isinstance(value, (list, tuple)):
+            return convert(value)
+        converted = [convert(item) for item in value]
+        if all(new is old for new, old in zip(converted, value)):
+            return value
+        return converted
+    return convert_each
+
+
+def _converter(arg_type, multiple=False):
+    """Fastest conversion function for an argument type"""
+    if arg_type is not None and multiple:
+        return _each(_converter(arg_type))
+    if arg_type is None:
+        return None
+    if arg_type is int:
+        return _to_int
+    if arg_type is float:
+        return _to_float
+    if arg_type is str:
+        return _to_str
+    if arg_type is bool:
+        return _to_bool
+    return lambda value: coerce(value, arg_type)
+
+
+class CompiledSchema:
+    """Argument specs of a function compiled for fast validation of argument
+    dicts
+    """
+    __slots__ = ('name', '_fields')
+
+    def __init__(self, name, specs):
+        """Compile argument specs
+
+        Parameters
+        ----------
+        name : str
+            Name of the function, used in error messages
+        specs : dict
+            {argument name: ArgSpec}, from function_arg_spec
+        """
+        self.name = name
+        fields = []
+        for spec in specs.values():
+            choices = spec.choices
+            if choices is not None:
+                try:
+                    choices = frozenset(choices)
+                except TypeError:
+                    choices = tuple(choices)
+            fields.append((spec.name, _converter(spec.type, spec.multiple),
+                           spec.required, choices, spec.multiple))
+        self._fields = tuple(fields)
+
+    def validate(self, args):
+        """Check the required arguments are present and coerce the values to
+        their declared types
+
+        Parameters
+        ----------
+        args : dict
+            The arguments of a call
+
+        Returns
+        -------
+        dict
+            args itself if nothing needed converting, otherwise a copy (of the
+            same type) holding the converted values
+
+        Raises
+        ------
+        DDOIInvalidArguments
+            Listing every missing or invalid argument
+        """
+        errors = None
+        coerced = None
+        for name, convert, required, choices, multiple in self._fields:
+            value = args.get(name)
+            if value is None:
+                if required:
+                    errors = errors or []
+                    errors.append(f"{name} is required")
+                continue
+            if convert is not None:
+                try:
+                    new_value = convert(value)
+                except (TypeError, ValueError) as e:
+                    errors = errors or []
+                    errors.append(f"{name}={value!r}: {e}")
+                    continue
+                if new_value is not value:
+                    coerced = coerced or {}
+                    coerced[name] = new_value
+                    value = new_value
+            if choices is None:
+                continue
+            values = value if multiple and isinstance(value, (list, tuple)) \
+                else (value,)
+            if any(item not in choices for item in values):
+                errors = errors or []
+                errors.append(f"{name}={value!r} is not one of {sorted(choices, key=str)}")
+
+        if errors:
+            raise DDOIInvalidArguments(
+                f"Invalid arguments for {self.name}: {'; '.join(errors)}")
+        if coerced:
+            args = args.copy()
+            args.update(coerced)
+        return args
+
+
+# {function: (config key, CompiledSchema or None)}
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def _config_key(cfg):
+    """Comparable identity of a config, every execution gets its own
+    ConfigParser so the object itself can not be compared.
+
+    Configs from _load_config carry their files and mtimes as
+    ``source_key``; the contents of other ConfigParsers are keyed once and
+    the key kept on the object.
+    """
+    if cfg is None or isinstance(cfg, str):
+        return cfg
+    key = getattr(cfg, 'source_key', None)
+    if key is not None:
+        return key
+    try:
+        key = tuple((section, tuple(cfg.items(section, raw=True)))
+                    for section in cfg.sections()) + \
+            (tuple(cfg.defaults().items()),)
+    except AttributeError:
+        return id(cfg)
+    try:
+        cfg.source_key = key
+    except AttributeError:
+        pass
+    return key
+
+
+def compiled_schema(function, cfg=None):
+    """The compiled schema of a function, compiled on first use
+
+    Parameters
+    ----------
+    function : class
+        The TranslatorModuleFunction
+    cfg : ConfigParser, optional
+        Config passed to add_cmdline_args; the schema is recompiled when the
+        config's contents change, by default None
+
+    Returns
+    -------
+    CompiledSchema or None
+        None if the function's arguments could not be described (e.g.
+        add_cmdline_args needs something that is not available)
+    """
+    key = _config_key(cfg)
+    with _schemas_lock:
+        cached = _schemas.get(function)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    try:
+        schema = CompiledSchema(function.__name__,
+                                function_arg_spec(function, cfg))
+    except Exception:
+        schema = None
+    with _schemas_lock:
+        _schemas[function] = (key, schema)
+    return schema
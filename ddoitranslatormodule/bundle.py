@@ -0,0 +1,493 @@
+"""
+Single-file startup bundle of the translator packages.
+
+``inst_script.py`` used to put network-mounted directories at the front of
+``sys.path``, so every import of the CLI (``yaml``, ``logging``, ...) was
+first looked for in them, one failed stat at a time.  A bundle holds
+``ddoitranslatormodule``, the instrument package of a linking table and
+their precompiled bytecode in one zip file on local disk, with an index of
+the modules.  ``install()`` puts a finder for it at the front of
+``sys.meta_path``, which answers for the bundled modules from the index and
+lets every other import go to the normal path without the network
+directories:
+
+    python -m ddoitranslatormodule.bundle build /usr/local/ddoi/kpf.bundle \\
+        --table /ddoi/KPFTranslator/default/KPFTranslator/kpf/linking_table.yml \\
+        --path /ddoi/KPFTranslator/default/KPFTranslator \\
+        --path /ddoi/DDOITranslatorModule/default/DDOITranslatorModule
+
+Bundled modules keep their source path as ``__file__``, so configuration
+files next to them (e.g. ``_cfg_location``) and tracebacks still refer to the
+deployed files.  A module reloaded by the reload manager is compiled from its
+source again.  The bundle is built for one Python version and is ignored by
+another.  The index records the size and mtime of every source and a hash of
+the linking table; ``inst_script.py`` compares them at start up
+(``BundleFinder.outdated``) and imports from the package directories, with a
+warning, once the packages were deployed again.  ``check`` lists what
+changed.
+
+This module only uses the standard library, and is also stored in the bundle
+(compiled) as the top level module ``ddoi_bundle``, which is what
+``inst_script.py`` imports from it with ``zipimport``.  It is imported on
+every start up, so the modules only needed to build or benchmark are imported
+where they are used.
+
+Compare the start up of the two layouts with:
+
+    python -m ddoitranslatormodule.bundle benchmark --table ... --path ...
+"""
+
+import os
+import sys
+import time
+import hashlib
+import marshal
+import zipimport
+import threading
+import importlib.util
+import importlib.machinery
+from pathlib import Path
+
+# Name of the index (a marshalled dict) in the bundle
+INDEX_NAME = '__index__.marshal'
+# Name this module is stored under in the bundle
+BOOT_MODULE = 'ddoi_bundle'
+# Packages always bundled
+CORE_PACKAGES = ('ddoitranslatormodule',)
+
+
+class BundleError(Exception):
+    pass
+
+
+def _pyc(code, mtime, size):
+    """Timestamp based pyc data of a code object, as py_compile writes it"""
+    return (importlib.util.MAGIC_NUMBER + (0).to_bytes(4, 'little')
+            + (int(mtime) & 0xFFFFFFFF).to_bytes(4, 'little')
+            + (size & 0xFFFFFFFF).to_bytes(4, 'little')
+            + marshal.dumps(code))
+
+
+def _package_modules(name, directory):
+    """(module name, source path, is package) of a package and everything
+    below it"""
+    directory = Path(directory)
+    yield name, directory / '__init__.py', True
+    for entry in sorted(directory.iterdir()):
+        if entry.name.startswith(('.', '__pycache__')):
+            continue
+        if entry.is_dir():
+            if (entry / '__init__.py').exists():
+                yield from _package_modules(f"{name}.{entry.name}", entry)
+        elif entry.suffix == '.py' and entry.name != '__init__.py':
+            yield f"{name}.{entry.stem}", entry, False
+
+
+def _find_package(name, search_path):
+    """Directory of a top level package, looked up in search_path then
+    sys.path"""
+    spec = importlib.machinery.PathFinder.find_spec(
+        name, list(search_path) + sys.path)
+    if spec is None or not spec.submodule_search_locations:
+        raise BundleError(f"Package {name} not found in {list(search_path)}")
+    return Path(list(spec.submodule_search_locations)[0])
+
+
+def _compile(source, optimize=-1):
+    return compile(source.read_bytes(), str(source), 'exec',
+                   dont_inherit=True, optimize=optimize)
+
+
+def _file_hash(path):
+    """sha256 hex digest of a file's contents"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def instrument_package(linking_table):
+    """Top level package of the functions of a linking table
+
+    Parameters
+    ----------
+    linking_table : str
+        Path to the linking table
+
+    Returns
+    -------
+    str
+        The first part of the table's prefix
+    """
+    import yaml
+    with open(linking_table) as f:
+        cfg = yaml.safe_load(f)
+    return cfg['common']['prefix'].split('.')[0]
+
+
+def build(output, linking_table=None, search_path=(), packages=(),
+          optimize=-1):
+    """Write a bundle of the translator packages
+
+    Parameters
+    ----------
+    output : str
+        Path of the bundle, preferably on local disk
+    linking_table : str, optional
+        Linking table whose instrument package is bundled
+    search_path : iterable, optional
+        Directories to look for the packages in before sys.path
+    packages : iterable, optional
+        Further top level packages to bundle
+    optimize : int, optional
+        Optimization level of the bytecode, as for compile(), by default the
+        interpreter's
+
+    Returns
+    -------
+    dict
+        The index written into the bundle
+    """
+    import zipfile
+
+    names = list(CORE_PACKAGES)
+    if linking_table is not None:
+        names.append(instrument_package(linking_table))
+    names.extend(packages)
+
+    modules = {}
+    output = Path(output)
+    tmp = output.with_name(output.name + '.tmp')
+    # stored, not deflated: the bundle is read on every start up
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED) as zf:
+        for package in dict.fromkeys(names):
+            directory = _find_package(package, search_path)
+            for name, source, is_package in _package_modules(package,
+                                                             directory):
+                stat = source.stat()
+                code = _compile(source, optimize)
+                entry = name.replace('.', '/') \
+                    + ('/__init__.pyc' if is_package else '.pyc')
+                zf.writestr(entry, _pyc(code, stat.st_mtime, stat.st_size))
+                modules[name] = {'entry': entry, 'package': is_package,
+                                 'origin': str(source),
+                                 'mtime': stat.st_mtime_ns,
+                                 'size': stat.st_size}
+        boot = Path(__file__)
+        zf.writestr(f"{BOOT_MODULE}.pyc", _pyc(_compile(boot, optimize),
+                                               boot.stat().st_mtime,
+                                               boot.stat().st_size))
+        index = {'magic': importlib.util.MAGIC_NUMBER.hex(),
+                 'python': sys.version.split()[0],
+                 'built': time.time(),
+                 'linking_table': (str(Path(linking_table).resolve())
+                                   if linking_table else None),
+                 'linking_table_hash': (_file_hash(linking_table)
+                                        if linking_table else None),
+                 'packages': list(dict.fromkeys(names)),
+                 'modules': modules}
+        zf.writestr(INDEX_NAME, marshal.dumps(index))
+    os.replace(tmp, output)
+    return index
+
+
+def read_index(bundle):
+    """The index of a bundle"""
+    return marshal.loads(zipimport.zipimporter(str(bundle)).get_data(
+        INDEX_NAME))
+
+
+def stale_modules(bundle):
+    """Bundled modules whose source changed or disappeared since the build
+
+    Parameters
+    ----------
+    bundle : str
+        Path of the bundle
+
+    Returns
+    -------
+    list
+        Module names
+    """
+    return _stale(read_index(bundle)['modules'])
+
+
+def _stale(modules):
+    stale = []
+    for name, info in modules.items():
+        try:
+            stat = os.stat(info['origin'])
+        except OSError:
+            stale.append(name)
+            continue
+        if stat.st_mtime_ns != info['mtime'] or stat.st_size != info['size']:
+            stale.append(name)
+    return stale
+
+
+class BundleFinder:
+    """Finds and loads the modules of a bundle from its index (a meta path
+    finder and the loader of the bundled modules)
+    """
+
+    def __init__(self, bundle):
+        """Open a bundle
+
+        Parameters
+        ----------
+        bundle : str
+            Path of the bundle
+
+        Raises
+        ------
+        BundleError
+            If the bundle was built by another Python version
+        """
+        self.bundle = str(bundle)
+        # zipimport is built in, and reads the zip directory once
+        self._zip = zipimport.zipimporter(self.bundle)
+        self._lock = threading.Lock()
+        self.index = marshal.loads(self._zip.get_data(INDEX_NAME))
+        if self.index['magic'] != importlib.util.MAGIC_NUMBER.hex():
+            raise BundleError(f"{self.bundle} was built for Python "
+                              f"{self.index['python']}")
+        self.modules = self.index['modules']
+        # Modules loaded from the bundle once, later loads are reloads
+        self._loaded = set()
+
+    def find_spec(self, fullname, path=None, target=None):
+        info = self.modules.get(fullname)
+        if info is None:
+            return None
+        spec = importlib.machinery.ModuleSpec(fullname, self,
+                                              origin=info['origin'],
+                                              is_package=info['package'])
+        spec.has_location = True
+        if info['package']:
+            # unbundled files of the package are still found on disk
+            spec.submodule_search_locations = [
+                os.path.dirname(info['origin'])]
+        return spec
+
+    def outdated(self, linking_table=None):
+        """What changed since the bundle was built
+
+        Parameters
+        ----------
+        linking_table : str, optional
+            Linking table in use, by default the one the bundle was built for
+
+        Returns
+        -------
+        list
+            Descriptions of the changes (the linking table, the modules whose
+            source changed), empty if the bundle is current
+        """
+        changes = []
+        recorded = self.index.get('linking_table_hash')
+        table = linking_table or self.index.get('linking_table')
+        if table is not None:
+            try:
+                if _file_hash(table) != recorded:
+                    changes.append(f"linking table {table}")
+            except OSError:
+                changes.append(f"linking table {table} (unreadable)")
+        changes.extend(f"module {name}" for name in _stale(self.modules))
+        return changes
+
+    def is_package(self, fullname):
+        return self.modules[fullname]['package']
+
+    def get_filename(self, fullname):
+        return self.modules[fullname]['origin']
+
+    def get_source(self, fullname):
+        try:
+            with open(self.modules[fullname]['origin'], 'rb') as f:
+                return importlib.util.decode_source(f.read())
+        except OSError:
+            return None
+
+    def get_code(self, fullname):
+        info = self.modules[fullname]
+        with self._lock:
+            reload = fullname in self._loaded
+            self._loaded.add(fullname)
+        if reload:
+            # the source may have been edited since the build
+            return _compile(Path(info['origin']))
+        return marshal.loads(memoryview(self._zip.get_data(info['entry']))[16:])
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+    def invalidate_caches(self):
+        pass
+
+
+def install(bundle):
+    """Import the bundled modules from a bundle
+
+    Parameters
+    ----------
+    bundle : str
+        Path of the bundle
+
+    Returns
+    -------
+    BundleFinder
+        The finder put in sys.meta_path, None if the bundle is missing or was
+        built by another Python version
+    """
+    for finder in sys.meta_path:
+        if isinstance(finder, BundleFinder) and finder.bundle == str(bundle):
+            return finder
+    try:
+        finder = BundleFinder(bundle)
+    except (OSError, KeyError, ValueError, EOFError, zipimport.ZipImportError,
+            BundleError):
+        return None
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def uninstall(finder):
+    """Remove a finder returned by install"""
+    if finder in sys.meta_path:
+        sys.meta_path.remove(finder)
+
+
+_STARTUP = """
+import sys, time
+start = time.perf_counter()
+{setup}
+import ddoitranslatormodule.cli_interface as cli
+tbl = cli.LinkingTable({table!r}, cli.logging.getLogger('bundle'))
+for key in tbl.get_entry_points():
+    cli.get_linked_function(tbl, key, tbl.logger)
+print(time.perf_counter() - start)
+"""
+
+_DIRECT = """
+for location in {path!r}:
+    sys.path.insert(0, location)
+"""
+
+_BUNDLED = """
+sys.path.insert(0, {bundle!r})
+import {boot}
+sys.path.remove({bundle!r})
+assert {boot}.install({bundle!r}) is not None
+"""
+
+
+def benchmark(linking_table, search_path, bundle=None, runs=10):
+    """Time starting a fresh interpreter and importing the CLI and every
+    function of a linking table, from the directories (as inst_script used
+    to) and from a bundle
+
+    Parameters
+    ----------
+    linking_table : str
+        Path to the linking table
+    search_path : list
+        The directories inst_script puts on sys.path
+    bundle : str, optional
+        Bundle to use, by default one is built in a temporary directory
+    runs : int, optional
+        Interpreter starts per layout, by default 10
+
+    Returns
+    -------
+    dict
+        {layout: {'median', 'min', 'max'}} of the seconds from interpreter
+        start to the functions being imported, plus 'import' for the import
+        part alone
+    """
+    import tempfile
+    import subprocess
+    import statistics
+
+    tmp = None
+    if bundle is None:
+        tmp = tempfile.TemporaryDirectory()
+        bundle = os.path.join(tmp.name, 'translator.bundle')
+        build(bundle, linking_table, search_path)
+
+    setups = {'directories': _DIRECT.format(path=list(search_path)),
+              'bundle': _BUNDLED.format(bundle=str(bundle), boot=BOOT_MODULE)}
+    results = {}
+    try:
+        for layout, setup in setups.items():
+            script = _STARTUP.format(setup=setup, table=str(linking_table))
+            totals, imports = [], []
+            for _ in range(runs):
+                start = time.perf_counter()
+                out = subprocess.run([sys.executable, '-c', script],
+                                     capture_output=True, text=True,
+                                     check=True, env=dict(os.environ,
+                                                          PYTHONPATH=''))
+                totals.append(time.perf_counter() - start)
+                imports.append(float(out.stdout.split()[-1]))
+            results[layout] = {'median': statistics.median(totals),
+                               'min': min(totals), 'max': max(totals),
+                               'import': statistics.median(imports)}
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m ddoitranslatormodule.bundle",
+        description="Build, check and benchmark translator start up bundles")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="Write a bundle")
+    p.add_argument("output", help="Path of the bundle")
+    p.add_argument("--table", help="Linking table of the instrument package")
+    p.add_argument("--path", action="append", default=[],
+                   help="Directory the packages are in (repeatable)")
+    p.add_argument("--package", action="append", default=[],
+                   help="Further package to bundle (repeatable)")
+
+    p = sub.add_parser("check", help="List what changed since the build")
+    p.add_argument("bundle")
+    p.add_argument("--table", help="Linking table in use, by default the "
+                   "one the bundle was built for")
+
+    p = sub.add_parser("benchmark", help="Compare start up with and without "
+                       "a bundle")
+    p.add_argument("--table", required=True)
+    p.add_argument("--path", action="append", default=[])
+    p.add_argument("--bundle", help="Existing bundle, by default one is "
+                   "built for the run")
+    p.add_argument("--runs", type=int, default=10)
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        index = build(args.output, args.table, args.path, args.package)
+        print(f"{args.output}: {len(index['modules'])} modules of "
+              f"{', '.join(index['packages'])}")
+    elif args.command == "check":
+        changes = BundleFinder(args.bundle).outdated(args.table)
+        for change in changes:
+            print(change)
+        return 1 if changes else 0
+    elif args.command == "benchmark":
+        results = benchmark(args.table, args.path, args.bundle, args.runs)
+        for layout, times in results.items():
+            print(f"{layout:12s} start up {times['median'] * 1000:7.1f} ms "
+                  f"(min {times['min'] * 1000:.1f}, max "
+                  f"{times['max'] * 1000:.1f}), imports "
+                  f"{times['import'] * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+Checkpoints of OB execution, to resume an interrupted OB.
+
+After every successful execution of a sequence, ``SequenceRunner`` (given a
+``CheckpointStore``) records the OB hash, the sequence number, the function
+and the outcome in a small JSON file per OB.  When the same OB is run again
+with ``resume=True``, the sequences already completed are skipped, provided
+the function's ``verify_completed`` confirms the hardware is still in the
+state they left it in (e.g. still on target after an acquisition).  By
+default it does not, so functions opt in by overriding it:
+
+    store = CheckpointStore()
+    runner = SequenceRunner(Expose, checkpoints=store, resume=True)
+    runner.run(OB)
+
+Files go to ``DDOI_CHECKPOINT_DIR``, or ``ddoi_checkpoints_<user>`` in the
+temporary directory.  Processes running the same OB take turns on its file
+(``flock``) and each write merges with what the others recorded.  Changing
+anything in the OB changes its hash, so an edited OB starts over.  Inspect
+them with:
+
+    python -m ddoitranslatormodule.checkpoint [--clear OB_HASH]
+"""
+
+import os
+import sys
+import json
+import time
+import getpass
+import tempfile
+import threading
+from pathlib import Path
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ddoitranslatormodule.execution_history import args_hash
+
+DONE = 'done'
+FAILED = 'failed'
+
+# Checkpoints not updated for this many days are removed by prune()
+MAX_AGE_DAYS = 7
+
+
+def default_dir():
+    """Directory of the checkpoint files: DDOI_CHECKPOINT_DIR, or
+    ddoi_checkpoints_<user> in the temporary directory, which the users of a
+    host share"""
+    env = os.environ.get('DDOI_CHECKPOINT_DIR')
+    if env:
+        return Path(env)
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = str(os.getuid()) if hasattr(os, 'getuid') else 'unknown'
+    return Path(tempfile.gettempdir()) / f"ddoi_checkpoints_{user}"
+
+
+def ob_hash(OB):
+    """Stable hash of an OB, equal for equal OBs across processes
+
+    Parameters
+    ----------
+    OB : dict
+        Observing Block, in dictionary form
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    return args_hash(OB)
+
+
+def _entry(function, sequence_number):
+    return f"{function}:{sequence_number}"
+
+
+class Checkpoint:
+    """Execution records of one OB, saved to its file on every change
+    """
+
+    def __init__(self, path, ob_hash):
+        self.path = Path(path)
+        self.ob_hash = ob_hash
+        self._lock = threading.Lock()
+        # {"function:sequence": record dict}
+        self.records = {}
+        self.load()
+
+    def _read(self):
+        """The records in the file, none if it is missing or unreadable"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return dict(data.get('records', {}))
+        except (OSError, ValueError, AttributeError, TypeError):
+            return {}
+
+    def load(self):
+        """(Re)read the file, no records if it is missing or unreadable"""
+        records = self._read()
+        with self._lock:
+            self.records = records
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the lock file of the checkpoint, so processes writing the
+        same OB take turns (no locking where fcntl is not available)"""
+        if fcntl is None:
+            yield
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path.with_name(f".{self.path.name}.lock"),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _save(self):
+        """Write the file atomically (caller holds both locks)"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+        with open(tmp, 'w') as f:
+            json.dump({'ob_hash': self.ob_hash, 'updated': time.time(),
+                       'records': self.records}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def record(self, function, sequence_number, outcome, run_id=None,
+               error=None):
+        """Record the outcome of an execution
+
+        Parameters
+        ----------
+        function : str
+            Name of the function
+        sequence_number : int or None
+            The sequence of the OB, None for the OB as a whole
+        outcome : str
+            DONE or FAILED
+        run_id : str, optional
+            Run id of the execution, by default None
+        error : Exception, optional
+            What failed, by default None
+        """
+        record = {'function': function, 'sequence_number': sequence_number,
+                  'outcome': outcome, 'run_id': run_id, 'time': time.time()}
+        if error is not None:
+            record['error'] = f"{type(error).__name__}: {error}"
+        with self._lock, self._file_lock():
+            # other processes may have recorded sequences since we read it
+            self.records = self._read()
+            self.records[_entry(function, sequence_number)] = record
+            self._save()
+
+    def is_done(self, function, sequence_number):
+        """True if the execution completed in an earlier run"""
+        record = self.records.get(_entry(function, sequence_number))
+        return record is not None and record['outcome'] == DONE
+
+    def completed(self, function=None):
+        """Sequence numbers that completed, of one function or all of them
+        """
+        return {record['sequence_number']
+                for record in self.records.values()
+                if record['outcome'] == DONE
+                and (function is None or record['function'] == function)}
+
+    def clear(self):
+        """Forget every record and remove the file, e.g. once the OB is done
+        """
+        with self._lock, self._file_lock():
+            self.records = {}
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __repr__(self):
+        return f"<Checkpoint {self.ob_hash}: {len(self.completed())} " \
+               f"completed>"
+
+
+class CheckpointStore:
+    """The directory of the checkpoint files, one per OB
+    """
+
+    def __init__(self, directory=None):
+        """Use a checkpoint directory
+
+        Parameters
+        ----------
+        directory : str or Path, optional
+            The directory, by default default_dir()
+        """
+        self.directory = Path(directory) if directory else default_dir()
+
+    def open(self, ob_hash):
+        """The checkpoint of an OB hash"""
+        return Checkpoint(self.directory / f"{ob_hash}.json", ob_hash)
+
+    def for_ob(self, OB):
+        """The checkpoint of an OB"""
+        return self.open(ob_hash(OB))
+
+    def list(self):
+        """Every checkpoint in the directory, most recent first"""
+        paths = sorted(self.directory.glob('*.json'),
+                       key=lambda path: path.stat().st_mtime, reverse=True)
+        return [self.open(path.stem) for path in paths]
+
+    def prune(self, max_age_days=MAX_AGE_DAYS):
+        """Remove the checkpoints not updated for max_age_days
+
+        Returns
+        -------
+        int
+            Number of files removed
+        """
+        cutoff = time.time() - max_age_days * 86400
+        removed = 0
+        for path in self.directory.glob('*.json'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="List or clear OB checkpoints")
+    parser.add_argument('--dir', help="checkpoint directory, by default "
+                                      "DDOI_CHECKPOINT_DIR or the temporary "
+                                      "directory")
+    parser.add_argument('--clear', metavar='OB_HASH',
+                        help="remove the checkpoint of an OB")
+    parser.add_argument('--prune', type=float, metavar='DAYS',
+                        help="remove checkpoints older than DAYS")
+    args = parser.parse_args(argv)
+
+    store = CheckpointStore(args.dir)
+    if args.clear:
+        store.open(args.clear).clear()
+        return 0
+    if args.prune is not None:
+        print(f"Removed {store.prune(args.prune)} checkpoints")
+        return 0
+    for checkpoint in store.list():
+        print(checkpoint.ob_hash)
+        for record in checkpoint.records.values():
+            error = f"  {record['error']}" if 'error' in record else ""
+            print(f"    {record['function']:24s} "
+                  f"{str(record['sequence_number']):>6s} "
+                  f"{record['outcome']:6s}{error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
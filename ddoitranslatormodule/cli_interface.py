@@ -9,11 +9,17 @@ from argparse import ArgumentParser, ArgumentError
 from typing import Dict, List, Tuple
 import logging
 from datetime import datetime, timedelta
+from contextlib import nullcontext
 
 import yaml
 
 from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOITranslatorModuleNotFoundException
 from ddoitranslatormodule.BaseFunction import TranslatorModuleFunction
+from ddoitranslatormodule.execution_context import add_observer, remove_observer
+from ddoitranslatormodule.checkpoint import CheckpointStore, DONE, FAILED
+
+# Names of the modules imported through a linking table by get_linked_function
+linked_modules = set()
 
 
 class LinkingTable():
@@ -33,9 +39,19 @@ class LinkingTable():
         """
 
         self.logger = logger
+        self.filename = filename
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        """(Re)load the table from its file
+        """
+        logger = self.logger
+        filename = self.filename
         logger.debug(f"Linking Table: Loading file at {filename}")
 
         try:
+            self.mtime = os.stat(filename).st_mtime_ns
             with open(filename) as f:
                 self.cfg = yaml.load(f, Loader=yaml.FullLoader)
         except:
@@ -46,6 +62,19 @@ class LinkingTable():
         self.links = self.cfg['links']
         logger.debug(f"Linking Table: Loading prefix: {self.prefix}, suffix: {self.suffix}, with {len(self.links)} links.")
 
+    def changed(self) -> bool:
+        """Checks if the file changed since it was loaded
+
+        Returns
+        -------
+        bool
+            True if the file's modification time differs from when loaded
+        """
+        try:
+            return os.stat(self.filename).st_mtime_ns != self.mtime
+        except OSError:
+            return False
+
     def get_entry_points(self) -> List[str]:
         """Gets a list of all the entry points listed in the linking table
 
@@ -167,6 +196,7 @@ def get_linked_function(linking_tbl, key, logger) -> Tuple[TranslatorModuleFunct
     try:
         # Try to import the package from the string in the linking table
         mod = importlib.import_module(module_str)
+        linked_modules.add(module_str)
 
         try:
             return getattr(mod, class_str), default_args, link
@@ -181,6 +211,10 @@ def get_linked_function(linking_tbl, key, logger) -> Tuple[TranslatorModuleFunct
 
 def create_logger():
     log = logging.getLogger('cli_interface')
+    # Already set up by an earlier call in this process, adding the
+    # handlers again would log every message several times
+    if log.handlers:
+        return log
     log.setLevel(logging.DEBUG)
     ## Set up console output
     LogConsoleHandler = logging.StreamHandler()
@@ -208,6 +242,16 @@ def create_logger():
     log.addHandler(LogFileHandler)
     return log
 
+def _log_dir(logger):
+    """Directory of the file the logger writes to, the working directory if
+    it has no file handler
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return Path(handler.baseFilename).parent
+    return Path.cwd()
+
+
 def main(table_loc, args):
 
     #
@@ -219,20 +263,6 @@ def main(table_loc, args):
     invocation = ' '.join(sys.argv)
     logger.debug(f"Invocation: {invocation}")
 
-    #
-    # Build the linking table
-    #
-
-    #table_loc = Path(__file__).parent / "linking_table.yml"
-    table_loc = Path(table_loc)
-    if not table_loc.suffix == ".yml":
-        logger.error("Linking table must be a .yml file! Exiting...")
-        sys.exit(1)
-    if not table_loc.exists():
-        logger.error(f"Failed to find a linking table at {str(table_loc)}. Exiting...")
-        sys.exit(1)
-    linking_tbl = LinkingTable(table_loc, logger)
-
     #
     # Handle command line arguments
     #
@@ -243,11 +273,42 @@ def main(table_loc, args):
     cli_parser.add_argument("-h", "--help", dest="help", action="store_true")
     cli_parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Print extra information")
     cli_parser.add_argument("-f", "--file", dest="file", help="JSON or YAML OB file to add to arguments")
+    cli_parser.add_argument("--profile", dest="profile", action="store_true", help="Profile the table load, module import, argument parsing and each execution phase separately")
+    cli_parser.add_argument("--profile-dir", dest="profile_dir", help="Directory for the --profile pstats files, defaults to the log directory")
+    cli_parser.add_argument("--resume", dest="resume", action="store_true", help="With -f, skip the function if it already completed for the same OB and arguments, once its verify_completed accepts the current hardware state")
+    cli_parser.add_argument("--checkpoint-dir", dest="checkpoint_dir", help="With -f, record the run in a checkpoint in this directory (also done by --resume, in DDOI_CHECKPOINT_DIR or the temporary directory)")
     # cli_parser.add_argument("function_args", nargs="*", help="Function to be executed, and any needed arguments")
     logger.debug("Parsing cli_interface.py arguments...")
     parsed_args, function_args = cli_parser.parse_known_args(args)
     logger.debug("Parsed.")
 
+    profiler = None
+    if parsed_args.profile:
+        from ddoitranslatormodule.profiling import PhaseProfiler
+        profile_dir = parsed_args.profile_dir or _log_dir(logger)
+        profiler = PhaseProfiler(profile_dir, logger)
+        logger.info(f"Profiling, pstats files will be written to {profiler.out_dir}")
+
+    def profiled(stage):
+        if profiler is None:
+            return nullcontext()
+        return profiler.profile(stage)
+
+    #
+    # Build the linking table
+    #
+
+    #table_loc = Path(__file__).parent / "linking_table.yml"
+    table_loc = Path(table_loc)
+    if not table_loc.suffix == ".yml":
+        logger.error("Linking table must be a .yml file! Exiting...")
+        sys.exit(1)
+    if not table_loc.exists():
+        logger.error(f"Failed to find a linking table at {str(table_loc)}. Exiting...")
+        sys.exit(1)
+    with profiled("linking_table"):
+        linking_tbl = LinkingTable(table_loc, logger)
+
     # Handle help:
     if parsed_args.help:
         logger.debug("Printing help...")
@@ -288,8 +349,9 @@ def main(table_loc, args):
 
         # Get the function
         logger.debug(f"Fetching {function_args[0]}...")
-        function, args, mod_str = get_linked_function(
-            linking_tbl, function_args[0], logger)
+        with profiled("import"):
+            function, args, mod_str = get_linked_function(
+                linking_tbl, function_args[0], logger)
         logger.debug(f"Found at {mod_str}")
 
         # Insert required default arguments
@@ -332,20 +394,21 @@ def main(table_loc, args):
         
         # Build an ArgumentParser and attach the function's arguments
         parser = ArgumentParser(add_help=False)
-        logger.debug(f"Adding CLI args to parser")
-        parser = function.add_cmdline_args(parser)
-        logger.debug("Parsing function arguments...")
-        try:
-            # Append these parsed args onto whatever was (or wasn't)
-            # found in the input file (i.e. if -f was used)
-            parsed_func_args.update(vars(parser.parse_args(final_args)))
+        with profiled("parse_args"):
+            logger.debug(f"Adding CLI args to parser")
+            parser = function.add_cmdline_args(parser)
+            logger.debug("Parsing function arguments...")
+            try:
+                # Append these parsed args onto whatever was (or wasn't)
+                # found in the input file (i.e. if -f was used)
+                parsed_func_args.update(vars(parser.parse_args(final_args)))
 
-            logger.debug("Parsed.")
-        except ArgumentError as e:
-            logger.error("Failed to parse arguments!")
-            logger.error(e)
-            logger.error(traceback.format_exc())
-            sys.exit(1)
+                logger.debug("Parsed.")
+            except ArgumentError as e:
+                logger.error("Failed to parse arguments!")
+                logger.error(e)
+                logger.error(traceback.format_exc())
+                sys.exit(1)
 
 
         if parsed_args.dry_run:
@@ -356,7 +419,33 @@ def main(table_loc, args):
             if parsed_args.verbose:
                 print(f"Executing {mod_str} {' '.join(final_args)}")
             logger.debug(f"Executing {mod_str} {' '.join(final_args)}")
-            function.execute(parsed_func_args, logger=logger)
+            # runs of an OB file are checkpointed when asked, so --resume
+            # can skip them
+            checkpoint = None
+            if parsed_args.file and (parsed_args.resume
+                                     or parsed_args.checkpoint_dir):
+                checkpoint = CheckpointStore(
+                    parsed_args.checkpoint_dir).for_ob(parsed_func_args)
+                if parsed_args.resume \
+                        and checkpoint.is_done(function.__name__, None) \
+                        and function.check_completed(parsed_func_args, logger):
+                    logger.info(f"{mod_str} already completed for this OB "
+                                f"({checkpoint.ob_hash}), skipping")
+                    return
+            if profiler is not None:
+                # profiles pre_condition, perform and post_condition
+                add_observer(profiler)
+            try:
+                function.execute(parsed_func_args, logger=logger)
+            except Exception as e:
+                if checkpoint is not None:
+                    checkpoint.record(function.__name__, None, FAILED, error=e)
+                raise
+            finally:
+                if profiler is not None:
+                    remove_observer(profiler)
+            if checkpoint is not None:
+                checkpoint.record(function.__name__, None, DONE)
 
     except DDOITranslatorModuleNotFoundException as e:
         logger.error("Failed to find Translator Module")
@@ -0,0 +1,226 @@
+"""
+Time source of translator functions and the base classes.
+
+Code that waits for hardware (``sleep``), computes timeouts (``utcnow``,
+``monotonic``) or times executions asks this module instead of ``time`` and
+``datetime`` directly:
+
+    from ddoitranslatormodule import clock
+
+    endat = clock.utcnow() + timedelta(seconds=timeout)
+    while clock.utcnow() < endat and not done():
+        clock.sleep(0.5)
+
+By default this is the system clock.  ``set_clock(VirtualClock())``
+replaces it with simulated time, where ``sleep`` returns immediately after
+moving the time forward, running the events scheduled until then (e.g. the
+end of an exposure in ``ktl_sim``) in order.  Paired with the simulated KTL,
+a whole OB runs in seconds while every function sees the durations it would
+see at the telescope.
+"""
+
+import heapq
+import itertools
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+
+class SystemClock:
+    """Real time
+    """
+
+    def time(self):
+        """Seconds since the epoch"""
+        return _time.time()
+
+    def monotonic(self):
+        """Seconds of a clock that never goes back, for durations"""
+        return _time.monotonic()
+
+    def utcnow(self):
+        """Current UT as a naive datetime, like datetime.utcnow()"""
+        return datetime.utcnow()
+
+    def sleep(self, seconds):
+        """Wait seconds"""
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds, from another thread
+
+        Returns
+        -------
+        threading.Timer
+            The timer, which can be cancelled
+        """
+        timer = threading.Timer(max(delay, 0), callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class VirtualClock:
+    """Simulated time that only moves forward when someone sleeps
+
+    A sleep advances the time to its wake up time at once, first running the
+    scheduled events that fall before it.  Threads share one timeline: a
+    thread that sleeps while another is running moves the time for both,
+    which is what a simulation wants from polling loops.
+    """
+
+    def __init__(self, start=None):
+        """Create the clock
+
+        Parameters
+        ----------
+        start : datetime or float, optional
+            UT start time (a naive UT datetime or seconds since the epoch), by
+            default the current time
+        """
+        if start is None:
+            start = _time.time()
+        elif isinstance(start, datetime):
+            start = (start - datetime(1970, 1, 1)).total_seconds()
+        self._start = float(start)
+        self._now = float(start)
+        self._lock = threading.RLock()
+        self._events = []
+        self._counter = itertools.count()
+        self.slept = 0.0
+
+    def time(self):
+        with self._lock:
+            return self._now
+
+    def monotonic(self):
+        with self._lock:
+            return self._now - self._start
+
+    def utcnow(self):
+        return datetime(1970, 1, 1) + timedelta(seconds=self.time())
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) when the simulated time has advanced by delay
+
+        Returns
+        -------
+        list
+            The event, which can be passed to cancel()
+        """
+        with self._lock:
+            event = [self._now + max(delay, 0), next(self._counter),
+                     callback, args]
+            heapq.heappush(self._events, event)
+            return event
+
+    def cancel(self, event):
+        """Cancel a scheduled event"""
+        with self._lock:
+            event[2] = None
+
+    def pending(self):
+        """Number of scheduled events that have not run"""
+        with self._lock:
+            return sum(1 for event in self._events if event[2] is not None)
+
+    def next_event(self):
+        """Simulated time of the next scheduled event, None if none"""
+        with self._lock:
+            for event in sorted(self._events):
+                if event[2] is not None:
+                    return event[0]
+            return None
+
+    def advance(self, seconds):
+        """Move the time forward, running the events that fall due"""
+        with self._lock:
+            target = self._now + max(seconds, 0)
+        while True:
+            with self._lock:
+                if not self._events or self._events[0][0] > target:
+                    self._now = max(self._now, target)
+                    return
+                when, _, callback, args = heapq.heappop(self._events)
+                self._now = max(self._now, when)
+            if callback is not None:
+                callback(*args)
+
+    def run_until_idle(self, limit=None):
+        """Run every scheduled event (including the ones they schedule)
+
+        Parameters
+        ----------
+        limit : float, optional
+            Seconds of simulated time to run at most, by default no limit
+        """
+        end = None if limit is None else self.time() + limit
+        while True:
+            when = self.next_event()
+            if when is None or (end is not None and when > end):
+                break
+            self.advance(when - self.time())
+        if end is not None:
+            self.advance(end - self.time())
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.slept += max(seconds, 0)
+        self.advance(seconds)
+
+
+_clock = SystemClock()
+
+
+def current():
+    """The clock in use"""
+    return _clock
+
+
+def set_clock(clock):
+    """Use another clock (e.g. a VirtualClock) everywhere
+
+    Parameters
+    ----------
+    clock : SystemClock or VirtualClock
+        The new clock
+
+    Returns
+    -------
+    The previous clock
+    """
+    global _clock
+    previous = _clock
+    _clock = clock
+    return previous
+
+
+def is_virtual():
+    """True if simulated time is in use"""
+    return isinstance(_clock, VirtualClock)
+
+
+def time():
+    """Seconds since the epoch, on the current clock"""
+    return _clock.time()
+
+
+def monotonic():
+    """Seconds of a never decreasing clock, on the current clock"""
+    return _clock.monotonic()
+
+
+def utcnow():
+    """Current UT as a naive datetime, on the current clock"""
+    return _clock.utcnow()
+
+
+def sleep(seconds):
+    """Wait seconds, on the current clock"""
+    _clock.sleep(seconds)
+
+
+def schedule(delay, callback, *args):
+    """Call callback(*args) after delay seconds, on the current clock"""
+    return _clock.schedule(delay, callback, *args)
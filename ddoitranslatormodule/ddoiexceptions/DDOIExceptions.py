@@ -95,3 +95,78 @@ class DDOIDetectorAngleUndefined(Exception):
 
 class DDOITranslatorModuleNotFoundException(Exception):
     pass
+
+class DDOIExecutionCancelled(Exception):
+    pass
+
+
+class DDOIPhaseTimeout(Exception):
+    def __init__(self, function_name, phase, limit, overrun):
+        self.function_name = function_name
+        self.phase = phase
+        self.limit = limit
+        self.overrun = overrun
+        self.message = f"{function_name} {phase} exceeded its deadline of " \
+                       f"{limit:.1f} s (overran by {overrun:.2f} s)"
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+class DDOIResourceLockTimeout(Exception):
+    def __init__(self, resource, holder):
+        self.resource = resource
+        self.holder = holder
+        self.message = f"Timed out waiting for the lock of {resource}, " \
+                       f"held by {holder}"
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+class DDOIServiceUnavailable(Exception):
+    def __init__(self, service, retry_in, last_error=None):
+        self.service = service
+        self.retry_in = retry_in
+        self.last_error = last_error
+        self.message = f"KTL service {service} is unavailable (circuit " \
+                       f"open after repeated failures, next trial in " \
+                       f"{retry_in:.1f} s). Last error: {last_error}"
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+class DDOIResourceGrowth(Exception):
+    def __init__(self, function_name, executions, exceeded):
+        self.function_name = function_name
+        self.executions = executions
+        self.exceeded = exceeded
+        growth = ", ".join(f"{resource} {value:+.1f}"
+                           for resource, value in exceeded.items())
+        self.message = f"Resources kept growing over {executions} " \
+                       f"executions of {function_name}: {growth}"
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
+
+
+class DDOIOffsetLimitExceeded(Exception):
+    def __init__(self, pattern, positions, violations):
+        self.pattern = pattern
+        self.positions = positions
+        self.violations = violations
+        listed = "; ".join(f"#{index} ({x:.2f}, {y:.2f}): {reason}"
+                           for index, (x, y), reason in violations[:5])
+        more = f" and {len(violations) - 5} more" \
+            if len(violations) > 5 else ""
+        self.message = f"Offset pattern {pattern} ({positions} positions) " \
+                       f"exceeds the limits: {listed}{more}"
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
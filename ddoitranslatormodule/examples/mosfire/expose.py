@@ -1,28 +1,44 @@
 from ddoitranslatormodule.BaseFunction import TranslatorModuleFunction
 
-from ddoitranslatormodule.DDOIExceptions import *
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import *
+from ddoitranslatormodule import clock, ktl_access
+from pathlib import Path
+import math
 import re
-from time import sleep
 
-import numpy as np
+class Expose(TranslatorModuleFunction):
 
-import ktl
+    # The FCS checks only read status, so they can run during the readout of
+    # the previous exposure
+    overlap_phases = ('pre_condition',)
 
-class Expose(TranslatorModuleFunction):
+    # Sequences after the first only write the detector settings that changed
+    apply_delta = True
+
+    # If True, detector settings the detector already has are not written
+    # again.  The "enabled" option of the [write_elision] config section
+    # takes precedence.
+    elide_writes = False
+
+    writes_keywords = (('mds', 'ITIME'), ('mds', 'COADDS'),
+                       ('mds', 'SAMPMODE'), ('mds', 'NUMREADS'),
+                       ('mds', 'OBJECT'), ('mds', 'GO'), ('mfcs', 'PA_EL'))
 
     def __init__(self):
         super().__init__()
 
+    def _cfg_location(cls, args):
+        return [str(Path(__file__).parent / 'mosfire.cfg')]
+
     @classmethod
     def pre_condition(cls, args, logger, cfg):
         # Check FCS
-        activekw = ktl.cache(keyword='ACTIVE', service='mfcs')
-        active = bool(activekw.read())
+        status = cls.read_many([('mfcs', 'ACTIVE'), ('mfcs', 'ENABLE')])
+        active = bool(int(status['mfcs', 'ACTIVE']))
         if active is not True:
             logger.warn(f'FCS is not active')
             return False
-        enabledkw = ktl.cache(keyword='ENABLE', service='mfcs')
-        enabled = bool(enabledkw.read())
+        enabled = bool(int(status['mfcs', 'ENABLE']))
         if enabled is not True:
             logger.warn(f'FCS is not enabled')
             return False
@@ -32,70 +48,117 @@ class Expose(TranslatorModuleFunction):
     @classmethod
     def perform(cls, args, logger, cfg):
         
-        # Set the exposure time
-        ITIMEkw = ktl.cache(service='mds', keyword='ITIME')
-        new_exptime = float(args.exptime)*1000
-        logger.debug(f'Setting exposure time to {new_exptime:.1f} ms')
-        ITIMEkw.write(new_exptime)
-
-        # Set coadds
-        COADDSkw = ktl.cache(service='mds', keyword='COADDS')
-        logger.debug(f'Setting coadds to {int(args.coadds)}')
-        COADDSkw.write(int(input))
-    
-        # Set sampling
-        
-        namematch = re.match('(M?CDS)(\d*)', input.strip())
-        if namematch is None:
-            raise DDOIMissingArgumentException(f'Unable to parse "{args.sampmode}"')
-        mode = {'CDS': 2, 'MCDS': 3}.get(namematch.group(1))
-
-        SAMPMODEkw = ktl.cache(service='mds', keyword='SAMPMODE')
-        NUMREADSkw = ktl.cache(service='mds', keyword='NUMREADS')
-        SAMPMODEkw.write(mode)
-        if mode == 3:
-            nreads = int(namematch.group(2))
-            NUMREADSkw.write(nreads)
-        
-        # Set Object
-        objectkw = ktl.cache(service='mds', keyword='OBJECT')
-        objectkw.write(args.object)
+        # Detector settings are often unchanged between exposures, so
+        # writes of values that are already set can be skipped (elided)
+        cls._set_detector(args, logger, cfg)
+
+        if not cls._update_fcs(args, logger, cfg):
+            logger.warn("Unable to update FCS. Exiting")
+            return
+
+        cls._go(logger)
+        return
+
+    @classmethod
+    def perform_delta(cls, args, delta, logger, cfg):
+        # The previous sequence set up the detector, so only the settings
+        # that changed are written.  The FCS follows the telescope, which
+        # moves between sequences, so it is always updated.
+        names = [name for name in cls.detector_settings if name in delta]
+        if names:
+            cls._set_detector(args, logger, cfg, names)
+        else:
+            logger.debug('Detector settings unchanged')
+
+        if not cls._update_fcs(args, logger, cfg):
+            logger.warn("Unable to update FCS. Exiting")
+            return
+
+        cls._go(logger)
+        return
 
-        # Update FCS
+    # Arguments setting the detector, in the order they are written
+    detector_settings = ('exptime', 'coadds', 'sampmode', 'object')
 
-        ROTPPOSNkw = ktl.cache(keyword='ROTPPOSN', service='dcs')
-        ROTPPOSN = float(ROTPPOSNkw.read())
-        ELkw = ktl.cache(keyword='EL', service='dcs')
-        EL = float(ELkw.read())
+    @classmethod
+    def _elide(cls, cfg):
+        """True if writes of values that are already set are skipped"""
+        return ktl_access.elision_enabled(cfg, cls.elide_writes)
 
-        FCPA_ELkw = ktl.cache(keyword='PA_EL', service='mfcs')
-        FCPA_ELkw.write(f"{ROTPPOSN:.2f} {EL:.2f}")
+    @classmethod
+    def _set_detector(cls, args, logger, cfg, names=detector_settings):
+        """Write the detector settings of the named arguments"""
+        elide = cls._elide(cfg)
+        if 'exptime' in names:
+            # Set the exposure time
+            new_exptime = float(args['exptime'])*1000
+            logger.debug(f'Setting exposure time to {new_exptime:.1f} ms')
+            ktl_access.write('mds', 'ITIME', new_exptime, elide=elide,
+                             logger=logger)
+
+        if 'coadds' in names:
+            # Set coadds
+            coadds = int(args.get('coadds', 1))
+            logger.debug(f'Setting coadds to {coadds}')
+            ktl_access.write('mds', 'COADDS', coadds, elide=elide,
+                             logger=logger)
+    
+        if 'sampmode' in names:
+            # Set sampling
+            sampmode = str(args.get('sampmode', 'CDS'))
+            namematch = re.match('(M?CDS)(\d*)', sampmode.strip())
+            if namematch is None:
+                raise DDOIMissingArgumentException(
+                    f'Unable to parse "{sampmode}"')
+            mode = {'CDS': 2, 'MCDS': 3}.get(namematch.group(1))
+
+            ktl_access.write('mds', 'SAMPMODE', mode, elide=elide,
+                             logger=logger)
+            if mode == 3:
+                nreads = int(namematch.group(2))
+                ktl_access.write('mds', 'NUMREADS', nreads, elide=elide,
+                                 logger=logger)
+        
+        if 'object' in names:
+            # Set Object
+            ktl_access.write('mds', 'OBJECT', args.get('object', ''),
+                             elide=elide, logger=logger)
 
-        FCPA_ELkw = ktl.cache(keyword='PA_EL', service='mfcs')
-        FCPA_EL = FCPA_ELkw.read()
+    @classmethod
+    def _update_fcs(cls, args, logger, cfg):
+        """Point the FCS at the current telescope position, True once it
+        is there"""
+        pa_threshold = float(args.get('PAthreshold',
+                                      cfg['expose']['PAthreshold']))
+        el_threshold = float(args.get('ELthreshold',
+                                      cfg['expose']['ELthreshold']))
+
+        telescope = cls.read_many([('dcs', 'ROTPPOSN'), ('dcs', 'EL')])
+        ROTPPOSN = float(telescope['dcs', 'ROTPPOSN'])
+        EL = float(telescope['dcs', 'EL'])
+
+        ktl_access.write('mfcs', 'PA_EL', f"{ROTPPOSN:.2f} {EL:.2f}")
+
+        # FCS and telescope positions from the same moment
+        status = cls.read_many([('mfcs', 'PA_EL'), ('dcs', 'ROTPPOSN'),
+                                ('dcs', 'EL')])
+        FCPA_EL = status['mfcs', 'PA_EL']
         FCSPA = float(FCPA_EL.split()[0])
         FCSEL = float(FCPA_EL.split()[1])
         
-        ROTPPOSNkw = ktl.cache(keyword='ROTPPOSN', service='dcs')
-        ROTPPOSN = float(ROTPPOSNkw.read())
-        ELkw = ktl.cache(keyword='EL', service='dcs')
-        EL = float(ELkw.read())
-        done = np.isclose(FCSPA, ROTPPOSN, atol=args.PAthreshold)\
-            and np.isclose(FCSEL, EL, atol=args.ELthreshold)
-        
-        if not done:
-            logger.warn("Unable to update FCS. Exiting")
-            return
-        
+        ROTPPOSN = float(status['dcs', 'ROTPPOSN'])
+        EL = float(status['dcs', 'EL'])
+        return math.isclose(FCSPA, ROTPPOSN, abs_tol=pa_threshold)\
+            and math.isclose(FCSEL, EL, abs_tol=el_threshold)
+
+    @classmethod
+    def _go(cls, logger):
         # Pad time to ensure proper execution
-        sleep(1)
+        clock.sleep(1)
 
         # Expose!
-        GOkw = ktl.cache(service='mds', keyword='GO')
         logger.info('Starting exposure')
-        GOkw.write(True)
-
-        return
+        ktl_access.write('mds', 'GO', True)
 
     @classmethod
     def post_condition(cls, args, logger, cfg):
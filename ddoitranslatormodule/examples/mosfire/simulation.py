@@ -0,0 +1,113 @@
+"""
+Simulated MOSFIRE for running Expose and MOSFIRE_WaitForExpose offline.
+
+    python -m ddoitranslatormodule.examples.mosfire.simulation
+
+runs a whole OB through SequenceRunner against the simulated services, in
+simulated time, and prints how long it would have taken at the telescope.
+"""
+
+import sys
+import time
+import logging
+import configparser
+
+from ddoitranslatormodule import clock, ktl_sim
+from ddoitranslatormodule.sequence_runner import SequenceRunner
+from ddoitranslatormodule.examples.mosfire.expose import Expose
+from ddoitranslatormodule.examples.mosfire.waitfor_expose import MOSFIRE_WaitForExpose
+
+# Seconds to read out the detector after the last coadd
+READOUT_TIME = 3.0
+
+# Seconds MOSFIRE_WaitForExpose waits for an exposure, mosfire.cfg allows
+# only the readout of short exposures
+WAIT_TIMEOUT = 600
+
+
+def mosfire_model(sim, readout_time=READOUT_TIME):
+    """Define the mds, mfcs and dcs keywords used by the MOSFIRE example
+    functions, and the exposure behaviour of GO
+
+    Parameters
+    ----------
+    sim : ktl_sim.SimulatedKTL
+        The simulator
+    readout_time : float, optional
+        Seconds from the end of the last coadd until READY, by default
+        READOUT_TIME
+
+    Returns
+    -------
+    ktl_sim.SimulatedKTL
+        sim
+    """
+    sim.define('mds', {'ITIME': 1000.0, 'COADDS': 1, 'SAMPMODE': 2,
+                       'NUMREADS': 1, 'OBJECT': '', 'GO': 0, 'IMAGEDONE': 1,
+                       'READY': 1})
+    sim.define('mfcs', {'ACTIVE': 1, 'ENABLE': 1, 'PA_EL': '0.00 45.00'})
+    sim.define('dcs', {'ROTPPOSN': 0.0, 'EL': 45.0})
+
+    def go(sim, value):
+        if not value:
+            return
+        duration = float(sim.get('mds', 'ITIME')) / 1000 \
+            * int(sim.get('mds', 'COADDS'))
+        sim.set('mds', 'IMAGEDONE', 0)
+        sim.set('mds', 'READY', 0)
+        sim.set_later(duration, 'mds', 'IMAGEDONE', 1)
+        sim.set_later(duration + readout_time, 'mds', 'READY', 1)
+        sim.set_later(duration + readout_time, 'mds', 'GO', 0)
+
+    sim.on_write('mds', 'GO', go)
+    return sim
+
+
+def example_ob(n_sequences=5, exptime=120, coadds=2):
+    """An OB of n_sequences exposures of the same target"""
+    return {
+        'target': {'parameters': {'object': 'NGC 1068'}},
+        'observations': [
+            {'metadata': {'sequence_number': num},
+             'parameters': {'exptime': exptime, 'coadds': coadds,
+                            'sampmode': 'MCDS16'}}
+            for num in range(n_sequences)
+        ],
+    }
+
+
+def run_ob(OB, logger=None, overlap=True):
+    """Run every sequence of an OB with Expose against the simulated
+    instrument, in simulated time
+
+    Returns
+    -------
+    Tuple[SequenceReport, float, float, ktl_sim.SimulatedKTL]
+        The runner's report, the simulated and the real seconds it took, and
+        the simulator
+    """
+    sim = mosfire_model(ktl_sim.install())
+    try:
+        real_start = time.perf_counter()
+        sim_start = clock.monotonic()
+        wait_cfg = configparser.ConfigParser()
+        wait_cfg.read_dict({'waitfor_expose': {'timeout': str(WAIT_TIMEOUT)}})
+        runner = SequenceRunner(Expose, wait_function=MOSFIRE_WaitForExpose,
+                                logger=logger, wait_cfg=wait_cfg,
+                                overlap=overlap)
+        report = runner.run(OB)
+        simulated = clock.monotonic() - sim_start
+        real = time.perf_counter() - real_start
+    finally:
+        ktl_sim.uninstall()
+    return report, simulated, real, sim
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    report, simulated, real, sim = run_ob(example_ob())
+    print(report.summary())
+    print(f"{len(report.sequences)} sequences: {simulated:.0f} s simulated "
+          f"in {real:.2f} s, {sim.write_count('mds', 'GO')} exposures, "
+          f"{len(sim.writes)} writes, {sim.reads} reads")
+    sys.exit(0)
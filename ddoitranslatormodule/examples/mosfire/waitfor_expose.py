@@ -1,34 +1,37 @@
 #! /kroot/rel/default/bin/kpython
 
-from time import sleep
-from datetime import datetime, timedelta
+from datetime import timedelta
+from pathlib import Path
 from ddoitranslatormodule.BaseFunction import TranslatorModuleFunction
-from ddoitranslatormodule.DDOIExceptions import *
-
-import ktl
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import *
+from ddoitranslatormodule import clock
 
 class MOSFIRE_WaitForExpose(TranslatorModuleFunction):
 
+    def _cfg_location(cls, args):
+        return [str(Path(__file__).parent / 'mosfire.cfg')]
+
     @classmethod
     def pre_condition(cls, args, logger, cfg):
         logger.info("No precondition")
 
     @classmethod
     def perform(cls, args, logger, cfg):
-        timeout = cfg['waitfor_expose']['timeout']
-        endat = datetime.utcnow() + timedelta(seconds=timeout)
+        timeout = float(cfg['waitfor_expose']['timeout'])
+        endat = clock.utcnow() + timedelta(seconds=timeout)
         logger.debug(f"Timeout is set to {timeout} seconds, timeout at {endat}")
-        sleep(1)
-        IMAGEDONEkw = ktl.cache(service='mds', keyword='IMAGEDONE')
-        READYkw = ktl.cache(service='mds', keyword='READY')
+        clock.sleep(1)
 
-        imagedone = bool(int(IMAGEDONEkw.read()))
-        mdsready = bool(int(READYkw.read()))
+        keywords = [('mds', 'IMAGEDONE'), ('mds', 'READY')]
+        status = cls.read_many(keywords)
+        imagedone = bool(int(status['mds', 'IMAGEDONE']))
+        mdsready = bool(int(status['mds', 'READY']))
         done_and_ready = imagedone and mdsready
-        while datetime.utcnow() < endat and not done_and_ready:
-            sleep(0.5)
-            imagedone = bool(int(IMAGEDONEkw.read()))
-            mdsready = bool(int(READYkw.read()))
+        while clock.utcnow() < endat and not done_and_ready:
+            clock.sleep(0.5)
+            status = cls.read_many(keywords)
+            imagedone = bool(int(status['mds', 'IMAGEDONE']))
+            mdsready = bool(int(status['mds', 'READY']))
             done_and_ready = imagedone and mdsready
         if not done_and_ready:
             raise DDOIKTLTimeoutException('Timeout exceeded on waitfor_exposure to finish')
@@ -0,0 +1,429 @@
+"""
+Per-run execution state for translator module functions.
+
+Every call to ``TranslatorModuleFunction.execute`` creates one
+``ExecutionContext``.  The context identifies the run (``run_id``), carries
+its deadline and cancellation state, the configuration that was loaded for
+it, a timing recorder and a logger adapter that tags every message with the
+function name and run id.  Several executions may be in flight at once (in
+threads, a daemon or a scheduler); each one sees only its own context through
+``current_context()``.
+
+Translator functions do not need to know about the context: the logger they
+receive is the context's adapter and behaves like the logger that was passed
+to ``execute``.
+
+Observers registered with ``add_observer`` are told when executions start,
+when each phase starts and ends, and when executions finish.  An observer is
+any object with some of the methods::
+
+    on_start(ctx)
+    on_phase_start(ctx, phase)
+    on_phase_end(ctx, phase, error)
+    on_finish(ctx, error)
+
+where ``error`` is the exception raised, or None.
+"""
+
+import logging
+import threading
+import time
+import uuid
+import contextvars
+from contextlib import contextmanager
+
+from ddoitranslatormodule import clock
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIExecutionCancelled
+
+_current = contextvars.ContextVar('ddoi_execution_context', default=None)
+
+_active = {}
+_active_lock = threading.Lock()
+# Notified whenever an execution exits; new executions wait while
+# _exclusive is set (see exclusive())
+_active_changed = threading.Condition(_active_lock)
+_exclusive = False
+
+_observers = ()
+_observers_lock = threading.Lock()
+
+
+def add_observer(observer):
+    """Register an object to be notified of execution events
+
+    Parameters
+    ----------
+    observer : object
+        Object with any of on_start, on_phase_start, on_phase_end, on_finish,
+        and on_worker_start/on_worker_end, notified from the worker thread
+        that runs a phase with a deadline (before and after the phase)
+    """
+    global _observers
+    with _observers_lock:
+        if observer not in _observers:
+            _observers = _observers + (observer,)
+
+
+def remove_observer(observer):
+    """Stop notifying an observer registered with add_observer"""
+    global _observers
+    with _observers_lock:
+        _observers = tuple(obs for obs in _observers if obs is not observer)
+
+
+def notify(event, *args):
+    """Call the event method of every observer.  Failing observers are logged
+    and never interrupt the execution.
+
+    Parameters
+    ----------
+    event : str
+        on_start, on_phase_start, on_phase_end, on_finish, on_worker_start
+        or on_worker_end
+    """
+    for observer in _observers:
+        method = getattr(observer, event, None)
+        if method is None:
+            continue
+        try:
+            method(*args)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                f"Execution observer {observer!r} failed in {event}")
+
+
+def current_context():
+    """Return the ExecutionContext of the run active in this thread/context
+
+    Returns
+    -------
+    ExecutionContext or None
+        The innermost running context, None if not inside execute()
+    """
+    return _current.get()
+
+
+def active_contexts(function=None):
+    """List the contexts of every execution currently in flight
+
+    Parameters
+    ----------
+    function : class, optional
+        Only return contexts for this translator function, by default None
+
+    Returns
+    -------
+    list
+        The active ExecutionContext instances
+    """
+    with _active_lock:
+        contexts = list(_active.values())
+    if function is None:
+        return contexts
+    return [ctx for ctx in contexts if ctx.function is function]
+
+
+@contextmanager
+def exclusive(timeout=None):
+    """Wait until no execution is in flight and keep new ones from starting
+    inside the block (e.g. while translator modules are reloaded).  Must not
+    be used from inside an execution.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Seconds to wait for running executions to finish, by default forever
+
+    Yields
+    ------
+    bool
+        True if exclusive access was obtained, False on timeout (the block
+        then runs without it and should do nothing)
+    """
+    global _exclusive
+    with _active_changed:
+        acquired = _active_changed.wait_for(
+            lambda: not _active and not _exclusive, timeout)
+        if acquired:
+            _exclusive = True
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with _active_changed:
+                _exclusive = False
+                _active_changed.notify_all()
+
+
+def get_context(run_id):
+    """Look up an in-flight execution by its run id
+
+    Parameters
+    ----------
+    run_id : str
+        The run id of the execution
+
+    Returns
+    -------
+    ExecutionContext or None
+        The matching context, None if no such run is active
+    """
+    with _active_lock:
+        return _active.get(run_id)
+
+
+class TimingRecorder:
+    """Thread safe accumulator of named durations (seconds)
+    """
+    __slots__ = ('_lock', '_durations')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+
+    def record(self, name, duration):
+        """Add a duration to the named timer
+
+        Parameters
+        ----------
+        name : str
+            Name of the timer, e.g. "perform"
+        duration : float
+            Duration in seconds
+        """
+        with self._lock:
+            self._durations[name] = self._durations.get(name, 0.0) + duration
+
+    @contextmanager
+    def time(self, name):
+        """Context manager recording the time spent inside the block
+        """
+        start = clock.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, clock.monotonic() - start)
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._durations.get(name, default)
+
+    def as_dict(self):
+        """Return a copy of all recorded durations
+
+        Returns
+        -------
+        dict
+            {timer name: total seconds}
+        """
+        with self._lock:
+            return dict(self._durations)
+
+
+class ContextLoggerAdapter:
+    """Wraps a logger (logging.Logger or DDOILoggerClient) and prefixes every
+    message with the function name and run id of the execution.
+    """
+    __slots__ = ('logger', 'prefix')
+
+    def __init__(self, logger, prefix):
+        # Never stack adapters when execute() calls are nested
+        while isinstance(logger, ContextLoggerAdapter):
+            logger = logger.logger
+        self.logger = logger
+        self.prefix = prefix
+
+    def _log(self, method, msg, *args, **kwargs):
+        getattr(self.logger, method)(f"{self.prefix} {msg}", *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log('debug', msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._log('info', msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self._log('warning', msg, *args, **kwargs)
+
+    def warn(self, msg, *args, **kwargs):
+        self._log('warning', msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self._log('error', msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self._log('critical', msg, *args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        self._log('exception', msg, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+class ExecutionContext:
+    """State of a single execute() call.
+
+    Use as a context manager: entering makes it the current context and
+    registers it as active, exiting restores the previous context.  Nested
+    execute() calls get the enclosing context as ``parent``, inherit its
+    deadline when it is sooner, and are cancelled along with it.
+    """
+    __slots__ = ('run_id', 'function', 'parent', 'args', 'initial_args',
+                 'cfg', 'logger', 'timeout', 'deadline', 'phase_timeouts',
+                 'start_time', 'timings', 'locks', 'delta', '_cancel_event',
+                 '_cancel_reason', '_token')
+
+    def __init__(self, function, args, logger, cfg=None, timeout=None,
+                 parent=None, phase_timeouts=None):
+        """Create the context for one execution
+
+        Parameters
+        ----------
+        function : class
+            The TranslatorModuleFunction being executed
+        args : dict
+            The arguments of this execution
+        logger : logging.Logger or DDOILoggerClient
+            The logger passed to execute()
+        cfg : configparser.ConfigParser, optional
+            The loaded configuration, by default None
+        timeout : float, optional
+            Seconds allowed for the whole execution, by default None
+        parent : ExecutionContext, optional
+            Enclosing execution, by default the current context
+        phase_timeouts : dict, optional
+            {phase: seconds} allowed for each phase, by default None
+        """
+        if parent is None:
+            parent = current_context()
+        self.run_id = uuid.uuid4().hex[:12]
+        self.function = function
+        self.parent = parent
+        self.args = args
+        self.initial_args = None
+        self.cfg = cfg
+        self.logger = ContextLoggerAdapter(
+            logger, f"[{function.__name__} {self.run_id}]")
+        self.start_time = clock.monotonic()
+        self.set_timeout(timeout)
+        self.phase_timeouts = dict(phase_timeouts or {})
+        self.timings = TimingRecorder()
+        # Keyword locks held (see resource_locks), None until taken
+        self.locks = None
+        # Arguments changed since the previous sequence of the OB, set by
+        # SequenceRunner for functions with apply_delta (see sequence_diff)
+        self.delta = None
+        self._cancel_event = threading.Event()
+        self._cancel_reason = None
+        self._token = None
+
+    def __enter__(self):
+        with _active_changed:
+            # Nested executions run inside one that is already active
+            if self.parent is None:
+                _active_changed.wait_for(lambda: not _exclusive)
+            _active[self.run_id] = self
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with _active_changed:
+            _active.pop(self.run_id, None)
+            _active_changed.notify_all()
+        _current.reset(self._token)
+        self._token = None
+        return False
+
+    def __repr__(self):
+        return f"<ExecutionContext {self.function.__name__} {self.run_id}>"
+
+    @property
+    def name(self):
+        return self.function.__name__
+
+    @property
+    def elapsed(self):
+        """Seconds since the context was created"""
+        return clock.monotonic() - self.start_time
+
+    def set_timeout(self, timeout):
+        """Set the seconds allowed for the whole execution (from its start);
+        the deadline stays the parent's when that one is sooner
+
+        Parameters
+        ----------
+        timeout : float or None
+            Seconds, None for no limit of its own
+        """
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = self.start_time + timeout
+        parent = self.parent
+        if parent is not None and parent.deadline is not None:
+            if self.deadline is None or parent.deadline < self.deadline:
+                self.deadline = parent.deadline
+
+    def remaining(self):
+        """Seconds left before the deadline, None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return self.deadline - clock.monotonic()
+
+    def expired(self):
+        """True if a deadline is set and has passed"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self, reason=None):
+        """Request cancellation of this execution (and any nested ones).
+        Safe to call from any thread.
+
+        Parameters
+        ----------
+        reason : str, optional
+            Why the execution was cancelled, by default None
+        """
+        if not self._cancel_event.is_set():
+            self._cancel_reason = reason
+            self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        if self._cancel_event.is_set():
+            return True
+        return self.parent is not None and self.parent.cancelled
+
+    @property
+    def cancel_reason(self):
+        if self._cancel_event.is_set():
+            return self._cancel_reason
+        if self.parent is not None:
+            return self.parent.cancel_reason
+        return None
+
+    def check_cancelled(self):
+        """Raise DDOIExecutionCancelled if cancellation was requested
+        """
+        if self.cancelled:
+            raise DDOIExecutionCancelled(
+                f"{self.name} ({self.run_id}) cancelled: {self.cancel_reason}")
+
+    def wait_cancelled(self, timeout=None):
+        """Block until cancelled or timeout seconds pass.
+
+        Returns
+        -------
+        bool
+            True if the execution was cancelled
+        """
+        if self.parent is None:
+            return self._cancel_event.wait(timeout)
+        end = None if timeout is None else time.monotonic() + timeout
+        while not self.cancelled:
+            step = 0.1 if end is None else min(0.1, end - time.monotonic())
+            if step <= 0:
+                break
+            self._cancel_event.wait(step)
+        return self.cancelled
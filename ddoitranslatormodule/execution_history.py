@@ -0,0 +1,522 @@
+"""
+Structured history of translator function executions in a local SQLite file.
+
+Every ``execute()`` outcome becomes one row: the entry point (module.Class),
+a hash of its arguments, the duration of each phase, the exception type if it
+failed, the host and the start time.  Rows are queued by an execution
+observer and written in batches by a background thread, so recording costs an
+execution one ``queue.put``.
+
+Enable it with:
+
+    from ddoitranslatormodule import execution_history
+    execution_history.enable('/path/to/history.db')
+
+or set ``DDOI_HISTORY_DB`` in the environment before the base class is
+imported.  Query it from Python with ``ExecutionHistory`` or from the shell:
+
+    python -m ddoitranslatormodule.execution_history history.db \\
+        --since 7d --function expose
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import atexit
+import sqlite3
+import hashlib
+import logging
+import threading
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+
+from ddoitranslatormodule.execution_context import add_observer, remove_observer
+
+logger = logging.getLogger(__name__)
+
+# The active HistoryRecorder, None when recording is disabled
+recorder = None
+
+PHASES = ('pre_condition', 'perform', 'post_condition')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS executions (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT,
+    parent_run_id TEXT,
+    entry_point TEXT NOT NULL,
+    args_hash TEXT,
+    host TEXT,
+    pid INTEGER,
+    start_time REAL NOT NULL,
+    duration REAL,
+    load_config REAL,
+    pre_condition REAL,
+    perform REAL,
+    post_condition REAL,
+    timings TEXT,
+    success INTEGER NOT NULL,
+    exception TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS executions_entry_time
+    ON executions (entry_point, start_time);
+CREATE INDEX IF NOT EXISTS executions_time ON executions (start_time);
+"""
+
+_COLUMNS = ('run_id', 'parent_run_id', 'entry_point', 'args_hash', 'host',
+            'pid', 'start_time', 'duration', 'load_config', 'pre_condition',
+            'perform', 'post_condition', 'timings', 'success', 'exception',
+            'message')
+
+_INSERT = f"INSERT INTO executions ({', '.join(_COLUMNS)}) " \
+          f"VALUES ({', '.join('?' * len(_COLUMNS))})"
+
+
+def connect(path):
+    """Open (creating if needed) a history database
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def args_hash(args):
+    """Stable hash of an argument dict (or Namespace), equal for equal
+    arguments across processes and hosts
+
+    Parameters
+    ----------
+    args : dict or Namespace
+        The arguments
+
+    Returns
+    -------
+    str or None
+        Hex digest, None if args is None
+    """
+    if args is None:
+        return None
+    if isinstance(args, Namespace):
+        args = vars(args)
+    text = json.dumps(dict(args), sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class HistoryRecorder:
+    """Execution observer writing one row per execution to the history
+    database from a background thread
+    """
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0,
+                 max_queue=100000):
+        """Start the recorder
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite file
+        batch_size : int, optional
+            Rows written per transaction at most, by default 200
+        flush_interval : float, optional
+            Seconds a row can wait before it is written, by default 1.0
+        max_queue : int, optional
+            Rows held in memory before new ones are dropped, by default 100000
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(max_queue)
+        # connect here so that a bad path fails on enable()
+        connect(path).close()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="execution-history")
+        self._thread.start()
+
+    # Execution observer interface
+
+    def on_finish(self, ctx, error):
+        args = ctx.initial_args if ctx.initial_args is not None else ctx.args
+        item = (ctx.run_id, ctx.parent.run_id if ctx.parent else None,
+                f"{ctx.function.__module__}.{ctx.function.__qualname__}",
+                args, time.time() - ctx.elapsed, ctx.elapsed,
+                ctx.timings.as_dict(), error)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _row(self, item):
+        run_id, parent_id, entry_point, args, start, duration, timings, \
+            error = item
+        try:
+            digest = args_hash(args)
+        except Exception:
+            digest = None
+        return (run_id, parent_id, entry_point, digest, self.host, self.pid,
+                start, duration, timings.get('load_config'),
+                *(timings.get(phase) for phase in PHASES),
+                json.dumps(timings), int(error is None),
+                type(error).__name__ if error is not None else None,
+                str(error)[:1000] if error is not None else None)
+
+    def _run(self):
+        conn = connect(self.path)
+        stop = False
+        while not stop:
+            batch = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                else:
+                    # executions, and flush() events set once written
+                    batch.append(item)
+                if stop or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            self._write(conn, batch)
+        conn.close()
+
+    def _write(self, conn, batch):
+        events = [item for item in batch if isinstance(item, threading.Event)]
+        rows = [self._row(item) for item in batch
+                if not isinstance(item, threading.Event)]
+        if rows:
+            try:
+                with conn:
+                    conn.executemany(_INSERT, rows)
+                self.written += len(rows)
+            except sqlite3.Error as e:
+                self.dropped += len(rows)
+                logger.warning(f"failed to write {len(rows)} rows to "
+                               f"{self.path}: {e}")
+        for event in events:
+            event.set()
+
+    def flush(self, timeout=5):
+        """Wait until the rows queued so far are written
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait at most, by default 5
+
+        Returns
+        -------
+        bool
+            True if everything queued was written in time
+        """
+        if not self._thread.is_alive():
+            return False
+        event = threading.Event()
+        self._queue.put(event)
+        return event.wait(timeout)
+
+    def close(self, timeout=5):
+        """Write the queued rows and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+def enable(path):
+    """Start recording executions to a history database
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file
+
+    Returns
+    -------
+    HistoryRecorder
+        The active recorder
+    """
+    global recorder
+    if recorder is not None:
+        disable()
+    recorder = HistoryRecorder(path)
+    add_observer(recorder)
+    atexit.register(recorder.close)
+    return recorder
+
+
+def disable():
+    """Stop recording, writing out the queued rows"""
+    global recorder
+    if recorder is None:
+        return
+    remove_observer(recorder)
+    atexit.unregister(recorder.close)
+    recorder.close()
+    recorder = None
+
+
+def percentile(values, fraction):
+    """Linear interpolated percentile of sorted values"""
+    if not values:
+        return None
+    pos = (len(values) - 1) * fraction
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class ExecutionHistory:
+    """Queries of a history database
+    """
+
+    def __init__(self, path):
+        """Open the database
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite file
+        """
+        self.path = path
+        self.conn = connect(path)
+
+    def close(self):
+        self.conn.close()
+
+    def _where(self, entry_point=None, since=None, until=None, host=None,
+               top_level=False):
+        clauses, params = [], []
+        if entry_point:
+            # module.Class, or the class name alone (LIKE ignores case)
+            clauses.append("(entry_point = ? OR entry_point LIKE ?)")
+            params += [entry_point, f"%.{entry_point}"]
+        if since is not None:
+            clauses.append("start_time >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("start_time < ?")
+            params.append(until)
+        if host:
+            clauses.append("host = ?")
+            params.append(host)
+        if top_level:
+            clauses.append("parent_run_id IS NULL")
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def entry_points(self, **filters):
+        """Entry points with recorded executions
+
+        Parameters
+        ----------
+        **filters
+            entry_point, since, until (epoch seconds), host, top_level
+
+        Returns
+        -------
+        list
+        """
+        where, params = self._where(**filters)
+        rows = self.conn.execute(f"SELECT DISTINCT entry_point FROM executions "
+                                 f"{where} ORDER BY entry_point", params)
+        return [row[0] for row in rows]
+
+    def durations(self, entry_point, phase='duration', successful=None,
+                  **filters):
+        """Recorded durations of an entry point
+
+        Parameters
+        ----------
+        entry_point : str
+            module.Class, or Class
+        phase : str, optional
+            'duration' (the whole execution), 'load_config', 'pre_condition',
+            'perform' or 'post_condition', by default 'duration'
+        successful : bool, optional
+            Only successful (True) or failed (False) executions, by default
+            both
+        **filters
+            since, until (epoch seconds), host, top_level
+
+        Returns
+        -------
+        list
+            Durations in seconds, sorted
+        """
+        if phase not in ('duration', 'load_config') + PHASES:
+            raise ValueError(f"Unknown phase {phase}")
+        where, params = self._where(entry_point, **filters)
+        where = f"{where} {'AND' if where else 'WHERE'} {phase} IS NOT NULL"
+        if successful is not None:
+            where += " AND success = ?"
+            params.append(int(successful))
+        rows = self.conn.execute(f"SELECT {phase} FROM executions {where} "
+                                 f"ORDER BY {phase}", params)
+        return [row[0] for row in rows]
+
+    def stats(self, entry_point=None, phase='duration',
+              percentiles=(0.5, 0.9, 0.99), **filters):
+        """Duration percentiles and failure rate per entry point
+
+        Parameters
+        ----------
+        entry_point : str, optional
+            Only this entry point, by default all
+        phase : str, optional
+            Duration summarised, see durations(), by default 'duration'
+        percentiles : tuple, optional
+            Fractions reported, by default (0.5, 0.9, 0.99)
+        **filters
+            since, until (epoch seconds), host, top_level
+
+        Returns
+        -------
+        dict
+            {entry point: {'count', 'failures', 'failure_rate', 'mean',
+            'p50', ..., 'max', 'exceptions': {name: count}}}
+        """
+        where, params = self._where(entry_point, **filters)
+        out = {}
+        counts = self.conn.execute(
+            f"SELECT entry_point, COUNT(*), SUM(1 - success) FROM executions "
+            f"{where} GROUP BY entry_point ORDER BY entry_point", params)
+        for name, count, failures in counts.fetchall():
+            values = self.durations(name, phase, successful=True, **filters)
+            row = {'count': count, 'failures': failures,
+                   'failure_rate': failures / count if count else 0.0,
+                   'mean': sum(values) / len(values) if values else None}
+            for fraction in percentiles:
+                row[f"p{fraction * 100:g}"] = percentile(values, fraction)
+            row['max'] = values[-1] if values else None
+            ex_where, ex_params = self._where(name, **filters)
+            row['exceptions'] = dict(self.conn.execute(
+                f"SELECT exception, COUNT(*) FROM executions {ex_where} "
+                f"{'AND' if ex_where else 'WHERE'} exception IS NOT NULL "
+                f"GROUP BY exception ORDER BY COUNT(*) DESC", ex_params))
+            out[name] = row
+        return out
+
+    def recent(self, limit=20, failed_only=False, **filters):
+        """The latest executions
+
+        Parameters
+        ----------
+        limit : int, optional
+            Number of rows, by default 20
+        failed_only : bool, optional
+            Only failed executions, by default False
+        **filters
+            entry_point, since, until (epoch seconds), host, top_level
+
+        Returns
+        -------
+        list
+            Rows as dicts, newest first
+        """
+        where, params = self._where(**filters)
+        if failed_only:
+            where = f"{where} {'AND' if where else 'WHERE'} success = 0"
+        cursor = self.conn.execute(f"SELECT * FROM executions {where} "
+                                   f"ORDER BY start_time DESC LIMIT ?",
+                                   params + [limit])
+        names = [col[0] for col in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+def parse_since(text):
+    """Epoch seconds of a time given as an age ('30m', '12h', '7d') or an
+    ISO date/time
+    """
+    if text is None:
+        return None
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text[-1:] in units:
+        try:
+            return time.time() - float(text[:-1]) * units[text[-1]]
+        except ValueError:
+            pass
+    return datetime.fromisoformat(text).timestamp()
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Duration percentiles and failure "
+                                        "rates of recorded executions")
+    parser.add_argument("database", help="Path to the history database")
+    parser.add_argument("-f", "--function", help="Entry point (module.Class or Class)")
+    parser.add_argument("-p", "--phase", default="duration",
+                        choices=('duration', 'load_config') + PHASES,
+                        help="Duration to summarise")
+    parser.add_argument("--since", help="Age (30m, 12h, 7d) or ISO time")
+    parser.add_argument("--until", help="Age (30m, 12h, 7d) or ISO time")
+    parser.add_argument("--host", help="Only executions on this host")
+    parser.add_argument("--top-level", action="store_true",
+                        help="Ignore executions nested in other functions")
+    parser.add_argument("--failures", type=int, metavar="N",
+                        help="List the last N failed executions")
+    parser.add_argument("--json", action="store_true", help="Output JSON")
+    parsed = parser.parse_args(argv)
+
+    history = ExecutionHistory(parsed.database)
+    filters = {'since': parse_since(parsed.since),
+               'until': parse_since(parsed.until),
+               'host': parsed.host, 'top_level': parsed.top_level}
+
+    if parsed.failures:
+        rows = history.recent(parsed.failures, failed_only=True,
+                              entry_point=parsed.function, **filters)
+        if parsed.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            for row in rows:
+                start = datetime.fromtimestamp(row['start_time'])
+                print(f"{start:%Y-%m-%d %H:%M:%S} {row['host']} "
+                      f"{row['entry_point']} {row['exception']}: "
+                      f"{row['message']}")
+        return 0
+
+    stats = history.stats(parsed.function, parsed.phase, **filters)
+    if parsed.json:
+        print(json.dumps(stats, indent=2))
+        return 0
+    print(f"{'entry point':<50} {'count':>7} {'fail%':>6} {'mean':>8} "
+          f"{'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for name, row in stats.items():
+        print(f"{name:<50} {row['count']:>7} {row['failure_rate']:>6.1%} "
+              f"{_fmt(row['mean']):>8} {_fmt(row['p50']):>8} "
+              f"{_fmt(row['p90']):>8} {_fmt(row['p99']):>8} "
+              f"{_fmt(row['max']):>8}")
+    return 0
+
+
+if os.environ.get('DDOI_HISTORY_DB'):
+    enable(os.environ['DDOI_HISTORY_DB'])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
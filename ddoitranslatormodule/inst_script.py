@@ -5,9 +5,11 @@ This script is the primary entry point to the translator module from the command
 It does three important things:
 1. It adds the base translator module to the PYTHONPATH, which is needed to access `cli_interface.py`
 2. It adds the translator for a specific instrument to PYTHONPATH, which is needed to import it
+   (or, when a bundle of both has been built on local disk, imports them from the bundle instead)
 3. It calls `main` on `cli_interface` with the appropriate arguments
 """
 
+import os
 import sys
 
 # 
@@ -23,12 +25,51 @@ translator_module_location = "/ddoi/KPFTranslator/default/KPFTranslator"
 linking_table_location = f"{server_location}{'/' if server_location else ''}{translator_module_location}/kpf/linking_table.yml"
 
 
-# Add the cli script to import path
-sys.path.insert(0, f"{server_location}/ddoi/DDOITranslatorModule/default/DDOITranslatorModule")
-import ddoitranslatormodule.cli_interface as cli
+# Prebuilt bundle of both packages on local disk (see ddoitranslatormodule/bundle.py),
+# used instead of importing from the directories above when it exists and matches
+# the deployed sources and linking table. Build it with
+# python -m ddoitranslatormodule.bundle build <bundle_location> --table <linking table> --path <translator module> --path <DDOITranslatorModule>
+bundle_location = "/usr/local/ddoi/KPFTranslator.bundle"
 
-# Add the translator module to the python path
-sys.path.insert(0, f"{server_location}/{translator_module_location}")
+
+def use_bundle(location, linking_table=None):
+    """Import the translator packages from a bundle, if there is a usable one
+    that was built from the deployed sources"""
+    if not location or not os.path.exists(location):
+        return False
+    sys.path.insert(0, location)
+    try:
+        import ddoi_bundle
+        finder = ddoi_bundle.install(location)
+        if finder is None:
+            return False
+        # bundles of older builds can not tell
+        changes = finder.outdated(linking_table) \
+            if hasattr(finder, 'outdated') else ["built without source checks"]
+        if changes:
+            ddoi_bundle.uninstall(finder)
+            what = changes[0] if len(changes) == 1 \
+                else f"{changes[0]} and {len(changes) - 1} more"
+            print(f"Warning: {location} is out of date ({what} changed), "
+                  f"importing from the package directories; rebuild it",
+                  file=sys.stderr)
+            return False
+        return True
+    except ImportError:
+        return False
+    finally:
+        sys.path.remove(location)
+
+
+if use_bundle(bundle_location, linking_table_location):
+    import ddoitranslatormodule.cli_interface as cli
+else:
+    # Add the cli script to import path
+    sys.path.insert(0, f"{server_location}/ddoi/DDOITranslatorModule/default/DDOITranslatorModule")
+    import ddoitranslatormodule.cli_interface as cli
+
+    # Add the translator module to the python path
+    sys.path.insert(0, f"{server_location}/{translator_module_location}")
 
 # Call main with the linking table location and arguments
 cli.main(linking_table_location, sys.argv[1:])
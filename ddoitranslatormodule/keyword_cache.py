@@ -0,0 +1,476 @@
+"""
+Host-local keyword value cache shared between processes.
+
+CLI processes, GUIs and scripts on one host tend to read the same status
+keywords (dcs, mds, ...) over and over, each with its own dispatcher round
+trip.  With this cache one feeder process keeps the current values of those
+keywords in a memory-mapped file, and every other process reads them from
+there without touching the dispatchers:
+
+    python -m ddoitranslatormodule.keyword_cache feed dcs.EL dcs.ROTPPOSN \\
+        mds.IMAGEDONE mds.READY --interval 0.5
+
+    # in translator code, any value at most 1 s old is good enough
+    el = ktl_access.read('dcs', 'EL', max_age=1.0)
+
+Reads only use the cache when they give a ``max_age``; a value that is older
+(or not cached, or when there is no cache) is read from KTL directly.  The
+file is ``DDOI_KEYWORD_CACHE``, by default ``ddoi_keyword_cache`` in
+``/dev/shm`` (or the temporary directory).
+
+The file holds a header and a fixed table of slots, one per keyword, found by
+hashing "service.KEYWORD".  The feeder is the only writer; each slot is
+guarded by a sequence number (a seqlock) that is odd while the slot is being
+written, so readers never see a half written value and never block the
+feeder.  A slot holds the ascii value as KTL gives it and, when its text
+differs (enumerated or sexagesimal keywords), the binary value after a NUL.
+The feeder monitors keywords when the backend supports callbacks and
+polls them otherwise.  Every slot carries the time its value arrived; the
+feeder re-reads monitored keywords that have not changed for an interval,
+so a value is only as fresh as the feeder last saw it.
+"""
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import tempfile
+import argparse
+import threading
+from pathlib import Path
+
+from ddoitranslatormodule import clock, ktl_access
+
+MAGIC = b'DDKC'
+VERSION = 2
+# magic, version, slots, slot size, heartbeat time, feeder pid
+HEADER = struct.Struct('<4sIIIdQ')
+HEADER_SIZE = 64
+# sequence, key, time, type, flags, value length
+SLOT = struct.Struct('<Q56sdccH4x')
+SLOT_SIZE = 256
+VALUE_SIZE = SLOT_SIZE - SLOT.size
+DEFAULT_SLOTS = 1024
+
+# Types of the binary values stored along with the ascii ones
+_TYPES = {bool: b'b', int: b'i', float: b'f'}
+_PARSERS = {b'b': lambda text: text.strip() in ('1', 'True', 'true'),
+            b'i': int, b'f': float}
+# Flag of the slots of monitored keywords
+MONITORED = b'm'
+# Length of a value too long for its slot
+TOO_LONG = 0xFFFF
+# Longest "service.KEYWORD" that can be cached
+KEY_SIZE = 56
+# Attempts to read a slot that keeps changing before giving up on it
+READ_ATTEMPTS = 100
+# Seconds between checks that the file was not replaced by a new feeder
+REOPEN_INTERVAL = 1.0
+
+
+def default_path():
+    """Path of the cache file: DDOI_KEYWORD_CACHE, or ddoi_keyword_cache in
+    /dev/shm or the temporary directory"""
+    env = os.environ.get('DDOI_KEYWORD_CACHE')
+    if env:
+        return Path(env)
+    shm = Path('/dev/shm')
+    base = shm if shm.is_dir() else Path(tempfile.gettempdir())
+    return base / 'ddoi_keyword_cache'
+
+
+def _key(service, keyword):
+    return f"{service.lower()}.{keyword.upper()}".encode()
+
+
+class KeywordCache:
+    """Read access to the cache file
+    """
+
+    def __init__(self, path=None):
+        """Open the cache
+
+        Parameters
+        ----------
+        path : str, optional
+            The cache file, by default default_path()
+
+        Raises
+        ------
+        OSError
+            If the file does not exist
+        ValueError
+            If the file is not a keyword cache
+        """
+        self.path = Path(path or default_path())
+        self._lock = threading.Lock()
+        self.counts = {'hits': 0, 'stale': 0, 'misses': 0}
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            cache_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_slots, slot_size, _, _ = \
+            HEADER.unpack_from(cache_map, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            cache_map.close()
+            raise ValueError(f"{self.path} is not a keyword cache")
+        self._map, self.n_slots, self._inode = cache_map, n_slots, inode
+        self._checked = clock.monotonic()
+
+    def _reopen_if_replaced(self):
+        """Follow a restarted feeder, which writes a new file"""
+        if clock.monotonic() - self._checked < REOPEN_INTERVAL:
+            return
+        self._checked = clock.monotonic()
+        try:
+            if os.stat(self.path).st_ino != self._inode:
+                # the old map is left to other threads still reading it
+                self._open()
+        except (OSError, ValueError):
+            pass
+
+    def heartbeat(self):
+        """(clock.time() of the feeder's last heartbeat, feeder pid)"""
+        return HEADER.unpack_from(self._map, 0)[4:6]
+
+    def _slot(self, key):
+        """Offset of the slot of key, None if it is not in the cache"""
+        start = zlib.crc32(key) % self.n_slots
+        for probe in range(self.n_slots):
+            offset = HEADER_SIZE + ((start + probe) % self.n_slots) * SLOT_SIZE
+            stored = self._map[offset + 8:offset + 8 + KEY_SIZE].rstrip(b'\0')
+            if not stored:
+                return None
+            if stored == key:
+                return offset
+        return None
+
+    def _read_slot(self, offset):
+        """Consistent (time, type, flags, value bytes) of a slot, None if
+        it keeps changing"""
+        for _ in range(READ_ATTEMPTS):
+            seq, _, when, kind, flags, length = SLOT.unpack_from(self._map,
+                                                                 offset)
+            if seq & 1:
+                # being written
+                continue
+            if length == TOO_LONG:
+                value = None
+            else:
+                start = offset + SLOT.size
+                value = self._map[start:start + length]
+            if struct.unpack_from('<Q', self._map, offset)[0] == seq:
+                return when, kind, flags, value
+        return None
+
+    def lookup(self, service, keyword):
+        """The cached entry of a keyword
+
+        Returns
+        -------
+        Tuple[str, object, float] or None
+            (ascii value, binary value, clock.time() the value arrived), None
+            if the keyword is not cached
+        """
+        offset = self._slot(_key(service, keyword))
+        if offset is None:
+            return None
+        slot = self._read_slot(offset)
+        if slot is None or slot[3] is None:
+            return None
+        when, kind, flags, value = slot
+        text, separator, binary_text = value.partition(b'\0')
+        text = text.decode(errors='replace')
+        binary = binary_text.decode(errors='replace') if separator else text
+        parse = _PARSERS.get(kind)
+        if parse is not None:
+            try:
+                binary = parse(binary)
+            except ValueError:
+                pass
+        return text, binary, when
+
+    def get(self, service, keyword, max_age, binary=False, both=False):
+        """A keyword value that is at most max_age seconds old
+
+        Parameters
+        ----------
+        service : str
+            The KTL service name
+        keyword : str
+            The KTL keyword name
+        max_age : float
+            Seconds
+        binary : bool, optional
+            Return the binary instead of the ascii value, by default False
+        both : bool, optional
+            Return the (binary, ascii) pair, by default False
+
+        Returns
+        -------
+        Tuple[object, float] or None
+            (value, clock.time() it arrived), None if there is no recent
+            enough value
+        """
+        entry = self.lookup(service, keyword)
+        if entry is None:
+            outcome = 'misses'
+        elif clock.time() - entry[2] > max_age:
+            outcome = 'stale'
+        else:
+            outcome = 'hits'
+        with self._lock:
+            self.counts[outcome] += 1
+        if outcome != 'hits':
+            self._reopen_if_replaced()
+            return None
+        if both:
+            return (entry[1], entry[0]), entry[2]
+        return (entry[1] if binary else entry[0]), entry[2]
+
+    def stats(self):
+        """hits, stale and misses of this process"""
+        with self._lock:
+            return dict(self.counts)
+
+    def close(self):
+        self._map.close()
+
+
+class KeywordCacheFeeder:
+    """Keeps the cache file up to date (the only writer)
+    """
+
+    def __init__(self, path=None, keywords=(), interval=1.0,
+                 n_slots=DEFAULT_SLOTS, monitor=True, logger=None):
+        """Create (or reset) the cache file
+
+        Parameters
+        ----------
+        path : str, optional
+            The cache file, by default default_path()
+        keywords : iterable, optional
+            (service, keyword) pairs or "service.keyword" names to cache
+        interval : float, optional
+            Seconds between polls and heartbeats, by default 1.0
+        n_slots : int, optional
+            Keywords the file can hold, by default DEFAULT_SLOTS
+        monitor : bool, optional
+            Use KTL monitoring callbacks where the backend supports them, by
+            default True
+        logger : logging.Logger, optional
+            Logger for feed errors, by default None
+        """
+        self.path = Path(path or default_path())
+        self.interval = interval
+        self.n_slots = n_slots
+        self.monitor = monitor
+        self.logger = logger
+        self.keywords = []
+        self.monitored = set()
+        # {(service, keyword): clock.time() of its last value}
+        self.updated = {}
+        self._offsets = {}
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        size = HEADER_SIZE + n_slots * SLOT_SIZE
+        tmp = self.path.with_name(self.path.name + f'.{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+        with open(tmp, 'r+b') as f:
+            self._map = mmap.mmap(f.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, n_slots, SLOT_SIZE,
+                         clock.time(), os.getpid())
+        # readers only ever see a complete file
+        os.replace(tmp, self.path)
+        for keyword in keywords:
+            self.add(*ktl_access.Snapshot._key(keyword))
+
+    def add(self, service, keyword):
+        """Cache another keyword"""
+        key = (service.lower(), keyword.upper())
+        if key not in self.keywords:
+            self.keywords.append(key)
+
+    def _slot(self, key):
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        start = zlib.crc32(key) % self.n_slots
+        for probe in range(self.n_slots):
+            offset = HEADER_SIZE + ((start + probe) % self.n_slots) * SLOT_SIZE
+            stored = self._map[offset + 8:offset + 8 + KEY_SIZE].rstrip(b'\0')
+            if not stored or stored == key:
+                self._offsets[key] = offset
+                return offset
+        raise ValueError(f"{self.path} is full ({self.n_slots} keywords)")
+
+    def update(self, service, keyword, value, ascii=None, when=None):
+        """Store a keyword value
+
+        Parameters
+        ----------
+        service : str
+            The KTL service name
+        keyword : str
+            The KTL keyword name
+        value :
+            The (binary) value
+        ascii : str, optional
+            The ascii value as KTL gives it, by default derived from value
+            (only right for numbers and strings)
+        when : float, optional
+            clock.time() of the value, by default now
+        """
+        key = _key(service, keyword)
+        if len(key) > KEY_SIZE:
+            # readers look it up in KTL
+            return
+        if when is None:
+            when = clock.time()
+        if ascii is None:
+            ascii = _ascii(value)
+        ascii = str(ascii)
+        data = ascii.encode()
+        binary_text = _ascii(value)
+        if binary_text != ascii:
+            data += b'\0' + binary_text.encode()
+        kind = _TYPES.get(type(value), b's')
+        name = (service.lower(), keyword.upper())
+        flags = MONITORED if name in self.monitored else b'-'
+        length = len(data) if len(data) <= VALUE_SIZE else TOO_LONG
+        with self._write_lock:
+            offset = self._slot(key)
+            seq = struct.unpack_from('<Q', self._map, offset)[0]
+            struct.pack_into('<Q', self._map, offset, seq + 1)
+            if length != TOO_LONG:
+                self._map[offset + SLOT.size:offset + SLOT.size + length] = data
+            SLOT.pack_into(self._map, offset, seq + 1, key, when, kind,
+                           flags, length)
+            struct.pack_into('<Q', self._map, offset, seq + 2)
+            self.updated[name] = when
+
+    def beat(self):
+        """Mark the feeder alive"""
+        struct.pack_into('<d', self._map, 16, clock.time())
+
+    def poll(self):
+        """Read the keywords that are not monitored, and the monitored ones
+        that did not change for an interval, and store their values
+
+        Returns
+        -------
+        int
+            Number of values stored
+        """
+        quiet = clock.time() - self.interval
+        polled = [key for key in self.keywords if key not in self.monitored
+                  or self.updated.get(key, 0) < quiet]
+        if not polled:
+            return 0
+        snapshot = ktl_access.read_many(polled, both=True, strict=False)
+        for (service, keyword), (value, ascii) in snapshot.items():
+            self.update(service, keyword, value, ascii,
+                        when=snapshot.timestamp((service, keyword)))
+        if snapshot.errors and self.logger:
+            self.logger.warning(f"Keyword cache: failed to read "
+                                f"{list(snapshot.errors)}")
+        return len(snapshot)
+
+    def _start_monitors(self):
+        ktl = ktl_access.backend()
+        for service, keyword in self.keywords:
+            kw = ktl.cache(service, keyword)
+            if not hasattr(kw, 'callback'):
+                continue
+
+            def changed(kw, service=service, keyword=keyword):
+                self.update(service, keyword, kw['binary'], kw['ascii'])
+
+            self.monitored.add((service, keyword))
+            kw.callback(changed)
+            kw.monitor()
+
+    def start(self):
+        """Feed the cache from a background thread"""
+        if self.monitor:
+            self._start_monitors()
+        self._thread = threading.Thread(target=self.run, daemon=True,
+                                        name="keyword-cache-feeder")
+        self._thread.start()
+        return self
+
+    def run(self):
+        """Poll and beat every interval until stop()"""
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"Keyword cache: poll failed: {e}")
+            self.beat()
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+        self._map.close()
+
+
+def _ascii(value):
+    """The ascii form KTL gives a binary value"""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def main(argv=None):
+    import logging
+
+    parser = argparse.ArgumentParser(
+        prog="python -m ddoitranslatormodule.keyword_cache",
+        description="Feed or show the shared keyword cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("feed", help="Keep keywords up to date in the cache")
+    p.add_argument("keywords", nargs="+", help="service.keyword names")
+    p.add_argument("--path", help="Cache file")
+    p.add_argument("--interval", type=float, default=1.0,
+                   help="Seconds between polls, by default 1")
+    p = sub.add_parser("show", help="Print the cached values")
+    p.add_argument("keywords", nargs="*", help="service.keyword names")
+    p.add_argument("--path", help="Cache file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "feed":
+        feeder = KeywordCacheFeeder(args.path, args.keywords, args.interval,
+                                    logger=logging.getLogger(__name__))
+        feeder.start()
+        try:
+            feeder._thread.join()
+        except KeyboardInterrupt:
+            feeder.close()
+    else:
+        cache = KeywordCache(args.path)
+        beat, pid = cache.heartbeat()
+        print(f"feeder {pid}, last heartbeat {clock.time() - beat:.1f} s ago")
+        for name in args.keywords:
+            entry = cache.lookup(*ktl_access.Snapshot._key(name))
+            if entry is None:
+                print(f"{name}: not cached")
+            else:
+                print(f"{name} = {entry[0]} ({clock.time() - entry[2]:.1f} s old)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1239 @@
+"""
+Shared access path to KTL keywords.
+
+TelescopeBase, the base class helpers and translator functions read and write
+KTL keywords through ``read`` and ``write`` here instead of calling ``ktl``
+directly, so behaviour that applies to all KTL traffic lives in one place.
+
+Write elision
+-------------
+``write(..., elide=True)`` first compares the new value with the current one
+(the monitored value if the keyword is monitored, otherwise a single read) and
+skips the write when they already match, within a per-keyword tolerance for
+numeric values.  A skipped write saves a full dispatcher round trip with
+``wait=True``; the number of skipped writes and the estimated seconds saved
+are counted per observing night, see ``elision_stats``.
+
+Tolerances are set with ``set_elision_tolerance`` or read from the
+``[write_elision]`` section of a config file::
+
+    [write_elision]
+    enabled = true
+    mds.itime = 0.5
+    dcs.rotdest = 0.01
+
+Circuit breakers
+----------------
+Every service has a circuit breaker.  After ``threshold`` consecutive
+timeouts or KTL errors it opens, and reads and writes of the service fail at
+once with ``DDOIServiceUnavailable`` instead of each waiting out its timeout.
+After ``reset_timeout`` seconds it lets ``half_open_trials`` calls through;
+one success closes it again, a failure opens it for another period.  State
+changes are logged (and traced), ``breaker_stats`` reports every breaker.
+Settings come from ``configure_breakers`` or the ``[circuit_breaker]``
+section of a config file (``service.option`` for one service)::
+
+    [circuit_breaker]
+    threshold = 3
+    reset_timeout = 30
+    dcs.reset_timeout = 10
+
+Rate limiting
+-------------
+Every service can be given a token bucket, so tight poll loops of several
+scripts cannot flood its dispatcher.  Each request takes a token; tokens
+refill at ``rate`` per second up to ``burst``.  Reads wait while writes of
+the same service are waiting, so commands go before status polls.  The time
+requests spent waiting is reported by ``rate_limit_stats`` (mean, p95 and
+max per service and kind), to size the limits under real load.  There is no
+limit unless one is set with ``configure_rate_limits`` or in the
+``[rate_limit]`` section of a config file::
+
+    [rate_limit]
+    rate = 50
+    burst = 10
+    mds.rate = 20
+
+Configuration
+-------------
+``load_config`` applies the ``[write_elision]``, ``[circuit_breaker]`` and
+``[rate_limit]`` sections of a config.  ``execute()`` calls it once the
+config of a function is loaded; a config whose sections were already applied
+is skipped, so settings are not reset on every execution (or write) and
+``configure_*`` calls made since stay in effect.
+
+Shared keyword cache
+--------------------
+Reads given a ``max_age`` first look in the host's shared keyword cache (see
+``keyword_cache``), fed by one monitoring process, and only go to KTL when
+the cached value is older than that, or missing.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime, timedelta
+
+from ddoitranslatormodule import clock, tracing
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIServiceUnavailable
+
+try:
+    import ktl
+except ImportError:
+    # Allows the module to be imported where KTL is not installed, a backend
+    # must then be provided with set_backend()
+    ktl = None
+
+DEFAULT_TIMEOUT = 2
+
+_backend = ktl
+
+
+def set_backend(module):
+    """Use another module with the ktl interface (e.g. a simulator) for all
+    KTL access
+
+    Parameters
+    ----------
+    module : module
+        Module providing read, write, cache, TimeoutException and ktlError
+    """
+    global _backend
+    _backend = module
+
+
+def backend():
+    """Return the module used for KTL access
+
+    Raises
+    ------
+    ModuleNotFoundError
+        If ktl is not installed and no backend was set
+    """
+    if _backend is None:
+        raise ModuleNotFoundError("KTL is not available, use "
+                                  "ktl_access.set_backend() to provide one")
+    return _backend
+
+
+def observing_night(utc=None):
+    """Name of the observing night, matching the log directory names
+
+    Parameters
+    ----------
+    utc : datetime, optional
+        UT time, by default now
+
+    Returns
+    -------
+    str
+        The night, e.g. "2022feb03"
+    """
+    if utc is None:
+        utc = clock.utcnow()
+    return (utc - timedelta(days=1)).strftime('%Y%b%d').lower()
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """Failure tracking of one KTL service
+    """
+
+    def __init__(self, service, threshold=5, reset_timeout=30.0,
+                 half_open_trials=1):
+        """Create a closed breaker
+
+        Parameters
+        ----------
+        service : str
+            The KTL service name
+        threshold : int, optional
+            Consecutive failures that open the breaker, by default 5
+        reset_timeout : float, optional
+            Seconds the breaker stays open before trial calls, by default 30
+        half_open_trials : int, optional
+            Calls let through at once while half-open, by default 1
+        """
+        self.service = service
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_trials = half_open_trials
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = None
+        self.opened_at = None
+        self._trials = 0
+        self._lock = threading.Lock()
+        self.counts = {'calls': 0, 'failures': 0, 'rejected': 0,
+                       'opened': 0}
+
+    def _set_state(self, state):
+        """Change state (caller holds the lock)"""
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self.opened_at = clock.monotonic()
+            self.counts['opened'] += 1
+        return previous
+
+    def _changed(self, previous, state):
+        if previous == state:
+            return
+        log = logging.getLogger(__name__)
+        if state == OPEN:
+            log.warning(f"KTL service {self.service}: circuit open after "
+                        f"{self.failures} consecutive failures, calls fail "
+                        f"immediately for {self.reset_timeout} s. Last error: "
+                        f"{self.last_error}")
+        elif state == CLOSED:
+            log.info(f"KTL service {self.service}: circuit closed, service "
+                     f"responding again")
+        else:
+            log.info(f"KTL service {self.service}: circuit half-open, trying")
+        if tracing.tracer is not None:
+            tracing.tracer.instant(f"circuit {self.service} {state}", 'ktl',
+                                   service=self.service, state=state,
+                                   previous=previous)
+
+    def before_call(self):
+        """Let a call through, or refuse it while the breaker is open
+
+        Raises
+        ------
+        DDOIServiceUnavailable
+            If the breaker is open, or half-open with its trials in flight
+        """
+        with self._lock:
+            previous = self.state
+            if self.state == OPEN:
+                waited = clock.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.counts['rejected'] += 1
+                    raise DDOIServiceUnavailable(
+                        self.service, self.reset_timeout - waited,
+                        self.last_error)
+                self._set_state(HALF_OPEN)
+                self._trials = 0
+            if self.state == HALF_OPEN:
+                if self._trials >= self.half_open_trials:
+                    self.counts['rejected'] += 1
+                    raise DDOIServiceUnavailable(self.service, 0.0,
+                                                 self.last_error)
+                self._trials += 1
+            self.counts['calls'] += 1
+            state = self.state
+        self._changed(previous, state)
+
+    def record(self, error=None):
+        """Record the outcome of a call let through by before_call
+
+        Parameters
+        ----------
+        error : Exception, optional
+            The timeout or KTL error of a failed call, None on success
+        """
+        with self._lock:
+            previous = self.state
+            if self.state == HALF_OPEN:
+                self._trials = max(self._trials - 1, 0)
+            if error is None:
+                self.failures = 0
+                if self.state == HALF_OPEN:
+                    self._set_state(CLOSED)
+            else:
+                self.failures += 1
+                self.counts['failures'] += 1
+                self.last_error = f"{type(error).__name__}: {error}"
+                if self.state == HALF_OPEN or (
+                        self.state == CLOSED
+                        and self.failures >= self.threshold):
+                    self._set_state(OPEN)
+            state = self.state
+        self._changed(previous, state)
+
+    def release(self):
+        """End a call that neither succeeded nor failed at the service level
+        (e.g. it raised an unrelated exception)"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trials = max(self._trials - 1, 0)
+
+    def reset(self):
+        """Close the breaker, e.g. after the dispatcher was restarted"""
+        with self._lock:
+            previous = self._set_state(CLOSED)
+            self.failures = 0
+            self._trials = 0
+        self._changed(previous, CLOSED)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts, state=self.state,
+                         consecutive_failures=self.failures,
+                         last_error=self.last_error)
+            if self.state == OPEN:
+                stats['retry_in'] = max(
+                    self.reset_timeout - (clock.monotonic() - self.opened_at),
+                    0.0)
+        return stats
+
+
+class CircuitBreakers:
+    """The circuit breakers of all services, with their settings
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = True
+        self.defaults = {'threshold': 5, 'reset_timeout': 30.0,
+                         'half_open_trials': 1}
+        # {service: {option: value}}
+        self.overrides = {}
+        self.breakers = {}
+
+    def configure(self, service=None, **options):
+        """Change settings, of one service or of all of them
+
+        Parameters
+        ----------
+        service : str, optional
+            The service, by default all
+        **options
+            threshold, reset_timeout and/or half_open_trials
+        """
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown circuit breaker options: {unknown}")
+        with self._lock:
+            if service is None:
+                self.defaults.update(options)
+                targets = list(self.breakers.values())
+            else:
+                service = service.lower()
+                self.overrides.setdefault(service, {}).update(options)
+                targets = [self.breakers[service]] \
+                    if service in self.breakers else []
+            for breaker in targets:
+                for option in options:
+                    setattr(breaker, option, self._option(breaker.service,
+                                                          option))
+
+    def _option(self, service, option):
+        return self.overrides.get(service, {}).get(option,
+                                                   self.defaults[option])
+
+    def load_config(self, cfg):
+        """Read settings from the [circuit_breaker] section of a config
+
+        Parameters
+        ----------
+        cfg : configparser.ConfigParser
+            The config
+        """
+        if cfg is None or not cfg.has_section('circuit_breaker'):
+            return
+        section = cfg['circuit_breaker']
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        for name, val in section.items():
+            if name == 'enabled':
+                continue
+            service, _, option = name.rpartition('.')
+            if option not in self.defaults:
+                continue
+            val = float(val) if option == 'reset_timeout' else int(val)
+            self.configure(service or None, **{option: val})
+
+    def get(self, service):
+        """The breaker of a service, created on first use"""
+        service = service.lower()
+        breaker = self.breakers.get(service)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(service)
+                if breaker is None:
+                    breaker = self.breakers[service] = CircuitBreaker(
+                        service, **{option: self._option(service, option)
+                                    for option in self.defaults})
+        return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self.breakers.values())
+        return {breaker.service: breaker.stats() for breaker in breakers}
+
+
+breakers = CircuitBreakers()
+
+
+def configure_breakers(service=None, **options):
+    """Change circuit breaker settings, see CircuitBreakers.configure"""
+    breakers.configure(service, **options)
+
+
+def breaker_stats():
+    """{service: state, counters and last error} of every circuit breaker"""
+    return breakers.stats()
+
+
+READ = 'read'
+WRITE = 'write'
+
+# Queueing delays kept per service and kind for the percentiles
+DELAY_SAMPLES = 1000
+# Longest single sleep while waiting for a token, so waiting reads notice
+# writes that arrive in the meantime
+RATE_WAIT_STEP = 0.05
+
+
+class RateLimiter:
+    """Token bucket of one KTL service: requests take tokens, which refill
+    at rate per second up to burst.  Reads wait while writes are waiting.
+    """
+
+    def __init__(self, service, rate=None, burst=10):
+        """Create a full bucket
+
+        Parameters
+        ----------
+        service : str
+            The KTL service name
+        rate : float, optional
+            Requests per second, by default None (unlimited)
+        burst : int, optional
+            Requests allowed at once after a quiet period, by default 10
+        """
+        self.service = service
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = clock.monotonic()
+        self._writes_waiting = 0
+        self._lock = threading.Lock()
+        self.counts = {READ: 0, WRITE: 0, 'delayed': 0, 'timeouts': 0}
+        self.delays = {READ: deque(maxlen=DELAY_SAMPLES),
+                       WRITE: deque(maxlen=DELAY_SAMPLES)}
+
+    def _refill(self, now):
+        """Add the tokens earned since the last update (caller holds the
+        lock)"""
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          float(self.burst))
+        self.updated = now
+
+    def acquire(self, kind=READ, tokens=1, timeout=None):
+        """Wait until the service may be sent tokens requests
+
+        Parameters
+        ----------
+        kind : str, optional
+            READ or WRITE, by default READ.  Writes go before waiting reads.
+        tokens : int, optional
+            Number of requests, by default 1.  Requests larger than the
+            burst are let through once the bucket is full.
+        timeout : float, optional
+            Seconds to wait at most, by default None (no limit)
+
+        Returns
+        -------
+        float
+            Seconds waited
+
+        Raises
+        ------
+        TimeoutException
+            (of the KTL backend) if no tokens were available in time
+        """
+        if self.rate is None:
+            with self._lock:
+                self.counts[kind] += 1
+            return 0.0
+        start = clock.monotonic()
+        with self._lock:
+            if kind == WRITE:
+                self._writes_waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = clock.monotonic()
+                    self._refill(now)
+                    needed = min(tokens, self.burst)
+                    ready = self.tokens >= needed and (
+                        kind == WRITE or not self._writes_waiting)
+                    if ready:
+                        self.tokens -= tokens
+                        waited = now - start
+                        self.counts[kind] += 1
+                        self.delays[kind].append(waited)
+                        if waited > 0:
+                            self.counts['delayed'] += 1
+                        return waited
+                    step = max((needed - self.tokens) / self.rate,
+                               RATE_WAIT_STEP / 10)
+                    if timeout is not None and now + step - start > timeout:
+                        self.counts['timeouts'] += 1
+                        raise backend().TimeoutException(
+                            f"Rate limit of {self.service}: no {kind} "
+                            f"allowed within {timeout} s")
+                clock.sleep(min(step, RATE_WAIT_STEP))
+        finally:
+            if kind == WRITE:
+                with self._lock:
+                    self._writes_waiting -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts, rate=self.rate, burst=self.burst)
+            for kind, delays in self.delays.items():
+                ordered = sorted(delays)
+                if not ordered:
+                    continue
+                stats[f'{kind}_delay'] = {
+                    'mean': sum(ordered) / len(ordered),
+                    'p95': ordered[min(int(len(ordered) * 0.95),
+                                       len(ordered) - 1)],
+                    'max': ordered[-1]}
+        return stats
+
+
+class RateLimiters:
+    """The rate limiters of all services, with their settings
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = True
+        self.defaults = {'rate': None, 'burst': 10}
+        # {service: {option: value}}
+        self.overrides = {}
+        self.limiters = {}
+
+    def configure(self, service=None, **options):
+        """Change settings, of one service or of all of them
+
+        Parameters
+        ----------
+        service : str, optional
+            The service, by default all
+        **options
+            rate (requests per second, None or <= 0 for unlimited) and/or
+            burst
+        """
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown rate limit options: {unknown}")
+        if options.get('rate') is not None and options['rate'] <= 0:
+            # the bucket would never refill
+            options['rate'] = None
+        with self._lock:
+            if service is None:
+                self.defaults.update(options)
+                targets = list(self.limiters.values())
+            else:
+                service = service.lower()
+                self.overrides.setdefault(service, {}).update(options)
+                targets = [self.limiters[service]] \
+                    if service in self.limiters else []
+            for limiter in targets:
+                with limiter._lock:
+                    for option in options:
+                        setattr(limiter, option,
+                                self._option(limiter.service, option))
+                    limiter.tokens = min(limiter.tokens, limiter.burst)
+
+    def _option(self, service, option):
+        return self.overrides.get(service, {}).get(option,
+                                                   self.defaults[option])
+
+    def load_config(self, cfg):
+        """Read settings from the [rate_limit] section of a config
+
+        Parameters
+        ----------
+        cfg : configparser.ConfigParser
+            The config
+        """
+        if cfg is None or not cfg.has_section('rate_limit'):
+            return
+        section = cfg['rate_limit']
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        for name, val in section.items():
+            if name == 'enabled':
+                continue
+            service, _, option = name.rpartition('.')
+            if option not in self.defaults:
+                continue
+            if option == 'rate':
+                val = float(val) if val.strip().lower() not in (
+                    '', 'none') else None
+            else:
+                val = int(val)
+            self.configure(service or None, **{option: val})
+
+    def get(self, service):
+        """The limiter of a service, created on first use"""
+        service = service.lower()
+        limiter = self.limiters.get(service)
+        if limiter is None:
+            with self._lock:
+                limiter = self.limiters.get(service)
+                if limiter is None:
+                    limiter = self.limiters[service] = RateLimiter(
+                        service, **{option: self._option(service, option)
+                                    for option in self.defaults})
+        return limiter
+
+    def acquire(self, service, kind=READ, tokens=1, timeout=None):
+        """Wait for the limiter of a service, see RateLimiter.acquire"""
+        if not self.enabled:
+            return 0.0
+        return self.get(service).acquire(kind, tokens, timeout)
+
+    def stats(self):
+        with self._lock:
+            limiters = list(self.limiters.values())
+        return {limiter.service: limiter.stats() for limiter in limiters}
+
+
+limiters = RateLimiters()
+
+
+def configure_rate_limits(service=None, **options):
+    """Change rate limit settings, see RateLimiters.configure"""
+    limiters.configure(service, **options)
+
+
+def rate_limit_stats():
+    """{service: request counts and queueing delays} of every rate limiter"""
+    return limiters.stats()
+
+
+def _is_service_failure(ktl_module, error):
+    return isinstance(error, (ktl_module.TimeoutException,
+                              ktl_module.ktlError))
+
+
+def _guarded(service, call, *args, **kwargs):
+    """Call the backend through the circuit breaker of service"""
+    if not breakers.enabled:
+        return call(*args, **kwargs)
+    breaker = breakers.get(service)
+    breaker.before_call()
+    try:
+        result = call(*args, **kwargs)
+    except Exception as e:
+        if _is_service_failure(backend(), e):
+            breaker.record(e)
+        else:
+            breaker.release()
+        raise
+    breaker.record()
+    return result
+
+
+_shared_cache = None
+_shared_cache_checked = None
+# Seconds between attempts to open a shared cache that does not exist (yet)
+SHARED_CACHE_RETRY = 5.0
+
+
+def use_shared_cache(path=None):
+    """Open the shared keyword cache used by reads with a max_age
+
+    Parameters
+    ----------
+    path : str, optional
+        The cache file, by default keyword_cache.default_path()
+
+    Returns
+    -------
+    keyword_cache.KeywordCache or None
+        The cache, None if there is no cache file
+    """
+    global _shared_cache, _shared_cache_checked
+    from ddoitranslatormodule import keyword_cache
+    _shared_cache_checked = clock.monotonic()
+    try:
+        _shared_cache = keyword_cache.KeywordCache(path)
+    except (OSError, ValueError):
+        _shared_cache = None
+    return _shared_cache
+
+
+def shared_cache():
+    """The shared keyword cache, opened on first use, None if there is none
+    """
+    if _shared_cache is None and (
+            _shared_cache_checked is None
+            or clock.monotonic() - _shared_cache_checked > SHARED_CACHE_RETRY):
+        use_shared_cache()
+    return _shared_cache
+
+
+def _cached(service, keyword, max_age, binary, both=False):
+    """(value, time) from the shared cache if at most max_age old"""
+    cache = shared_cache()
+    if cache is None:
+        return None
+    return cache.get(service, keyword, max_age, binary, both=both)
+
+
+def read(service, keyword, timeout=DEFAULT_TIMEOUT, binary=False,
+         max_age=None):
+    """Read the current value of a keyword
+
+    Parameters
+    ----------
+    service : str
+        The KTL service name
+    keyword : str
+        The KTL keyword name
+    timeout : float, optional
+        Seconds to wait for the read, by default DEFAULT_TIMEOUT
+    binary : bool, optional
+        Return the binary instead of the ascii value, by default False
+    max_age : float, optional
+        Accept a value from the shared keyword cache that is at most this
+        many seconds old, by default None (always read from KTL)
+
+    Returns
+    -------
+    The keyword value
+
+    Raises
+    ------
+    DDOIServiceUnavailable
+        If the circuit breaker of the service is open
+    """
+    if max_age is not None:
+        cached = _cached(service, keyword, max_age, binary)
+        if cached is not None:
+            return cached[0]
+    limiters.acquire(service, READ, timeout=timeout)
+    if tracing.tracer is None:
+        return _guarded(service, backend().read, service, keyword,
+                        timeout=timeout, binary=binary)
+    with tracing.tracer.span(f"ktl read {service}.{keyword}", 'ktl',
+                             service=service, keyword=keyword):
+        return _guarded(service, backend().read, service, keyword,
+                        timeout=timeout, binary=binary)
+
+
+class Snapshot(Mapping):
+    """Values of several keywords read together by read_many
+
+    Indexed by (service, keyword) or "service.keyword" (case insensitive).
+    """
+
+    def __init__(self, keys):
+        self.keys_requested = list(keys)
+        self.values = {}
+        # {key: clock.time() when the value was received}
+        self.timestamps = {}
+        # {key: exception} of the reads that failed or did not finish
+        self.errors = {}
+        self.started = clock.time()
+        self.finished = None
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, str):
+            key = key.split('.', 1)
+        service, keyword = key
+        return service.lower(), keyword.upper()
+
+    def __getitem__(self, key):
+        return self.values[self._key(key)]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return self._key(key) in self.values
+
+    def timestamp(self, key):
+        """clock.time() at which the value of key was received"""
+        return self.timestamps[self._key(key)]
+
+    @property
+    def complete(self):
+        """True if every requested keyword was read"""
+        return not self.errors
+
+    @property
+    def spread(self):
+        """Seconds between the first and last value received"""
+        if not self.timestamps:
+            return 0.0
+        times = self.timestamps.values()
+        return max(times) - min(times)
+
+    def __repr__(self):
+        values = ', '.join(f"{serv}.{kw}={val!r}"
+                           for (serv, kw), val in self.values.items())
+        return f"<Snapshot {values}{' incomplete' if self.errors else ''}>"
+
+
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+# Threads used to read the services of read_many concurrently
+READ_THREADS = 16
+
+
+def _pool():
+    global _read_pool
+    with _read_pool_lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(READ_THREADS,
+                                            thread_name_prefix='ktl-read')
+        return _read_pool
+
+
+def _read_service(ktl_module, service, keywords, end, binary, both=False):
+    """Read keywords of one service: all reads are issued before waiting
+    for the replies when the backend supports it, one by one otherwise
+
+    Returns
+    -------
+    Tuple[dict, dict, dict]
+        values, timestamps and errors by (service, keyword)
+    """
+    values, times, errors = {}, {}, {}
+    keys = [(service, kw) for kw in keywords]
+    try:
+        limiters.acquire(service, READ, len(keys),
+                         timeout=max(end - clock.monotonic(), 0))
+    except ktl_module.TimeoutException as e:
+        return values, times, {key: e for key in keys}
+    breaker = breakers.get(service) if breakers.enabled else None
+    if breaker is not None:
+        try:
+            breaker.before_call()
+        except DDOIServiceUnavailable as e:
+            return values, times, {key: e for key in keys}
+    try:
+        _read_keywords(ktl_module, keys, values, times, errors, end, binary,
+                       both)
+    except BaseException:
+        if breaker is not None:
+            breaker.release()
+        raise
+    if breaker is not None:
+        failure = next((e for e in errors.values()
+                        if _is_service_failure(ktl_module, e)), None)
+        breaker.record(failure)
+    return values, times, errors
+
+
+def _read_keywords(ktl_module, keys, values, times, errors, end, binary,
+                   both=False):
+    kws = [ktl_module.cache(service, kw) for service, kw in keys]
+    if all(hasattr(kw, 'wait') for kw in kws):
+        pending = []
+        for key, kw in zip(keys, kws):
+            try:
+                pending.append((key, kw, kw.read(wait=False)))
+            except Exception as e:
+                errors[key] = e
+        for key, kw, sequence in pending:
+            try:
+                kw.wait(sequence=sequence,
+                        timeout=max(end - clock.monotonic(), 0))
+                if both:
+                    values[key] = kw['binary'], kw['ascii']
+                else:
+                    values[key] = kw['binary' if binary else 'ascii']
+                times[key] = clock.time()
+            except Exception as e:
+                errors[key] = e
+    else:
+        for key, kw in zip(keys, kws):
+            try:
+                if both:
+                    values[key] = kw.read(both=True, timeout=max(
+                        end - clock.monotonic(), 0))
+                else:
+                    values[key] = kw.read(binary=binary, timeout=max(
+                        end - clock.monotonic(), 0))
+                times[key] = clock.time()
+            except Exception as e:
+                errors[key] = e
+
+
+def read_many(keywords, timeout=DEFAULT_TIMEOUT, binary=False, strict=True,
+              max_age=None, both=False):
+    """Read several keywords at once: the services are read concurrently and
+    the reads of one service are pipelined, so the whole set costs about one
+    round trip
+
+    Parameters
+    ----------
+    keywords : iterable
+        (service, keyword) pairs or "service.keyword" names
+    timeout : float, optional
+        Seconds allowed for the whole set, by default DEFAULT_TIMEOUT
+    binary : bool, optional
+        Return the binary instead of the ascii values, by default False
+    strict : bool, optional
+        Raise if any keyword could not be read, by default True.  Otherwise
+        the failures are in Snapshot.errors.
+    max_age : float, optional
+        Take the values that are at most this many seconds old in the
+        shared keyword cache from there, by default None (read all from KTL)
+    both : bool, optional
+        Return (binary, ascii) pairs, as KTL's read(both=True), by default
+        False
+
+    Returns
+    -------
+    Snapshot
+        The values, with the time each was received
+
+    Raises
+    ------
+    TimeoutException
+        (of the KTL backend) if strict and not every value arrived in time
+    DDOIServiceUnavailable
+        If strict and the circuit breaker of a service is open
+    """
+    by_service = {}
+    keys = []
+    cached = {}
+    for item in keywords:
+        service, keyword = Snapshot._key(item)
+        keys.append((service, keyword))
+        if max_age is not None:
+            hit = _cached(service, keyword, max_age, binary, both)
+            if hit is not None:
+                cached[service, keyword] = hit
+                continue
+        by_service.setdefault(service, []).append(keyword)
+    snapshot = Snapshot(keys)
+    for key, (value, when) in cached.items():
+        snapshot.values[key] = value
+        snapshot.timestamps[key] = when
+    if not by_service:
+        snapshot.finished = clock.time()
+        return snapshot
+    ktl_module = backend()
+    end = clock.monotonic() + timeout
+
+    with tracing.span("ktl read_many", 'ktl',
+                      keywords=[f"{s}.{k}" for s, k in keys]):
+        if len(by_service) == 1:
+            service, kws = next(iter(by_service.items()))
+            results = [_read_service(ktl_module, service, kws, end, binary,
+                                     both)]
+        else:
+            # the reads of a service that are late are left to finish in the
+            # pool, their values are not part of the snapshot
+            context = contextvars.copy_context()
+            futures = {_pool().submit(context.copy().run, _read_service,
+                                      ktl_module, service, kws, end,
+                                      binary, both): service
+                       for service, kws in by_service.items()}
+            done, not_done = wait_futures(futures, timeout)
+            results = [future.result() for future in done]
+            for future in not_done:
+                service = futures[future]
+                results.append(({}, {}, {
+                    (service, kw): ktl_module.TimeoutException(
+                        f"read of {service}.{kw} timed out")
+                    for kw in by_service[service]}))
+    for values, times, errors in results:
+        snapshot.values.update(values)
+        snapshot.timestamps.update(times)
+        snapshot.errors.update(errors)
+    snapshot.finished = clock.time()
+
+    if strict and snapshot.errors:
+        missing = ', '.join(f"{s}.{k}" for s, k in snapshot.errors)
+        first = next(iter(snapshot.errors.values()))
+        if isinstance(first, ktl_module.TimeoutException):
+            raise ktl_module.TimeoutException(f"read_many timed out on {missing}")
+        raise first
+    return snapshot
+
+
+def write(service, keyword, value, wait=True, timeout=DEFAULT_TIMEOUT,
+          elide=False, tolerance=None, logger=None):
+    """Write a keyword
+
+    Parameters
+    ----------
+    service : str
+        The KTL service name
+    keyword : str
+        The KTL keyword name
+    value :
+        The new value
+    wait : bool, optional
+        Wait for the write to complete, by default True
+    timeout : float, optional
+        Seconds to wait for the write, by default DEFAULT_TIMEOUT
+    elide : bool, optional
+        Skip the write when the keyword already has the value, by default
+        False.  Never use it for keywords whose write triggers an action
+        (e.g. GO), only for settings.
+    tolerance : float, optional
+        Tolerance for numeric comparisons when eliding, by default the
+        tolerance set for the keyword
+    logger : DDOILoggerClient, optional
+        Logger for elision messages, by default None
+
+    Returns
+    -------
+    bool
+        True if the write was sent, False if it was elided
+
+    Raises
+    ------
+    DDOIServiceUnavailable
+        If the circuit breaker of the service is open
+    """
+    if tracing.tracer is None:
+        return _write(service, keyword, value, wait, timeout, elide,
+                      tolerance, logger)
+    with tracing.tracer.span(f"ktl write {service}.{keyword}", 'ktl',
+                             service=service, keyword=keyword,
+                             value=str(value)) as span:
+        written = _write(service, keyword, value, wait, timeout, elide,
+                         tolerance, logger)
+        span.args['elided'] = not written
+        return written
+
+
+def _write(service, keyword, value, wait, timeout, elide, tolerance, logger):
+    if elide and elision.matches(service, keyword, value, timeout, tolerance):
+        saved = elision.record_elided(service, keyword)
+        if logger:
+            logger.debug(f"KTL write elided: {service} {keyword} already "
+                         f"{value} (saved ~{saved:.3f} s)")
+        return False
+
+    limiters.acquire(service, WRITE, timeout=timeout)
+    start = time.perf_counter()
+    _guarded(service, backend().write, service, keyword, value, wait=wait,
+             timeout=timeout)
+    if wait:
+        elision.record_write(service, keyword, time.perf_counter() - start)
+    return True
+
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return None
+
+
+class WriteElision:
+    """Per-keyword tolerances, write cost estimates and elision statistics
+    """
+
+    # Assumed cost of a write before one has been timed
+    default_write_cost = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tolerances = {}
+        # {(service, keyword): mean seconds of a completed write}
+        self.write_costs = {}
+        # {(service, keyword): mean seconds of a comparison read}
+        self.read_costs = {}
+        # {night: {(service, keyword): [writes elided, seconds saved]}}
+        self.nights = {}
+
+    @staticmethod
+    def _key(service, keyword):
+        return service.lower(), keyword.lower()
+
+    def set_tolerance(self, service, keyword, tolerance):
+        """Set the tolerance used to compare numeric values of a keyword
+        """
+        with self._lock:
+            self.tolerances[self._key(service, keyword)] = float(tolerance)
+
+    def load_config(self, cfg):
+        """Read tolerances from the [write_elision] section of a config
+
+        Parameters
+        ----------
+        cfg : configparser.ConfigParser
+            The config
+
+        Returns
+        -------
+        bool
+            The value of the 'enabled' option, False if there is no section
+        """
+        if cfg is None or not cfg.has_section('write_elision'):
+            return False
+        section = cfg['write_elision']
+        for name, val in section.items():
+            if '.' in name:
+                service, keyword = name.split('.', 1)
+                self.set_tolerance(service, keyword, val)
+        return section.getboolean('enabled', fallback=False)
+
+    def current_value(self, service, keyword, timeout):
+        """Return (binary, ascii) for a keyword, from the monitored value when
+        possible, otherwise from one read
+        """
+        kw = backend().cache(service, keyword)
+        if kw['monitored'] and kw['populated']:
+            return kw['binary'], kw['ascii']
+        limiters.acquire(service, READ, timeout=timeout)
+        start = time.perf_counter()
+        values = _guarded(service, kw.read, both=True, timeout=timeout)
+        self._average(self.read_costs, self._key(service, keyword),
+                      time.perf_counter() - start)
+        return values
+
+    def matches(self, service, keyword, value, timeout, tolerance=None):
+        """True if the keyword already holds value (within tolerance)
+        """
+        try:
+            current_bin, current_ascii = self.current_value(service, keyword,
+                                                            timeout)
+        except Exception:
+            # If the current value can't be read, just do the write
+            return False
+
+        if tolerance is None:
+            tolerance = self.tolerances.get(self._key(service, keyword), 0.0)
+
+        new_num = _as_number(value)
+        current_num = _as_number(current_bin)
+        if new_num is not None and current_num is not None:
+            return abs(new_num - current_num) <= tolerance
+        return str(value).strip() == str(current_ascii).strip()
+
+    def _average(self, costs, key, duration):
+        with self._lock:
+            previous = costs.get(key)
+            costs[key] = duration if previous is None \
+                else 0.8 * previous + 0.2 * duration
+
+    def record_write(self, service, keyword, duration):
+        """Update the cost estimate of a completed write"""
+        self._average(self.write_costs, self._key(service, keyword), duration)
+
+    def record_elided(self, service, keyword):
+        """Count an elided write, returning the estimated seconds saved"""
+        key = self._key(service, keyword)
+        night = observing_night()
+        with self._lock:
+            saved = self.write_costs.get(key, self.default_write_cost) \
+                - self.read_costs.get(key, 0.0)
+            saved = max(saved, 0.0)
+            counts = self.nights.setdefault(night, {}).setdefault(key, [0, 0.0])
+            counts[0] += 1
+            counts[1] += saved
+        return saved
+
+    def stats(self, night=None):
+        """Elision statistics for a night
+
+        Parameters
+        ----------
+        night : str, optional
+            Night as returned by observing_night(), by default tonight
+
+        Returns
+        -------
+        dict
+            writes_elided, seconds_saved and a by_keyword breakdown
+        """
+        if night is None:
+            night = observing_night()
+        with self._lock:
+            counts = {f"{serv}.{kw}": tuple(val) for (serv, kw), val
+                      in self.nights.get(night, {}).items()}
+        return {
+            'night': night,
+            'writes_elided': sum(val[0] for val in counts.values()),
+            'seconds_saved': sum(val[1] for val in counts.values()),
+            'by_keyword': counts,
+        }
+
+
+elision = WriteElision()
+
+
+def set_elision_tolerance(service, keyword, tolerance):
+    """Set the numeric tolerance used when eliding writes to a keyword"""
+    elision.set_tolerance(service, keyword, tolerance)
+
+
+def elision_stats(night=None):
+    """Writes elided and seconds saved for a night, see WriteElision.stats"""
+    return elision.stats(night)
+
+
+def elision_enabled(cfg, default=False):
+    """The 'enabled' option of the [write_elision] section of a config
+
+    Parameters
+    ----------
+    cfg : configparser.ConfigParser or None
+        The config
+    default : bool, optional
+        Value without the option, by default False
+    """
+    if cfg is None:
+        return default
+    return cfg.getboolean('write_elision', 'enabled', fallback=default)
+
+
+# Settings of the config last applied by load_config
+_applied_config = None
+_applied_config_lock = threading.Lock()
+
+CONFIG_SECTIONS = ('write_elision', 'circuit_breaker', 'rate_limit')
+
+
+def load_config(cfg):
+    """Apply the KTL access sections of a config (CONFIG_SECTIONS), unless
+    they are the settings already in effect
+
+    Parameters
+    ----------
+    cfg : configparser.ConfigParser or None
+        The config
+
+    Returns
+    -------
+    bool
+        True if the settings were applied
+    """
+    if cfg is None:
+        return False
+    key = tuple((section, tuple(cfg.items(section, raw=True)))
+                for section in CONFIG_SECTIONS if cfg.has_section(section))
+    if not key:
+        return False
+    global _applied_config
+    with _applied_config_lock:
+        # configs that alternate (A, B, A) are applied every time
+        if key == _applied_config:
+            return False
+        _applied_config = key
+        elision.load_config(cfg)
+        breakers.load_config(cfg)
+        limiters.load_config(cfg)
+    return True
@@ -0,0 +1,276 @@
+"""
+Simulated KTL services for running translator functions offline.
+
+``SimulatedKTL`` provides the part of the ``ktl`` interface used through
+``ktl_access`` (``read``, ``write``, ``cache`` keyword objects,
+``TimeoutException`` and ``ktlError``), backed by an in-memory keyword table.
+Instrument behaviour is modelled with write handlers, which can change other
+keywords right away or schedule changes on the clock (e.g. IMAGEDONE
+becoming 1 when an exposure started by GO has been read out).
+
+With ``install()`` all KTL access goes to the simulator and time becomes
+simulated (see ``clock.VirtualClock``), so sleeps and polling loops cost no
+real time:
+
+    sim = ktl_sim.install()
+    mosfire_model(sim)          # keywords and behaviour of the instrument
+    SequenceRunner(Expose, wait_function=MOSFIRE_WaitForExpose).run(OB)
+    ktl_sim.uninstall()
+"""
+
+import threading
+
+from ddoitranslatormodule import clock, ktl_access
+
+
+class TimeoutException(Exception):
+    pass
+
+
+class ktlError(Exception):
+    pass
+
+
+def _ascii(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+class SimKeyword:
+    """Keyword object returned by SimulatedKTL.cache
+    """
+
+    def __init__(self, sim, service, keyword):
+        self.sim = sim
+        self.service = service
+        self.name = keyword
+        self.monitored = False
+        self.callbacks = []
+
+    def read(self, binary=False, both=False, timeout=None):
+        return self.sim.read(self.service, self.name, timeout=timeout,
+                             binary=binary, both=both)
+
+    def write(self, value, wait=True, timeout=None, binary=False):
+        return self.sim.write(self.service, self.name, value, wait=wait,
+                              timeout=timeout)
+
+    def monitor(self, start=True, prime=True, wait=True):
+        self.monitored = bool(start)
+        if self.monitored and prime:
+            self.notify()
+
+    def callback(self, function, remove=False, preferred=False):
+        """Call function(keyword) on every change while monitored"""
+        if remove:
+            if function in self.callbacks:
+                self.callbacks.remove(function)
+        elif function not in self.callbacks:
+            self.callbacks.append(function)
+
+    def notify(self):
+        if not self.monitored or not self.sim.has(self.service, self.name):
+            return
+        for function in list(self.callbacks):
+            function(self)
+
+    def subscribe(self, start=True, prime=True):
+        self.monitor(start, prime)
+
+    def __getitem__(self, item):
+        if item == 'monitored':
+            return self.monitored
+        if item == 'populated':
+            return self.sim.has(self.service, self.name)
+        if item == 'binary':
+            return self.sim.get(self.service, self.name)
+        if item == 'ascii':
+            return _ascii(self.sim.get(self.service, self.name))
+        raise KeyError(item)
+
+    def __repr__(self):
+        return f"<SimKeyword {self.service}.{self.name}>"
+
+
+class SimulatedKTL:
+    """In-memory KTL services with scripted behaviour
+    """
+
+    TimeoutException = TimeoutException
+    ktlError = ktlError
+
+    def __init__(self, read_latency=0.0, write_latency=0.0, strict=True):
+        """Create empty services
+
+        Parameters
+        ----------
+        read_latency : float, optional
+            Seconds every read takes (on the clock), by default 0
+        write_latency : float, optional
+            Seconds every write with wait=True takes, by default 0
+        strict : bool, optional
+            Reading or writing a keyword that was never defined raises
+            ktlError, by default True
+        """
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.strict = strict
+        self._lock = threading.RLock()
+        self._values = {}
+        self._handlers = {}
+        self._keywords = {}
+        # (simulated time, service, keyword, value) of every write
+        self.writes = []
+        self.reads = 0
+        # {service: reads}
+        self.service_reads = {}
+
+    @staticmethod
+    def _key(service, keyword):
+        return service.lower(), keyword.upper()
+
+    # Direct access to the simulated state
+
+    def define(self, service, values):
+        """Define keywords of a service with their initial values
+
+        Parameters
+        ----------
+        service : str
+            Service name
+        values : dict
+            {keyword: value}
+        """
+        with self._lock:
+            for keyword, value in values.items():
+                self._values[self._key(service, keyword)] = value
+
+    def set(self, service, keyword, value):
+        """Change a keyword as the instrument would, without running the
+        write handlers"""
+        key = self._key(service, keyword)
+        with self._lock:
+            self._values[key] = value
+            kw = self._keywords.get(key)
+        if kw is not None:
+            kw.notify()
+
+    def set_later(self, delay, service, keyword, value):
+        """Change a keyword after delay seconds of (simulated) time"""
+        return clock.schedule(delay, self.set, service, keyword, value)
+
+    def get(self, service, keyword):
+        """Current value of a keyword"""
+        key = self._key(service, keyword)
+        with self._lock:
+            if key not in self._values:
+                raise ktlError(f"{service}.{keyword} is not defined")
+            return self._values[key]
+
+    def has(self, service, keyword):
+        with self._lock:
+            return self._key(service, keyword) in self._values
+
+    def on_write(self, service, keyword, handler):
+        """Model the instrument's reaction to a write
+
+        Parameters
+        ----------
+        service : str
+            Service name
+        keyword : str
+            Keyword name
+        handler : callable
+            Called as handler(sim, value) after the value was stored
+        """
+        with self._lock:
+            self._handlers.setdefault(self._key(service, keyword),
+                                      []).append(handler)
+
+    # ktl interface
+
+    def read(self, service, keyword, timeout=None, binary=False, both=False):
+        if self.read_latency:
+            clock.sleep(self.read_latency)
+        with self._lock:
+            self.reads += 1
+            service_name = service.lower()
+            self.service_reads[service_name] = \
+                self.service_reads.get(service_name, 0) + 1
+        value = self.get(service, keyword)
+        if both:
+            return value, _ascii(value)
+        return value if binary else _ascii(value)
+
+    def write(self, service, keyword, value, wait=True, timeout=None):
+        key = self._key(service, keyword)
+        with self._lock:
+            if self.strict and key not in self._values:
+                raise ktlError(f"{service}.{keyword} is not defined")
+            self._values[key] = value
+            self.writes.append((clock.time(), key[0], key[1], value))
+            handlers = list(self._handlers.get(key, ()))
+            kw = self._keywords.get(key)
+        if kw is not None:
+            kw.notify()
+        for handler in handlers:
+            handler(self, value)
+        if wait and self.write_latency:
+            clock.sleep(self.write_latency)
+        return True
+
+    def cache(self, service=None, keyword=None):
+        key = self._key(service, keyword)
+        with self._lock:
+            kw = self._keywords.get(key)
+            if kw is None:
+                kw = self._keywords[key] = SimKeyword(self, service, keyword)
+            return kw
+
+    def write_count(self, service=None, keyword=None):
+        """Number of writes, optionally of one service or keyword"""
+        with self._lock:
+            return sum(1 for _, serv, kw, _ in self.writes
+                       if (service is None or serv == service.lower())
+                       and (keyword is None or kw == keyword.upper()))
+
+
+_previous_clock = None
+
+
+def install(sim=None, virtual=True, start=None):
+    """Send all KTL access through a simulator, in simulated time
+
+    Parameters
+    ----------
+    sim : SimulatedKTL, optional
+        The simulator, by default a new empty one
+    virtual : bool, optional
+        Use a VirtualClock, by default True
+    start : datetime or float, optional
+        UT start time of the VirtualClock, by default now
+
+    Returns
+    -------
+    SimulatedKTL
+        The installed simulator
+    """
+    global _previous_clock
+    if sim is None:
+        sim = SimulatedKTL()
+    if virtual:
+        previous = clock.set_clock(clock.VirtualClock(start))
+        if _previous_clock is None:
+            _previous_clock = previous
+    ktl_access.set_backend(sim)
+    return sim
+
+
+def uninstall():
+    """Restore the real KTL backend and clock"""
+    global _previous_clock
+    ktl_access.set_backend(ktl_access.ktl)
+    if _previous_clock is not None:
+        clock.set_clock(_previous_clock)
+        _previous_clock = None
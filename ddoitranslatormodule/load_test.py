@@ -0,0 +1,449 @@
+"""
+Concurrent-client load test of the translator stack against ktl_sim.
+
+N client threads run a weighted mix of linking table entry points, either
+through ``cli_interface.main`` (linking table load, import, argument parsing,
+config loading and execution, as an operator's command) or with ``execute()``
+on functions resolved once (as a long running script).  All KTL access goes
+to one simulated dispatcher, optionally with a per-call latency.  Each
+concurrency level reports throughput, latency percentiles, errors and the
+dispatcher read and write rates per service:
+
+    python -m ddoitranslatormodule.load_test linking_table.yml \\
+        --entry "expose --exptime 1@1" --entry "status@5" \\
+        --model mymod.sim:model --clients 1,2,4,8 --requests 50
+
+Entries are "ENTRY_POINT [ARGS...]" with an optional "@weight".  Without a
+linking table the MOSFIRE example functions are run (``--demo``).  Clients
+are threads of one process sharing the simulator, so the results show lock
+and interpreter contention as well as dispatcher traffic.
+"""
+
+import sys
+import json
+import time
+import random
+import shlex
+import logging
+import importlib
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+
+from ddoitranslatormodule import ktl_sim
+from ddoitranslatormodule.execution_history import percentile
+
+CLI = 'cli'
+EXECUTE = 'execute'
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class MixEntry:
+    """One kind of request of the mix
+    """
+
+    def __init__(self, entry, argv=(), weight=1.0, function=None, args=None):
+        """Create an entry
+
+        Parameters
+        ----------
+        entry : str
+            Linking table entry point (a label if function is given)
+        argv : sequence of str, optional
+            Command line arguments of the entry point, by default none
+        weight : float, optional
+            Relative frequency in the mix, by default 1
+        function : class, optional
+            Function executed directly instead of resolving entry, execute
+            mode only, by default None
+        args : dict, optional
+            Arguments of function, by default parsed from argv
+        """
+        self.entry = entry
+        self.argv = list(argv)
+        self.weight = weight
+        self.function = function
+        self.args = args
+
+    @classmethod
+    def parse(cls, text):
+        """An entry from "ENTRY_POINT [ARGS...][@weight]" """
+        weight = 1.0
+        command, sep, tail = text.rpartition('@')
+        if sep and tail.replace('.', '', 1).isdigit():
+            text, weight = command, float(tail)
+        words = shlex.split(text)
+        if not words:
+            raise ValueError("Empty load test entry")
+        return cls(words[0], words[1:], weight)
+
+    @property
+    def label(self):
+        return " ".join([self.entry, *self.argv])
+
+    def __repr__(self):
+        return f"<MixEntry {self.label} @{self.weight}>"
+
+
+class LevelResult:
+    """Measurements of one concurrency level
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.latencies = []
+        # {exception type name: count}
+        self.errors = {}
+        # {entry label: [latencies]}
+        self.by_entry = {}
+        self.wall_time = 0.0
+        # {service: calls} of the simulated dispatcher
+        self.reads = {}
+        self.writes = {}
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """Requests completed per second"""
+        return self.requests / self.wall_time if self.wall_time else 0.0
+
+    def percentile(self, fraction):
+        """Latency percentile in seconds, fraction in [0, 1]"""
+        return percentile(sorted(self.latencies), fraction)
+
+    def call_rates(self):
+        """{service: (reads/s, writes/s)} of the dispatcher"""
+        wall = self.wall_time or 1.0
+        return {service: (self.reads.get(service, 0) / wall,
+                          self.writes.get(service, 0) / wall)
+                for service in sorted(set(self.reads) | set(self.writes))}
+
+    def as_dict(self):
+        return {
+            'clients': self.clients,
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'wall_time': self.wall_time,
+            'throughput': self.throughput,
+            'latency': {f"p{int(p * 100)}": self.percentile(p)
+                        for p in PERCENTILES} | {
+                'max': max(self.latencies, default=None)},
+            'entries': {label: {'requests': len(values),
+                                'p50': percentile(sorted(values), 0.5)}
+                        for label, values in self.by_entry.items()},
+            'dispatcher': {service: {'reads_per_s': reads,
+                                     'writes_per_s': writes}
+                           for service, (reads, writes)
+                           in self.call_rates().items()},
+        }
+
+
+class LoadReport:
+    """Results of every concurrency level of a load test
+    """
+
+    def __init__(self, mode, mix):
+        self.mode = mode
+        self.mix = mix
+        self.levels = []
+
+    def efficiency(self, level):
+        """Throughput per client relative to the single client level (1.0
+        is perfect scaling), None without a single client level"""
+        base = next((lvl for lvl in self.levels if lvl.clients == 1), None)
+        if base is None or not base.throughput:
+            return None
+        return level.throughput / (level.clients * base.throughput)
+
+    def as_dict(self):
+        return {'mode': self.mode,
+                'mix': [{'entry': entry.label, 'weight': entry.weight}
+                        for entry in self.mix],
+                'levels': [dict(level.as_dict(),
+                                efficiency=self.efficiency(level))
+                           for level in self.levels]}
+
+    def summary(self):
+        lines = [f"Load test ({self.mode}): "
+                 + ", ".join(f"{entry.label} x{entry.weight:g}"
+                             for entry in self.mix),
+                 f"{'clients':>7s} {'requests':>8s} {'errors':>6s} "
+                 f"{'req/s':>8s} {'p50 ms':>8s} {'p90 ms':>8s} "
+                 f"{'p99 ms':>8s} {'scaling':>7s}  dispatcher reads/writes "
+                 f"per s"]
+        for level in self.levels:
+            efficiency = self.efficiency(level)
+            scaling = f"{efficiency:7.2f}" if efficiency is not None \
+                else f"{'-':>7s}"
+            p50, p90, p99 = (level.percentile(p) for p in PERCENTILES)
+            rates = ", ".join(f"{service} {reads:.0f}/{writes:.0f}"
+                              for service, (reads, writes)
+                              in level.call_rates().items())
+            lines.append(
+                f"{level.clients:7d} {level.requests:8d} "
+                f"{sum(level.errors.values()):6d} {level.throughput:8.1f} "
+                f"{(p50 or 0) * 1000:8.1f} {(p90 or 0) * 1000:8.1f} "
+                f"{(p99 or 0) * 1000:8.1f} {scaling}  {rates}")
+            for name, count in level.errors.items():
+                lines.append(f"{'':>16s}{count} x {name}")
+        return "\n".join(lines)
+
+
+def _quiet_logger(name):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    return logger
+
+
+def load_model(spec):
+    """The simulator model function named "module:function" (or
+    "module.function")"""
+    module, sep, name = spec.partition(':')
+    if not sep:
+        module, _, name = spec.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+class LoadTest:
+    """Runs a mix of requests from concurrent clients against ktl_sim
+    """
+
+    def __init__(self, mix, table=None, mode=EXECUTE, model=None,
+                 read_latency=0.0, write_latency=0.0, virtual=False,
+                 logger=None, seed=0):
+        """Set up the test
+
+        Parameters
+        ----------
+        mix : list of MixEntry
+            The requests
+        table : str or Path, optional
+            Linking table the entry points are in, needed unless every entry
+            has a function, by default None
+        mode : str, optional
+            CLI to run every request through cli_interface.main, EXECUTE to
+            call execute() on functions resolved once, by default EXECUTE
+        model : callable, optional
+            Called with every new SimulatedKTL to define the keywords (e.g.
+            mosfire_model), by default None
+        read_latency, write_latency : float, optional
+            Seconds each dispatcher read / write takes, by default 0
+        virtual : bool, optional
+            Run on a VirtualClock, so function sleeps cost no real time, by
+            default False
+        logger : logging.Logger, optional
+            Logger given to the functions, by default a silent one
+        seed : int, optional
+            Seed of the request choice of the clients, by default 0
+        """
+        if mode not in (CLI, EXECUTE):
+            raise ValueError(f"Unknown load test mode {mode}")
+        if mode == CLI and table is None:
+            raise ValueError("The cli mode needs a linking table")
+        self.mix = list(mix)
+        self.table = Path(table) if table is not None else None
+        self.mode = mode
+        self.model = model
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.virtual = virtual
+        self.logger = logger if logger is not None \
+            else _quiet_logger('ddoi_load_test')
+        self.seed = seed
+        self._prepared = False
+
+    def _prepare(self):
+        """Resolve the entry points and parse their arguments once, as a
+        script would (execute mode)"""
+        if self._prepared or self.mode != EXECUTE:
+            return
+        from ddoitranslatormodule import cli_interface
+        table = None
+        for entry in self.mix:
+            if entry.function is not None:
+                if entry.args is None:
+                    entry.args = {}
+                continue
+            if table is None:
+                if self.table is None:
+                    raise ValueError(f"No linking table to resolve "
+                                     f"{entry.entry}")
+                table = cli_interface.LinkingTable(self.table, self.logger)
+            function, default_args, _ = cli_interface.get_linked_function(
+                table, entry.entry, self.logger)
+            argv = list(entry.argv)
+            for position, value in default_args:
+                argv.insert(position, str(value))
+            parser = function.add_cmdline_args(
+                ArgumentParser(prog=entry.entry, add_help=False))
+            entry.function = function
+            entry.args = vars(parser.parse_args(argv))
+        self._prepared = True
+
+    def _request(self, entry):
+        """Run one request, raise if it failed"""
+        if self.mode == EXECUTE:
+            entry.function.execute(dict(entry.args), self.logger)
+            return
+        from ddoitranslatormodule import cli_interface
+        try:
+            cli_interface.main(str(self.table), [entry.entry, *entry.argv])
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise RuntimeError(f"exit status {e.code}") from None
+
+    def _client(self, index, requests, barrier, result, lock):
+        rng = random.Random(self.seed + index)
+        choices = rng.choices(self.mix, [entry.weight for entry in self.mix],
+                              k=requests)
+        barrier.wait()
+        for entry in choices:
+            start = time.perf_counter()
+            error = None
+            try:
+                self._request(entry)
+            except Exception as e:
+                error = type(e).__name__
+            latency = time.perf_counter() - start
+            with lock:
+                result.latencies.append(latency)
+                result.by_entry.setdefault(entry.label, []).append(latency)
+                if error is not None:
+                    result.errors[error] = result.errors.get(error, 0) + 1
+
+    def run_level(self, clients, requests):
+        """Run one concurrency level on a fresh simulator
+
+        Parameters
+        ----------
+        clients : int
+            Number of concurrent clients
+        requests : int
+            Requests made by every client
+
+        Returns
+        -------
+        LevelResult
+        """
+        self._prepare()
+        if self.mode == CLI:
+            # cli_interface.create_logger keeps a logger that has handlers
+            _quiet_logger('cli_interface')
+        sim = ktl_sim.install(ktl_sim.SimulatedKTL(self.read_latency,
+                                                   self.write_latency),
+                              virtual=self.virtual)
+        result = LevelResult(clients)
+        try:
+            if self.model is not None:
+                self.model(sim)
+            barrier = threading.Barrier(clients + 1)
+            lock = threading.Lock()
+            threads = [threading.Thread(
+                target=self._client, name=f"load-client-{idx}",
+                args=(idx, requests, barrier, result, lock), daemon=True)
+                for idx in range(clients)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            result.wall_time = time.perf_counter() - start
+            result.reads = dict(sim.service_reads)
+            for _, service, _, _ in sim.writes:
+                result.writes[service] = result.writes.get(service, 0) + 1
+        finally:
+            ktl_sim.uninstall()
+        return result
+
+    def run(self, levels=(1, 2, 4, 8), requests=50):
+        """Run every concurrency level
+
+        Parameters
+        ----------
+        levels : sequence of int, optional
+            Numbers of concurrent clients, by default (1, 2, 4, 8)
+        requests : int, optional
+            Requests made by every client at each level, by default 50
+
+        Returns
+        -------
+        LoadReport
+        """
+        report = LoadReport(self.mode, self.mix)
+        for clients in levels:
+            report.levels.append(self.run_level(clients, requests))
+        return report
+
+
+def demo_mix():
+    """The MOSFIRE example functions: one exposure start for every three
+    readout checks"""
+    from ddoitranslatormodule.examples.mosfire.expose import Expose
+    from ddoitranslatormodule.examples.mosfire.waitfor_expose import MOSFIRE_WaitForExpose
+    args = {'exptime': 1, 'coadds': 1, 'sampmode': 'MCDS16',
+            'object': 'load test'}
+    return [MixEntry('expose', weight=1, function=Expose, args=args),
+            MixEntry('waitfor_expose', weight=3,
+                     function=MOSFIRE_WaitForExpose, args={})]
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Load test the translator stack "
+                                        "with concurrent clients")
+    parser.add_argument('table', nargs='?', help="linking table (.yml) of "
+                                                 "the entry points")
+    parser.add_argument('--entry', action='append', default=[],
+                        help='"ENTRY_POINT [ARGS...][@weight]", repeatable')
+    parser.add_argument('--demo', action='store_true',
+                        help="run the MOSFIRE example functions")
+    parser.add_argument('--mode', choices=(CLI, EXECUTE), default=EXECUTE,
+                        help="cli_interface.main or execute() per request")
+    parser.add_argument('--clients', default='1,2,4,8',
+                        help="comma separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=50,
+                        help="requests per client and level")
+    parser.add_argument('--model', help="module:function defining the "
+                                        "simulated keywords")
+    parser.add_argument('--read-latency', type=float, default=0.0,
+                        help="seconds per dispatcher read")
+    parser.add_argument('--write-latency', type=float, default=0.0,
+                        help="seconds per dispatcher write")
+    parser.add_argument('--virtual', action='store_true',
+                        help="simulated time, sleeps cost nothing")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model) if args.model else None
+    if args.demo or not args.table:
+        from ddoitranslatormodule.examples.mosfire.simulation import mosfire_model
+        mix = demo_mix()
+        model = model or mosfire_model
+        test = LoadTest(mix, model=model, read_latency=args.read_latency,
+                        write_latency=args.write_latency, virtual=True)
+    else:
+        if not args.entry:
+            parser.error("--entry is needed with a linking table")
+        mix = [MixEntry.parse(text) for text in args.entry]
+        test = LoadTest(mix, table=args.table, mode=args.mode, model=model,
+                        read_latency=args.read_latency,
+                        write_latency=args.write_latency,
+                        virtual=args.virtual)
+
+    levels = [int(level) for level in args.clients.split(',')]
+    report = test.run(levels, args.requests)
+    print(report.summary())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report.as_dict(), f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,476 @@
+"""
+Buffered, batching logging client for remote log services.
+
+A function's ``logger.info`` should never wait on the logging service.
+``BatchingLogClient`` has the logger interface ``execute()`` expects (the
+``DDOILoggerClient`` methods and the ``logging.Logger`` ones), but only puts
+records on a bounded queue.  A background thread ships them in batches,
+bounded by size and by age, through a sender:
+
+* ``ClientSender`` forwards the records to an existing client (a
+  ``DDOILoggerClient`` or a ``logging.Logger``), one call per record, off the
+  control path.
+* ``SocketSender`` writes each batch as JSON lines to a TCP log service in
+  one send, optionally waiting for the service to acknowledge it.
+
+When the service is slower than the functions log, the queue fills up and the
+client either drops records (the default) or blocks the caller for at most
+``block_timeout`` before dropping.  Both are counted in ``stats()``.
+
+``LocalLogServer`` is a stand-in log service (with an optional latency per
+batch) for trying the client out:
+
+    server = LocalLogServer(delay=0.2).start()
+    logger = BatchingLogClient(SocketSender(*server.address))
+    Expose.execute(args, logger)
+    logger.close()
+
+Run this module to compare direct and batched logging to a slow service:
+
+    python -m ddoitranslatormodule.log_shipper
+"""
+
+import sys
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+import traceback
+import socketserver
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+          'warning': logging.WARNING, 'error': logging.ERROR,
+          'critical': logging.CRITICAL}
+
+
+class ShippedRecord:
+    """A log record waiting to be shipped
+    """
+    __slots__ = ('time', 'level', 'message')
+
+    def __init__(self, time, level, message):
+        self.time = time
+        self.level = level
+        self.message = message
+
+    def as_dict(self):
+        return {'time': self.time, 'level': self.level,
+                'message': self.message}
+
+
+class ClientSender:
+    """Ships records by calling the level method of another logger client
+    """
+
+    def __init__(self, client):
+        """
+        Parameters
+        ----------
+        client : DDOILoggerClient or logging.Logger
+            Client the records are forwarded to
+        """
+        self.client = client
+
+    def __call__(self, batch):
+        for record in batch:
+            method = getattr(self.client, record.level, None)
+            if method is None and record.level == 'warning':
+                method = getattr(self.client, 'warn')
+            method(record.message)
+
+    def close(self):
+        pass
+
+
+class SocketSender:
+    """Ships each batch as JSON lines over a TCP connection, reconnecting
+    when the connection is lost.  With ack, a blank line ends each batch and
+    the call returns once the service has answered it with one.
+    """
+
+    def __init__(self, host, port, timeout=2.0, source=None, ack=False):
+        """
+        Parameters
+        ----------
+        host : str
+            Host of the log service
+        port : int
+            Port of the log service
+        timeout : float, optional
+            Seconds to connect and to send a batch, by default 2.0
+        source : str, optional
+            Added to every record, by default the host name
+        ack : bool, optional
+            Wait for the service to acknowledge each batch, by default False
+        """
+        self.address = (host, port)
+        self.timeout = timeout
+        self.source = source or socket.gethostname()
+        self.ack = ack
+        self._sock = None
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address, self.timeout)
+            self._sock.settimeout(self.timeout)
+        return self._sock
+
+    def __call__(self, batch):
+        data = ''.join(json.dumps(dict(record.as_dict(), source=self.source))
+                       + '\n' for record in batch).encode()
+        if self.ack:
+            data += b'\n'
+        try:
+            sock = self._connect()
+            sock.sendall(data)
+            if self.ack and not sock.recv(1):
+                raise ConnectionError("log service closed the connection")
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+
+class BatchingLogClient:
+    """Logger client that queues records and ships them in batches from a
+    background thread
+    """
+
+    def __init__(self, sender, max_batch=200, max_delay=0.5, max_queue=10000,
+                 block=False, block_timeout=0.05, level=logging.DEBUG,
+                 retries=1):
+        """Start the client
+
+        Parameters
+        ----------
+        sender : callable
+            Called with each batch (a list of ShippedRecord), e.g.
+            ClientSender or SocketSender.  An exception fails the batch.
+        max_batch : int, optional
+            Records per batch at most, by default 200
+        max_delay : float, optional
+            Seconds a record waits for its batch to fill, by default 0.5
+        max_queue : int, optional
+            Records buffered before the queue is full, by default 10000
+        block : bool, optional
+            Wait (at most block_timeout) for space when the queue is full
+            instead of dropping the record right away, by default False
+        block_timeout : float, optional
+            Seconds a log call can block, by default 0.05
+        level : int, optional
+            Records below this level are ignored, by default logging.DEBUG
+        retries : int, optional
+            Times a failed batch is sent again before it is dropped, by
+            default 1
+        """
+        self.sender = sender
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.block = block
+        self.block_timeout = block_timeout
+        self.level = level
+        self.retries = retries
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._counters = {'queued': 0, 'sent': 0, 'dropped_full': 0,
+                          'dropped_failed': 0, 'batches': 0, 'send_errors': 0,
+                          'blocked': 0, 'blocked_time': 0.0,
+                          'max_queue_depth': 0}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="log-shipper")
+        self._thread.start()
+
+    # Logger interface
+
+    def log(self, level, msg, *args, **kwargs):
+        if isinstance(level, int):
+            level = logging.getLevelName(level).lower()
+        if LEVELS.get(level, logging.INFO) < self.level or self._closed:
+            return
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = f"{msg} {args}"
+        if kwargs.get('exc_info'):
+            msg = f"{msg}\n{traceback.format_exc()}"
+        self._put(ShippedRecord(time.time(), level, str(msg)))
+
+    def debug(self, msg, *args, **kwargs):
+        self.log('debug', msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log('info', msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log('warning', msg, *args, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        self.log('error', msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self.log('critical', msg, *args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs['exc_info'] = True
+        self.log('error', msg, *args, **kwargs)
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if not self.block:
+                self._count('dropped_full')
+                return
+            start = time.perf_counter()
+            try:
+                self._queue.put(record, timeout=self.block_timeout)
+            except queue.Full:
+                self._count('dropped_full')
+                return
+            finally:
+                with self._lock:
+                    self._counters['blocked'] += 1
+                    self._counters['blocked_time'] += \
+                        time.perf_counter() - start
+        with self._lock:
+            self._counters['queued'] += 1
+            depth = self._queue.qsize()
+            if depth > self._counters['max_queue_depth']:
+                self._counters['max_queue_depth'] = depth
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    # Shipping
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, events = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    # flush() marker: ship what we have now
+                    events.append(item)
+                    break
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.max_batch:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._ship(batch)
+            for event in events:
+                event.set()
+        close = getattr(self.sender, 'close', None)
+        if close is not None:
+            close()
+
+    def _ship(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.sender(batch)
+            except Exception:
+                self._count('send_errors')
+                continue
+            with self._lock:
+                self._counters['sent'] += len(batch)
+                self._counters['batches'] += 1
+            return
+        self._count('dropped_failed', len(batch))
+
+    def flush(self, timeout=5):
+        """Wait until the records logged so far are shipped
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait at most, by default 5
+
+        Returns
+        -------
+        bool
+            True if everything was shipped (or dropped) in time
+        """
+        if not self._thread.is_alive():
+            return False
+        event = threading.Event()
+        try:
+            self._queue.put(event, timeout=timeout)
+        except queue.Full:
+            return False
+        return event.wait(timeout)
+
+    def close(self, timeout=5):
+        """Ship the queued records and stop the background thread"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Counters of the client
+
+        Returns
+        -------
+        dict
+            queued, sent, dropped_full (queue full), dropped_failed (sender
+            failed), batches, send_errors, blocked (calls that waited for
+            space), blocked_time, max_queue_depth and queue_depth
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+
+class _LogHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server.log_server
+        pending = b''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            records = []
+            acks = 0
+            for line in lines:
+                if not line.strip():
+                    # end of a batch to acknowledge (SocketSender ack=True)
+                    acks += 1
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+            if server.delay:
+                # a slow service, taking delay per batch (per network read
+                # from senders that do not mark their batches)
+                time.sleep(server.delay * max(acks, 1))
+            with server.lock:
+                server.records.extend(records)
+            if acks:
+                self.request.sendall(b'\n' * acks)
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalLogServer:
+    """Stand-in log service receiving JSON lines over TCP
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        """
+        Parameters
+        ----------
+        host : str, optional
+            Interface to listen on, by default '127.0.0.1'
+        port : int, optional
+            Port, by default a free one
+        delay : float, optional
+            Seconds the service takes per batch, by default 0
+        """
+        self.delay = delay
+        self.records = []
+        self.lock = threading.Lock()
+        self._server = _ThreadingServer((host, port), _LogHandler)
+        self._server.log_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True, name="local-log-server")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def benchmark(n=500, delay=0.002):
+    """Time n records logged to a service taking delay seconds per batch,
+    directly (one acknowledged send per record) and through
+    BatchingLogClient (acknowledged batches)
+
+    Returns
+    -------
+    dict
+        Seconds spent in the log calls ('direct', 'batched'), seconds until
+        the service acknowledged every record ('direct_shipped',
+        'batched_shipped'), and the client's stats
+    """
+    results = {}
+    server = LocalLogServer(delay=delay).start()
+    host, port = server.address
+
+    # direct: every call waits for the service, as a request/reply client
+    sender = SocketSender(host, port, ack=True)
+    start = time.perf_counter()
+    for i in range(n):
+        sender([ShippedRecord(time.time(), 'info', f"direct {i}")])
+    results['direct'] = results['direct_shipped'] = \
+        time.perf_counter() - start
+    sender.close()
+
+    client = BatchingLogClient(SocketSender(host, port, ack=True))
+    start = time.perf_counter()
+    for i in range(n):
+        client.info(f"batched {i}")
+    results['batched'] = time.perf_counter() - start
+    client.flush()
+    results['batched_shipped'] = time.perf_counter() - start
+    client.close()
+    results['stats'] = client.stats()
+    server.stop()
+    return results
+
+
+if __name__ == "__main__":
+    res = benchmark()
+    for name in ('direct', 'batched'):
+        print(f"{name + ':':<8} {res[name] * 1000:8.1f} ms in log calls, "
+              f"{res[name + '_shipped'] * 1000:8.1f} ms until shipped")
+    print(f"stats:   {res['stats']}")
+    sys.exit(0)
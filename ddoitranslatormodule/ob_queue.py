@@ -0,0 +1,550 @@
+"""
+Queue executor running a night's OBs in one process, with look-ahead.
+
+``OBQueueExecutor`` takes an ordered queue of OBs (dicts or OB files) and runs
+every sequence of each with ``SequenceRunner``.  While an OB is running, a
+prefetch thread prepares the next ones in queue order: it parses the OB file,
+resolves and imports the linked function, loads (and so caches) its configs,
+maps every sequence through ``map_OB`` and validates the arguments against
+the compiled schema.  When the running OB finishes, the next one starts
+straight from its prepared sequences; an OB whose arguments do not validate
+is reported and passed over without touching the instrument.
+
+The queue can be changed while it runs: ``add`` more OBs, ``set_priority``
+(higher runs first, queue order among equals), ``skip`` an OB (cancelling it
+if it is the one running) or ``stop`` after the current OB.
+
+    executor = OBQueueExecutor(Expose, wait_function=MOSFIRE_WaitForExpose,
+                               logger=logger)
+    for path in tonight:
+        executor.add(path)
+    report = executor.run()
+    logger.info(report.summary())
+
+Functions can also be given as linking table entry points, with
+``table=LinkingTable(...)``.
+"""
+
+import time
+import itertools
+import threading
+import contextvars
+from pathlib import Path
+from logging import getLogger
+
+from ddoitranslatormodule.argspec import compiled_schema
+from ddoitranslatormodule.cli_interface import get_linked_function
+from ddoitranslatormodule.execution_context import add_observer, remove_observer
+from ddoitranslatormodule.ob_validation import parse_obs, ob_id
+from ddoitranslatormodule.sequence_runner import SequenceRunner, sequence_numbers
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIExecutionCancelled, DDOIInvalidArguments
+
+# States of a queued OB
+QUEUED = 'queued'
+PREPARING = 'preparing'
+READY = 'ready'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+INVALID = 'invalid'
+SKIPPED = 'skipped'
+# States of OBs that will not run (again)
+FINISHED = (DONE, FAILED, INVALID, SKIPPED)
+
+# The QueuedOB being run, seen by the executions it starts (also in the
+# threads SequenceRunner prepares sequences in)
+_running = contextvars.ContextVar('ddoi_queued_ob', default=None)
+
+
+class QueuedOB:
+    """An OB in the queue, and what is known about it so far
+    """
+
+    def __init__(self, key, OB=None, source=None, priority=0, function=None,
+                 order=0):
+        self.key = key
+        self.OB = OB
+        self.source = source
+        self.priority = priority
+        self.function = function
+        self.order = order
+        self.state = QUEUED
+        # Filled in by the preparation
+        self.resolved = None
+        self.sequences = None
+        self.errors = []
+        self.prepare_time = None
+        self.prefetched = False
+        # Filled in by the run
+        self.report = None
+        self.error = None
+        self.transition = None
+        self.contexts = set()
+
+    def __repr__(self):
+        return f"<QueuedOB {self.key} {self.state}>"
+
+    def as_dict(self):
+        report = self.report
+        return {'key': self.key, 'source': self.source, 'state': self.state,
+                'priority': self.priority, 'errors': list(self.errors),
+                'error': str(self.error) if self.error else None,
+                'prefetched': self.prefetched,
+                'prepare_time': self.prepare_time,
+                'transition': self.transition,
+                'sequences': len(report.sequences) if report else 0,
+                'wall_time': report.wall_time if report else None}
+
+
+class QueueReport:
+    """Outcome of an OBQueueExecutor run
+    """
+
+    def __init__(self):
+        self.obs = []
+        self.wall_time = 0.0
+
+    def count(self, state):
+        return sum(1 for entry in self.obs if entry.state == state)
+
+    @property
+    def transition_time(self):
+        """Seconds spent between the end of one OB and the start of the
+        next"""
+        return sum(entry.transition or 0.0 for entry in self.obs)
+
+    def summary(self):
+        states = ', '.join(f"{self.count(state)} {state}"
+                           for state in FINISHED if self.count(state))
+        return f"{len(self.obs)} OBs in {self.wall_time:.2f} s ({states}), " \
+               f"{self.transition_time:.3f} s between OBs"
+
+
+class OBQueueExecutor:
+    """Runs a queue of OBs, preparing the next ones while the current one
+    runs
+    """
+
+    def __init__(self, function, wait_function=None, logger=None, cfg=None,
+                 wait_cfg=None, timeout=None, overlap=True, table=None,
+                 lookahead=1, stop_on_error=False, checkpoints=None,
+                 resume=False):
+        """Create the executor
+
+        Parameters
+        ----------
+        function : class or str
+            TranslatorModuleFunction run for every sequence, or its entry
+            point in table
+        wait_function : class or str, optional
+            Function waiting for each sequence's readout, by default None
+        logger : DDOILoggerClient, optional
+            The logger to use, by default the root logger
+        cfg : filepath or ConfigParser, optional
+            Config of function, by default its default
+        wait_cfg : filepath or ConfigParser, optional
+            Config of wait_function, by default its default
+        timeout : float, optional
+            Seconds allowed for each execution, by default None
+        overlap : bool, optional
+            Overlap the sequences of an OB (see SequenceRunner), by default
+            True
+        table : LinkingTable, optional
+            Table the entry points are resolved in, by default None
+        lookahead : int, optional
+            Number of OBs prepared ahead of the running one, by default 1
+        stop_on_error : bool, optional
+            Stop the queue when an OB fails, by default False
+        checkpoints : checkpoint.CheckpointStore, optional
+            Where the completed sequences are recorded, by default None
+        resume : bool, optional
+            Skip the sequences of each OB completed by an earlier run (see
+            SequenceRunner), by default False
+        """
+        self.function = function
+        self.wait_function = wait_function
+        self.logger = logger if logger is not None else getLogger("")
+        self.cfg = cfg
+        self.wait_cfg = wait_cfg
+        self.timeout = timeout
+        self.overlap = overlap
+        self.table = table
+        self.lookahead = lookahead
+        self.stop_on_error = stop_on_error
+        self.checkpoints = checkpoints
+        self.resume = resume
+        self.report = None
+        self._entries = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._functions = {}
+        self._prefetcher = None
+        self._stopping = False
+        self._closed = False
+
+    # The queue
+
+    def add(self, OB, priority=0, function=None, key=None):
+        """Append an OB to the queue
+
+        Parameters
+        ----------
+        OB : dict, str or Path
+            The OB, or an OB file (.json, .yml, .yaml).  Every further OB in
+            the file is queued right after the first.
+        priority : int, optional
+            Higher priorities run first, by default 0
+        function : class or str, optional
+            Function of this OB, by default the executor's
+        key : str, optional
+            Name to refer to the OB by, by default its id or file name
+
+        Returns
+        -------
+        str
+            The key of the queued OB
+        """
+        with self._cond:
+            order = next(self._order)
+            if isinstance(OB, dict):
+                source = None
+                key = key or ob_id(OB, order)
+            else:
+                source, OB = str(OB), None
+                key = key or Path(source).name
+            key = self._unique(key)
+            self._entries.append(QueuedOB(key, OB, source, priority,
+                                          function, order))
+            self._cond.notify_all()
+        return key
+
+    def _unique(self, key):
+        keys = {entry.key for entry in self._entries}
+        if key not in keys:
+            return key
+        for n in itertools.count(2):
+            if f"{key}.{n}" not in keys:
+                return f"{key}.{n}"
+
+    def _entry(self, key):
+        for entry in self._entries:
+            if entry.key == key:
+                return entry
+        raise KeyError(key)
+
+    def set_priority(self, key, priority):
+        """Change the priority of a queued OB
+
+        Parameters
+        ----------
+        key : str
+            Key returned by add
+        priority : int
+            Higher priorities run first
+        """
+        with self._cond:
+            self._entry(key).priority = priority
+            self._cond.notify_all()
+
+    def skip(self, key, reason="skipped"):
+        """Take an OB out of the queue.  If it is running, its executions
+        are cancelled.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by add
+        reason : str, optional
+            Cancellation reason, by default "skipped"
+
+        Returns
+        -------
+        bool
+            False if the OB had already finished
+        """
+        with self._cond:
+            entry = self._entry(key)
+            if entry.state in FINISHED:
+                return False
+            if entry.state == RUNNING:
+                entry.error = reason
+                for ctx in list(entry.contexts):
+                    ctx.cancel(reason)
+            else:
+                entry.state = SKIPPED
+            self._cond.notify_all()
+        self.logger.info(f"Queue: skipping {key} ({reason})")
+        return True
+
+    def stop(self):
+        """Stop the run after the current OB"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def close(self):
+        """Let run() return once the queue is empty, when it was started with
+        wait=True"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def pending(self):
+        """Keys of the OBs still to run, in the order they would run"""
+        with self._cond:
+            return [entry.key for entry in self._upcoming()]
+
+    def status(self):
+        """State of every OB in the queue, in the order they were added
+
+        Returns
+        -------
+        list
+            One dict per OB (see QueuedOB.as_dict)
+        """
+        with self._cond:
+            return [entry.as_dict() for entry in self._entries]
+
+    def _upcoming(self):
+        """OBs still to run, in run order (caller holds the lock)"""
+        waiting = [entry for entry in self._entries
+                   if entry.state in (QUEUED, PREPARING, READY)]
+        return sorted(waiting, key=lambda entry: (-entry.priority,
+                                                  entry.order))
+
+    # Preparation
+
+    def _resolve(self, function):
+        """The function class of a class or an entry point, imported once"""
+        if not isinstance(function, str):
+            return function
+        if function not in self._functions:
+            if self.table is None:
+                raise DDOIInvalidArguments(
+                    f"Entry point {function} given without a linking table")
+            resolved, _, _ = get_linked_function(self.table, function,
+                                                 self.logger)
+            if resolved is None:
+                raise ImportError(f"Failed to import {function}")
+            self._functions[function] = resolved
+        return self._functions[function]
+
+    @staticmethod
+    def _warm(function, cfg, args):
+        """Load the config of a function as execute() would and return the
+        compiled schema of its arguments (both cached for the run)"""
+        if cfg is None:
+            cfg = function._cfg_location(function, args=args)[0]
+        cfg = function._load_config(function, cfg, args=args)
+        return compiled_schema(function, cfg)
+
+    def _prepare(self, entry):
+        """Parse, resolve, map and validate an OB; fills in entry.resolved,
+        entry.sequences and entry.errors"""
+        start = time.perf_counter()
+        errors = []
+        if entry.OB is None:
+            path = Path(entry.source)
+            obs = parse_obs(path.read_text(), path.suffix)
+            if not obs:
+                raise DDOIInvalidArguments(f"No OB in {entry.source}")
+            entry.OB = obs[0]
+            with self._cond:
+                # the other OBs of the file run right after this one
+                position = self._entries.index(entry) + 1
+                for index, OB in enumerate(obs[1:], 1):
+                    extra = QueuedOB(
+                        self._unique(f"{entry.key}#{index}"), OB,
+                        entry.source, entry.priority, entry.function,
+                        entry.order + index / len(obs))
+                    self._entries.insert(position, extra)
+                    position += 1
+
+        function = self._resolve(entry.function or self.function)
+        sequences = [(num, function.map_OB(entry.OB, num, cfg=self.cfg))
+                     for num in sequence_numbers(entry.OB)]
+
+        schema = None
+        for num, args in sequences:
+            if schema is None:
+                schema = self._warm(function, self.cfg, args)
+            if schema is None or not function.validate_args:
+                break
+            try:
+                schema.validate(args)
+            except DDOIInvalidArguments as e:
+                errors.append(f"sequence {num}: {e}")
+
+        wait_function = self.wait_function
+        if wait_function is not None:
+            wait_function = self._resolve(wait_function)
+            if sequences:
+                self._warm(wait_function, self.wait_cfg, sequences[0][1])
+
+        entry.resolved = (function, wait_function)
+        entry.sequences = sequences
+        entry.errors = errors
+        entry.prepare_time = time.perf_counter() - start
+
+    def _prepare_entry(self, entry, prefetch):
+        """Prepare an entry the caller moved to PREPARING"""
+        try:
+            self._prepare(entry)
+            state = INVALID if entry.errors else READY
+        except Exception as e:
+            entry.errors = [f"{type(e).__name__}: {e}"]
+            state = INVALID
+        with self._cond:
+            if entry.state != PREPARING:
+                return
+            entry.state = state
+            entry.prefetched = prefetch
+            self._cond.notify_all()
+        if state == INVALID:
+            self.logger.error(f"Queue: {entry.key} is invalid and will not "
+                              f"run: {'; '.join(entry.errors)}")
+
+    def _prefetch(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping or self._prefetcher is None:
+                        return
+                    entry = next((entry for entry in
+                                  self._upcoming()[:self.lookahead + 1]
+                                  if entry.state == QUEUED), None)
+                    if entry is not None:
+                        entry.state = PREPARING
+                        break
+                    self._cond.wait()
+            self.logger.debug(f"Queue: preparing {entry.key}")
+            self._prepare_entry(entry, prefetch=True)
+
+    # Running
+
+    def _next(self, wait):
+        """Take the next OB to run, waiting for its preparation; None when
+        the run is over"""
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return None
+                    upcoming = self._upcoming()
+                    if not upcoming:
+                        if not wait or self._closed:
+                            return None
+                        self._cond.wait()
+                        continue
+                    entry = upcoming[0]
+                    if entry.state == PREPARING:
+                        # the prefetch thread is on it
+                        self._cond.wait()
+                        continue
+                    if entry.state == READY:
+                        entry.state = RUNNING
+                        return entry
+                    entry.state = PREPARING
+                    break
+            # not prefetched (yet): prepare it here
+            self._prepare_entry(entry, prefetch=False)
+            with self._cond:
+                if entry.state == READY:
+                    entry.state = RUNNING
+                    return entry
+
+    def on_start(self, ctx):
+        entry = _running.get()
+        if entry is not None:
+            with self._cond:
+                entry.contexts.add(ctx)
+                cancelled = entry.error is not None
+            if cancelled:
+                ctx.cancel(entry.error)
+
+    def on_finish(self, ctx, error):
+        entry = _running.get()
+        if entry is not None:
+            with self._cond:
+                entry.contexts.discard(ctx)
+
+    def _run_entry(self, entry):
+        function, wait_function = entry.resolved
+        runner = SequenceRunner(function, wait_function=wait_function,
+                                logger=self.logger, cfg=self.cfg,
+                                wait_cfg=self.wait_cfg, timeout=self.timeout,
+                                overlap=self.overlap,
+                                checkpoints=self.checkpoints,
+                                resume=self.resume)
+        token = _running.set(entry)
+        try:
+            self.logger.info(f"Queue: running {entry.key} "
+                             f"({len(entry.sequences)} sequences)")
+            entry.report = runner.run(entry.OB, entry.sequences)
+            state = DONE
+        except DDOIExecutionCancelled as e:
+            entry.report = runner.report
+            state = SKIPPED if entry.error is not None else FAILED
+            entry.error = entry.error or e
+        except Exception as e:
+            entry.report = runner.report
+            entry.error = e
+            state = FAILED
+            self.logger.error(f"Queue: {entry.key} failed: {type(e).__name__}: {e}")
+        finally:
+            _running.reset(token)
+        with self._cond:
+            entry.state = state
+            self._cond.notify_all()
+        return state
+
+    def run(self, wait=False):
+        """Run the queue in priority order
+
+        Parameters
+        ----------
+        wait : bool, optional
+            When the queue is empty, wait for more OBs until close() or
+            stop() is called, by default False (return)
+
+        Returns
+        -------
+        QueueReport
+            The OBs run, in the order they ran, then the ones skipped or
+            found invalid.  Also kept in self.report.
+        """
+        report = self.report = QueueReport()
+        start = time.perf_counter()
+        with self._cond:
+            self._stopping = False
+            self._prefetcher = threading.Thread(
+                target=contextvars.copy_context().run, args=(self._prefetch,),
+                daemon=True, name="ob-prefetch")
+        self._prefetcher.start()
+        add_observer(self)
+        try:
+            finished = time.perf_counter()
+            while True:
+                entry = self._next(wait)
+                if entry is None:
+                    break
+                entry.transition = time.perf_counter() - finished
+                report.obs.append(entry)
+                state = self._run_entry(entry)
+                finished = time.perf_counter()
+                report.wall_time = finished - start
+                if state == FAILED and self.stop_on_error:
+                    break
+        finally:
+            remove_observer(self)
+            with self._cond:
+                prefetcher, self._prefetcher = self._prefetcher, None
+                self._cond.notify_all()
+            prefetcher.join()
+            # OBs passed over without running
+            report.obs.extend(entry for entry in self._entries
+                              if entry.state in (SKIPPED, INVALID)
+                              and entry not in report.obs)
+        report.wall_time = time.perf_counter() - start
+        self.logger.info(f"Queue: {report.summary()}")
+        return report
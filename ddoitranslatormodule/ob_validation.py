@@ -0,0 +1,348 @@
+"""
+Bulk validation of OBs against the argument specs of translator functions.
+
+Every sequence of every OB is expanded through the target function's
+``map_OB`` and the resulting arguments are checked against the function's
+argument spec (``add_cmdline_args`` and ``min_args``, see ``argspec``) and the
+preset arguments of its linking table entry.  OB files are spread over a
+process pool, so a night (or a semester) of OBs can be checked before
+observing instead of failing in ``perform``.
+
+    python -m ddoitranslatormodule.ob_validation linking_table.yml expose \\
+        /path/to/obs/ -o report.json
+
+Sources can be OB files (.json, .yml, .yaml, holding one OB or a list of
+OBs), directories searched recursively for such files, or ``-`` for a stream
+of OBs on stdin (JSON lines, a JSON list, or YAML documents; ``--format``
+selects the parser, by default guessed from the first character).  Sources
+that cannot be parsed are reported as invalid.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from ddoitranslatormodule.argspec import function_arg_spec, check_args
+from ddoitranslatormodule.cli_interface import LinkingTable, get_linked_function
+from ddoitranslatormodule.sequence_runner import sequence_numbers
+
+OB_SUFFIXES = ('.json', '.yml', '.yaml')
+
+# Suffix passed to parse_obs for each --format of stdin
+STREAM_FORMATS = {'auto': None, 'json': '.json', 'yaml': '.yaml'}
+
+# Per process state of the validation workers
+_worker = {}
+
+
+def find_ob_files(paths):
+    """Expand files and directories into the list of OB files to check
+
+    Parameters
+    ----------
+    paths : list
+        Files and directories
+
+    Returns
+    -------
+    list
+        Paths of the OB files, sorted within each directory
+    """
+    files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob('*')
+                                if p.suffix.lower() in OB_SUFFIXES))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_obs(text, suffix='.json'):
+    """Parse the OBs held in a file or stream
+
+    Parameters
+    ----------
+    text : str
+        The file contents
+    suffix : str or None, optional
+        File suffix, selecting the YAML or JSON parser, by default '.json'.
+        None guesses: JSON if the text starts with [ or {, YAML otherwise.
+
+    Returns
+    -------
+    list
+        The OBs
+    """
+    if suffix is None:
+        suffix = '.json' if text.lstrip()[:1] in ('[', '{') else '.yaml'
+    if suffix.lower() in ('.yml', '.yaml'):
+        obs = []
+        for doc in yaml.safe_load_all(text):
+            obs.extend(doc if isinstance(doc, list) else [doc])
+        return [ob for ob in obs if ob is not None]
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # JSON lines
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+def ob_id(OB, index):
+    """A name to report an OB by"""
+    if isinstance(OB, dict):
+        for key in ('_id', 'ob_id', 'id'):
+            if key in OB:
+                return str(OB[key])
+        name = OB.get('metadata', {}).get('name') \
+            if isinstance(OB.get('metadata'), dict) else None
+        if name:
+            return str(name)
+    return f"#{index}"
+
+
+def _init_worker(table_loc, entry_point, cfg, entry_point_key, sys_path):
+    sys.path[:] = sys_path
+    logger = logging.getLogger(__name__)
+    _worker.clear()
+    _worker.update({
+        'table': LinkingTable(table_loc, logger),
+        'entry_point': entry_point,
+        'cfg': cfg,
+        'entry_point_key': entry_point_key,
+        'logger': logger,
+        'functions': {},
+    })
+
+
+def _resolve(entry_point):
+    """Import the function of an entry point and compile its spec, once per
+    worker process
+    """
+    functions = _worker['functions']
+    if entry_point not in functions:
+        try:
+            function, preset_args, _ = get_linked_function(
+                _worker['table'], entry_point, _worker['logger'])
+            if function is None:
+                raise ImportError(f"failed to import {entry_point}")
+            specs = function_arg_spec(function, _worker['cfg'], preset_args)
+            functions[entry_point] = (function, specs, None)
+        except Exception as e:
+            functions[entry_point] = (None, None, f"{type(e).__name__}: {e}")
+    return functions[entry_point]
+
+
+def _validate_ob(source, index, OB):
+    results = []
+    oid = ob_id(OB, index)
+    try:
+        observations = {obs['metadata']['sequence_number']: obs
+                        for obs in OB['observations']}
+        numbers = sequence_numbers(OB)
+    except Exception as e:
+        return [{'source': source, 'ob': oid, 'sequence': None,
+                 'entry_point': _worker['entry_point'], 'valid': False,
+                 'errors': [f"malformed OB: {type(e).__name__}: {e}"]}]
+
+    for num in numbers:
+        entry_point = _worker['entry_point']
+        key = _worker['entry_point_key']
+        if key:
+            entry_point = observations[num]['metadata'].get(key, entry_point)
+        function, specs, error = _resolve(entry_point)
+        if error:
+            errors = [error]
+        else:
+            try:
+                args = function.map_OB(OB, num, cfg=_worker['cfg'])
+                errors = check_args(specs, args)
+            except Exception as e:
+                errors = [f"map_OB failed: {type(e).__name__}: {e}"]
+        results.append({'source': source, 'ob': oid, 'sequence': num,
+                        'entry_point': entry_point, 'valid': not errors,
+                        'errors': errors})
+    return results
+
+
+def _validate_source(item):
+    """Validate the OBs of one source (a file path, or already parsed OBs)
+    """
+    source, obs = item
+    if obs is None:
+        try:
+            path = Path(source)
+            obs = parse_obs(path.read_text(), path.suffix)
+        except Exception as e:
+            return [{'source': source, 'ob': None, 'sequence': None,
+                     'entry_point': _worker['entry_point'], 'valid': False,
+                     'errors': [f"unreadable: {type(e).__name__}: {e}"]}]
+    results = []
+    for index, OB in enumerate(obs):
+        results.extend(_validate_ob(source, index, OB))
+    return results
+
+
+class OBValidator:
+    """Validates OBs in parallel against the functions they will be run with
+    """
+
+    def __init__(self, table_loc, entry_point, cfg=None, entry_point_key=None,
+                 workers=None, logger=None):
+        """Create the validator
+
+        Parameters
+        ----------
+        table_loc : str
+            Path to the linking table
+        entry_point : str
+            Linking table entry point the sequences are executed with
+        cfg : str, optional
+            Config file used by map_OB and add_cmdline_args, by default the
+            function's default
+        entry_point_key : str, optional
+            Sequence metadata key naming the entry point of a sequence when it
+            differs from entry_point, by default None
+        workers : int, optional
+            Number of worker processes, 1 validates in this process, by
+            default os.cpu_count()
+        logger : logging.Logger, optional
+            Logger, by default this module's
+        """
+        self.table_loc = str(table_loc)
+        self.entry_point = entry_point
+        self.cfg = cfg
+        self.entry_point_key = entry_point_key
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logger or logging.getLogger(__name__)
+
+    def _initargs(self):
+        return (self.table_loc, self.entry_point, self.cfg,
+                self.entry_point_key, list(sys.path))
+
+    def validate(self, files=(), obs=None, stream_name='<stream>',
+                 text=None, text_format=None):
+        """Validate OB files and/or already loaded OBs
+
+        Parameters
+        ----------
+        files : list, optional
+            OB files and directories
+        obs : list, optional
+            OBs in dictionary form, by default None
+        stream_name : str, optional
+            Source name reported for obs and text, by default '<stream>'
+        text : str, optional
+            Unparsed OBs (e.g. stdin), added to obs; reported as an invalid
+            source if they cannot be parsed, by default None
+        text_format : str, optional
+            Suffix of the text's format (see parse_obs), by default guessed
+
+        Returns
+        -------
+        dict
+            The report: a summary and one result per sequence
+        """
+        start = time.perf_counter()
+        items = [(str(path), None) for path in find_ob_files(files)]
+        unreadable = []
+        if text is not None:
+            try:
+                obs = list(obs or ()) + parse_obs(text, text_format)
+            except Exception as e:
+                unreadable.append({
+                    'source': stream_name, 'ob': None, 'sequence': None,
+                    'entry_point': self.entry_point, 'valid': False,
+                    'errors': [f"unreadable: {type(e).__name__}: {e}"]})
+        if obs:
+            # Several chunks so that large streams are spread over the pool
+            step = max(1, len(obs) // (self.workers * 4))
+            items.extend((stream_name, obs[i:i + step])
+                         for i in range(0, len(obs), step))
+
+        self.logger.info(f"Validating {len(items)} sources against "
+                         f"{self.entry_point} with {self.workers} workers")
+        results = list(unreadable)
+        if self.workers == 1:
+            _init_worker(*self._initargs())
+            for item in items:
+                results.extend(_validate_source(item))
+        else:
+            chunksize = max(1, len(items) // (self.workers * 4))
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                     initargs=self._initargs()) as pool:
+                for source_results in pool.map(_validate_source, items,
+                                               chunksize=chunksize):
+                    results.extend(source_results)
+
+        invalid = [res for res in results if not res['valid']]
+        report = {
+            'linking_table': self.table_loc,
+            'entry_point': self.entry_point,
+            'generated': datetime.utcnow().isoformat(timespec='seconds'),
+            'summary': {
+                'sources': len(items) + len(unreadable),
+                'obs': len({(res['source'], res['ob']) for res in results}),
+                'sequences': len(results),
+                'invalid_sequences': len(invalid),
+                'errors': sum(len(res['errors']) for res in invalid),
+                'seconds': round(time.perf_counter() - start, 3),
+            },
+            'results': results,
+        }
+        summary = report['summary']
+        self.logger.info(f"Validated {summary['sequences']} sequences of "
+                         f"{summary['obs']} OBs in {summary['seconds']} s, "
+                         f"{summary['invalid_sequences']} invalid")
+        return report
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Validate OBs against the argument "
+                                        "specs of translator functions")
+    parser.add_argument("linking_table", help="Path to the linking table")
+    parser.add_argument("entry_point", help="Entry point the sequences are run with")
+    parser.add_argument("sources", nargs="+", help="OB files, directories, or - for stdin")
+    parser.add_argument("-c", "--cfg", help="Config file used to map the OBs")
+    parser.add_argument("-k", "--entry-point-key", dest="entry_point_key",
+                        help="Sequence metadata key overriding the entry point")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Number of worker processes")
+    parser.add_argument("-o", "--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--format", choices=sorted(STREAM_FORMATS),
+                        default='auto',
+                        help="Format of the OBs on stdin, by default guessed")
+    parsed = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    files = [src for src in parsed.sources if src != '-']
+    text = sys.stdin.read() if '-' in parsed.sources else None
+
+    validator = OBValidator(parsed.linking_table, parsed.entry_point,
+                            cfg=parsed.cfg,
+                            entry_point_key=parsed.entry_point_key,
+                            workers=parsed.workers)
+    report = validator.validate(files, text=text,
+                                text_format=STREAM_FORMATS[parsed.format])
+
+    if parsed.output:
+        with open(parsed.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if report['summary']['invalid_sequences'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
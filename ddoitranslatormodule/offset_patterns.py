@@ -0,0 +1,372 @@
+"""
+Dither and offset patterns of a sequence.
+
+A pattern holds every position of a sequence at once, as an (N, 2) array of
+offsets in arcseconds from the starting position, so it can be built,
+rotated and checked against the telescope limits with array operations
+before the first move:
+
+    pattern = offset_patterns.box(20, points=5).repeat(2)
+    limits = OffsetLimits(max_radius=60, max_step=30)
+    limits.check(pattern)           # all violations at once, or nothing
+    for dx, dy in pattern.moves():  # relative moves, as Python floats
+        move(dx, dy)
+
+Patterns: ``box`` (corners of a square, optionally with its center, or a 3x3
+grid), ``abba`` (nod along an axis), ``random_in_box`` and ``custom`` lists.
+``TelescopeBase.run_offset_pattern`` validates a pattern and streams it to a
+move function.
+
+NumPy is needed to build patterns; the module imports without it.
+"""
+
+import math
+
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIOffsetLimitExceeded
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIZeroOffsets
+
+try:
+    import numpy as np
+except ImportError:
+    # Allows the module to be imported where NumPy is not installed
+    np = None
+
+
+def _numpy():
+    if np is None:
+        raise ModuleNotFoundError("NumPy is needed for offset patterns")
+    return np
+
+
+def _clean(offsets):
+    """Offsets with rounding noise of trigonometry (and -0.0) set to 0"""
+    return np.where(np.abs(offsets) < 1e-9, 0.0, offsets)
+
+
+class OffsetPattern:
+    """Offsets of every position of a sequence, from the starting position
+    """
+
+    def __init__(self, offsets, name='custom'):
+        """Create a pattern
+
+        Parameters
+        ----------
+        offsets : array_like
+            (N, 2) offsets in arcseconds, in the order they are visited
+        name : str, optional
+            Name of the pattern, by default 'custom'
+        """
+        numpy = _numpy()
+        offsets = numpy.asarray(offsets, dtype=float)
+        if offsets.ndim == 1 and offsets.size == 0:
+            offsets = offsets.reshape(0, 2)
+        if offsets.ndim != 2 or offsets.shape[1] != 2:
+            raise ValueError(f"Offsets must be (x, y) pairs, got an array "
+                             f"of shape {offsets.shape}")
+        if not numpy.isfinite(offsets).all():
+            raise ValueError("Offsets must be finite")
+        self.offsets = offsets
+        self.name = name
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        """(x, y) of every position, as Python floats"""
+        return iter(map(tuple, self.offsets.tolist()))
+
+    def __repr__(self):
+        return f"<OffsetPattern {self.name}, {len(self)} positions>"
+
+    def steps(self):
+        """Relative moves from position to position, the first one from the
+        starting position
+
+        Returns
+        -------
+        numpy.ndarray
+            (N, 2) moves in arcseconds
+        """
+        numpy = _numpy()
+        return numpy.diff(self.offsets, axis=0, prepend=numpy.zeros((1, 2)))
+
+    def moves(self, return_to_start=False):
+        """Iterate over the relative moves, as (dx, dy) Python floats
+
+        Parameters
+        ----------
+        return_to_start : bool, optional
+            End with the move back to the starting position, by default False
+        """
+        steps = self.steps()
+        if return_to_start and len(self):
+            steps = _numpy().vstack([steps, _clean(-self.offsets[-1:])])
+        return iter(map(tuple, steps.tolist()))
+
+    def rotate(self, angle):
+        """The pattern rotated counter clockwise, e.g. from instrument to
+        sky coordinates
+
+        Parameters
+        ----------
+        angle : float
+            Degrees
+
+        Returns
+        -------
+        OffsetPattern
+        """
+        theta = math.radians(angle)
+        rotation = _numpy().array([[math.cos(theta), -math.sin(theta)],
+                                   [math.sin(theta), math.cos(theta)]])
+        return OffsetPattern(_clean(self.offsets @ rotation.T), self.name)
+
+    def scale(self, factor):
+        """The pattern with every offset multiplied by factor (e.g. pixel
+        scale)"""
+        return OffsetPattern(self.offsets * factor, self.name)
+
+    def shift(self, dx, dy):
+        """The pattern with every position moved by (dx, dy)"""
+        return OffsetPattern(self.offsets + (dx, dy), self.name)
+
+    def repeat(self, count, each=False):
+        """The pattern repeated
+
+        Parameters
+        ----------
+        count : int
+            Number of times
+        each : bool, optional
+            Repeat every position in place (AABB) instead of the whole
+            pattern (ABAB), by default False
+
+        Returns
+        -------
+        OffsetPattern
+        """
+        numpy = _numpy()
+        if each:
+            offsets = numpy.repeat(self.offsets, count, axis=0)
+        else:
+            offsets = numpy.tile(self.offsets, (count, 1))
+        return OffsetPattern(offsets, self.name)
+
+
+def box(size, points=4):
+    """Positions on a square centered on the starting position
+
+    Parameters
+    ----------
+    size : float
+        Side of the square in arcseconds
+    points : int, optional
+        4 for the corners, 5 for the center then the corners, 9 for a 3x3
+        grid, by default 4
+
+    Returns
+    -------
+    OffsetPattern
+    """
+    numpy = _numpy()
+    half = size / 2
+    corners = numpy.array([[1, 1], [-1, 1], [-1, -1], [1, -1]]) * half
+    if points == 4:
+        offsets = corners
+    elif points == 5:
+        offsets = numpy.vstack([numpy.zeros((1, 2)), corners])
+    elif points == 9:
+        grid = numpy.array([-half, 0.0, half])
+        xx, yy = numpy.meshgrid(grid, grid[::-1])
+        # snake through the rows so every move is one grid step
+        xx[1] = xx[1][::-1]
+        offsets = numpy.column_stack([xx.ravel(), yy.ravel()])
+    else:
+        raise ValueError(f"A box has 4, 5 or 9 points, not {points}")
+    return OffsetPattern(offsets, f"box{points}")
+
+
+def abba(throw, angle=90.0, repeats=1):
+    """Nod between two positions A and B, throw apart, in the order ABBA
+
+    Parameters
+    ----------
+    throw : float
+        Distance from A to B in arcseconds, centered on the starting
+        position
+    angle : float, optional
+        Direction of A in degrees counter clockwise from +x, by default 90
+        (along +y, e.g. along the slit)
+    repeats : int, optional
+        Number of ABBA cycles, by default 1
+
+    Returns
+    -------
+    OffsetPattern
+    """
+    numpy = _numpy()
+    theta = math.radians(angle)
+    a = numpy.array([math.cos(theta), math.sin(theta)]) * throw / 2
+    cycle = _clean(numpy.array([a, -a, -a, a]))
+    return OffsetPattern(numpy.tile(cycle, (repeats, 1)), 'ABBA')
+
+
+def random_in_box(count, width, height=None, seed=None):
+    """Positions drawn uniformly in a box centered on the starting position
+
+    Parameters
+    ----------
+    count : int
+        Number of positions
+    width : float
+        Width of the box in arcseconds
+    height : float, optional
+        Height of the box in arcseconds, by default width
+    seed : int, optional
+        Seed of the generator, to repeat a pattern, by default random
+
+    Returns
+    -------
+    OffsetPattern
+    """
+    numpy = _numpy()
+    height = width if height is None else height
+    rng = numpy.random.default_rng(seed)
+    offsets = (rng.random((count, 2)) - 0.5) * (width, height)
+    return OffsetPattern(offsets, 'random')
+
+
+def custom(offsets):
+    """A pattern from a list of (x, y) offsets in arcseconds"""
+    return OffsetPattern(offsets, 'custom')
+
+
+PATTERNS = {'box': box, 'abba': abba, 'random': random_in_box,
+            'custom': custom}
+
+
+def make_pattern(name, *args, **kwargs):
+    """Build a pattern by name, e.g. from an OB
+
+    Parameters
+    ----------
+    name : str
+        box, abba, random or custom
+    *args, **kwargs
+        The arguments of the pattern function
+
+    Returns
+    -------
+    OffsetPattern
+    """
+    try:
+        function = PATTERNS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown offset pattern {name}, expected one of "
+                         f"{sorted(PATTERNS)}") from None
+    return function(*args, **kwargs)
+
+
+class OffsetLimits:
+    """Limits the positions and moves of a pattern must stay within
+    """
+
+    OPTIONS = ('max_radius', 'max_x', 'max_y', 'max_step')
+
+    def __init__(self, max_radius=None, max_x=None, max_y=None,
+                 max_step=None):
+        """Create limits, None for no limit
+
+        Parameters
+        ----------
+        max_radius : float, optional
+            Largest distance from the starting position, in arcseconds
+        max_x, max_y : float, optional
+            Largest absolute offset along each axis, in arcseconds
+        max_step : float, optional
+            Largest single move, in arcseconds
+        """
+        self.max_radius = max_radius
+        self.max_x = max_x
+        self.max_y = max_y
+        self.max_step = max_step
+
+    @classmethod
+    def from_config(cls, cfg, section='offset_limits'):
+        """Limits from a config section with any of max_radius, max_x,
+        max_y and max_step; no limits if the section is missing"""
+        if cfg is None or not cfg.has_section(section):
+            return cls()
+        return cls(**{option: cfg.getfloat(section, option)
+                      for option in cls.OPTIONS
+                      if cfg.has_option(section, option)})
+
+    def violations(self, pattern, return_to_start=False):
+        """Every position or move of the pattern outside the limits
+
+        Parameters
+        ----------
+        pattern : OffsetPattern
+            The pattern
+        return_to_start : bool, optional
+            Also check the move from the last position back to the start
+            (index len(pattern), position (0, 0)), by default False
+
+        Returns
+        -------
+        list
+            (index, (x, y), reason) of each violation, by index
+        """
+        numpy = _numpy()
+        offsets = pattern.offsets
+        checks = []
+        if self.max_radius is not None:
+            checks.append((numpy.hypot(offsets[:, 0], offsets[:, 1]),
+                           self.max_radius, "from the start"))
+        if self.max_x is not None:
+            checks.append((numpy.abs(offsets[:, 0]), self.max_x, "in x"))
+        if self.max_y is not None:
+            checks.append((numpy.abs(offsets[:, 1]), self.max_y, "in y"))
+        if self.max_step is not None:
+            steps = pattern.steps()
+            checks.append((numpy.hypot(steps[:, 0], steps[:, 1]),
+                           self.max_step, "in one move"))
+
+        found = []
+        for values, limit, what in checks:
+            for index in numpy.flatnonzero(values > limit).tolist():
+                found.append((index, tuple(offsets[index].tolist()),
+                              f"{values[index]:.2f}\" {what} > {limit}\""))
+        if self.max_step is not None and return_to_start and len(pattern):
+            back = math.hypot(*offsets[-1].tolist())
+            if back > self.max_step:
+                found.append((len(pattern), (0.0, 0.0),
+                              f"{back:.2f}\" in the move back to the start "
+                              f"> {self.max_step}\""))
+        return sorted(found, key=lambda violation: violation[0])
+
+    def check(self, pattern, return_to_start=False):
+        """Check the whole pattern before any move
+
+        Parameters
+        ----------
+        pattern : OffsetPattern
+            The pattern
+        return_to_start : bool, optional
+            The pattern ends with the move back to the start, which is
+            checked too, by default False
+
+        Raises
+        ------
+        DDOIZeroOffsets
+            If the pattern has no position other than the start
+        DDOIOffsetLimitExceeded
+            If any position or move is outside the limits, listing all of them
+        """
+        if not len(pattern) or not pattern.offsets.any():
+            raise DDOIZeroOffsets(f"Offset pattern {pattern.name} has no "
+                                  f"non-zero offsets")
+        found = self.violations(pattern, return_to_start)
+        if found:
+            raise DDOIOffsetLimitExceeded(pattern.name, len(pattern), found)
@@ -0,0 +1,131 @@
+"""
+Per-stage cProfile profiles for ``cli_interface.main --profile``.
+
+Each stage of a CLI run (linking table load, import of the linked module,
+argument parsing, and pre_condition/perform/post_condition of the executed
+function) is profiled separately, so CLI start up and imports are not mixed
+with instrument code.  Every stage writes a ``.pstats`` file, readable with
+``python -m pstats`` or snakeviz, and logs its top functions.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+class PhaseProfiler:
+    """Profiles named stages, and the phases of executions as an execution
+    observer (see execution_context.add_observer)
+    """
+
+    def __init__(self, out_dir, logger, top_n=10, sort='cumulative'):
+        """Create the profiler
+
+        Parameters
+        ----------
+        out_dir : str or Path
+            Directory the pstats files are written to
+        logger : logging.Logger
+            Logger for the top-N summaries
+        top_n : int, optional
+            Number of functions in each summary, by default 10
+        sort : str, optional
+            pstats sort key of the summaries, by default 'cumulative'
+        """
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+        self.top_n = top_n
+        self.sort = sort
+        self.prefix = f"{datetime.utcnow():%H%M%S}_{os.getpid()}"
+        self.files = []
+        # {run_id: cProfile.Profile} of the phases being profiled
+        self._running = {}
+        # {run_id: cProfile.Profile} of the watchdog worker threads running
+        # them, cProfile (before Python 3.12) only sees the thread that
+        # enabled it
+        self._workers = {}
+        # run_ids whose worker profile is finished
+        self._workers_done = set()
+
+    def _path(self, stage):
+        return self.out_dir / f"{self.prefix}_{stage}.pstats"
+
+    def _report(self, stage, profile, *more):
+        """Write and log a profile, merged with those in more"""
+        path = self._path(stage)
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, *more, stream=stream)
+        stats.dump_stats(str(path))
+        self.files.append(path)
+
+        stats.sort_stats(self.sort).print_stats(self.top_n)
+        self.logger.info(f"Profile of {stage}: {stats.total_tt:.3f} s, "
+                         f"written to {path}\n{stream.getvalue()}")
+
+    @contextmanager
+    def profile(self, stage):
+        """Profile the block as the named stage
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield profile
+        finally:
+            profile.disable()
+            self._report(stage, profile)
+
+    # Execution observer interface, only top level executions are profiled
+    # (nested ones are part of their caller's phase)
+
+    def on_phase_start(self, ctx, phase):
+        if ctx.parent is not None:
+            return
+        profile = cProfile.Profile()
+        self._running[ctx.run_id] = profile
+        profile.enable()
+
+    def on_worker_start(self, ctx, phase):
+        if ctx.run_id not in self._running:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12 allows one active profiler per interpreter, the
+            # phase's own (enabled by the caller) already holds it
+            self.logger.info(f"Worker thread of {ctx.name}.{phase} is not "
+                             f"profiled separately, another profiler is "
+                             f"active")
+            return
+        self._workers[ctx.run_id] = profile
+
+    def on_worker_end(self, ctx, phase):
+        profile = self._workers.get(ctx.run_id)
+        if profile is None:
+            return
+        profile.disable()
+        if ctx.run_id in self._running:
+            self._workers_done.add(ctx.run_id)
+        else:
+            # the phase passed its deadline and was already reported
+            self._workers.pop(ctx.run_id, None)
+
+    def on_phase_end(self, ctx, phase, error):
+        profile = self._running.pop(ctx.run_id, None)
+        if profile is None:
+            return
+        profile.disable()
+        more = []
+        if ctx.run_id in self._workers_done:
+            self._workers_done.discard(ctx.run_id)
+            more.append(self._workers.pop(ctx.run_id))
+        elif ctx.run_id in self._workers:
+            # still running past its deadline, its profile is incomplete
+            self.logger.warning(f"Profile of {ctx.name}.{phase} is missing "
+                                f"its unfinished worker thread")
+        self._report(f"{ctx.name}.{phase}", profile, *more)
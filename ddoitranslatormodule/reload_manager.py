@@ -0,0 +1,271 @@
+"""
+Hot reload of translator modules in long-running processes.
+
+A sequencer or GUI host that keeps the functions returned by
+``get_linked_function`` alive would otherwise need a restart (and a full
+import and warm up) to pick up a fixed translator module.  ``ReloadManager``
+watches the files of the modules imported through the linking table (and the
+other loaded modules of the same packages), and reloads only the changed
+modules and the modules that depend on them.  It also reloads the
+``LinkingTable`` when its YAML file changes.
+
+Reloads only happen between executions: the manager waits until no
+``execute()`` is in flight and holds new ones back while it reloads (see
+``execution_context.exclusive``).
+
+    manager = ReloadManager(linking_tbl, logger)
+    manager.start(interval=2)
+    ...
+    function, args, link = manager.get_function('expose')  # always current
+"""
+
+import os
+import sys
+import types
+import importlib
+import threading
+import traceback
+
+from ddoitranslatormodule.cli_interface import get_linked_function, linked_modules
+from ddoitranslatormodule.execution_context import exclusive
+
+# The framework itself is never reloaded
+FRAMEWORK_PACKAGE = 'ddoitranslatormodule'
+
+
+def _mtime(module):
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ReloadManager:
+    """Tracks and reloads the translator modules of a linking table
+    """
+
+    def __init__(self, linking_tbl, logger):
+        """Create the manager
+
+        Parameters
+        ----------
+        linking_tbl : LinkingTable
+            The linking table functions are resolved with
+        logger : logging.Logger
+            Logger for reload messages
+        """
+        self.linking_tbl = linking_tbl
+        self.logger = logger
+        self._lock = threading.RLock()
+        # {module name: mtime when last (re)loaded}
+        self._mtimes = {}
+        # {entry point: get_linked_function result}
+        self._functions = {}
+        self._callbacks = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def on_reload(self, callback):
+        """Call callback(reloaded module names, table_reloaded) after every
+        reload, e.g. to drop references to old classes
+        """
+        self._callbacks.append(callback)
+
+    def get_function(self, key):
+        """get_linked_function for the managed table, cached until a reload
+
+        Parameters
+        ----------
+        key : str
+            Entry point
+
+        Returns
+        -------
+        Tuple[class, list, str]
+            As returned by get_linked_function
+        """
+        with self._lock:
+            result = self._functions.get(key)
+            if result is None:
+                result = get_linked_function(self.linking_tbl, key,
+                                             self.logger)
+                if result[0] is not None:
+                    self._functions[key] = result
+                self.track()
+            return result
+
+    def _packages(self):
+        packages = set()
+        for name in linked_modules:
+            top = name.split('.')[0]
+            if top != FRAMEWORK_PACKAGE:
+                packages.add(top)
+        return packages
+
+    def tracked_modules(self):
+        """Names of the loaded modules that are watched: those imported
+        through the linking table and the loaded modules of their packages
+        """
+        packages = self._packages()
+        names = set(name for name in linked_modules if name in sys.modules)
+        for name, module in list(sys.modules.items()):
+            if module is None or name.split('.')[0] not in packages:
+                continue
+            if getattr(module, '__file__', None):
+                names.add(name)
+        return names
+
+    def track(self):
+        """Record the current modification time of newly tracked modules
+        """
+        with self._lock:
+            for name in self.tracked_modules():
+                if name not in self._mtimes:
+                    self._mtimes[name] = _mtime(sys.modules[name])
+
+    def changed_modules(self):
+        """Names of the tracked modules whose file changed since loaded"""
+        self.track()
+        with self._lock:
+            return [name for name, mtime in self._mtimes.items()
+                    if name in sys.modules
+                    and _mtime(sys.modules[name]) != mtime]
+
+    def _dependencies(self, name, names):
+        """Tracked modules that the module imports (as a module or with
+        'from ... import')
+        """
+        deps = set()
+        module = sys.modules.get(name)
+        if module is None:
+            return deps
+        for value in list(vars(module).values()):
+            if isinstance(value, types.ModuleType):
+                dep = value.__name__
+                if dep.startswith(name + '.'):
+                    # submodule attribute of a package, not an import
+                    continue
+            else:
+                dep = getattr(value, '__module__', None)
+            if dep in names and dep != name:
+                deps.add(dep)
+        return deps
+
+    def reload_order(self, changed):
+        """The changed modules and everything that depends on them, each
+        after the modules it depends on
+
+        Parameters
+        ----------
+        changed : list
+            Names of the changed modules
+
+        Returns
+        -------
+        list
+            Module names in reload order
+        """
+        names = self.tracked_modules()
+        deps = {name: self._dependencies(name, names) for name in names}
+
+        # changed modules and their dependents
+        selected = set(changed)
+        grew = True
+        while grew:
+            grew = False
+            for name, name_deps in deps.items():
+                if name not in selected and name_deps & selected:
+                    selected.add(name)
+                    grew = True
+
+        # dependencies first; modules in a cycle keep their name order
+        order = []
+        remaining = sorted(selected)
+        while remaining:
+            ready = [name for name in remaining
+                     if not (deps.get(name, set()) & set(remaining))]
+            if not ready:
+                ready = remaining[:1]
+            for name in ready:
+                order.append(name)
+                remaining.remove(name)
+        return order
+
+    def reload_changed(self, timeout=None):
+        """Reload changed modules (and the linking table if its file
+        changed), once no execution is running
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for running executions, by default forever
+
+        Returns
+        -------
+        list
+            Names of the reloaded modules, None if executions did not finish
+            within the timeout
+        """
+        changed = self.changed_modules()
+        table_changed = self.linking_tbl.changed()
+        if not changed and not table_changed:
+            return []
+
+        with exclusive(timeout) as acquired:
+            if not acquired:
+                self.logger.info("Reload postponed, executions are running")
+                return None
+            with self._lock:
+                if table_changed:
+                    self.logger.info(f"Reloading linking table "
+                                     f"{self.linking_tbl.filename}")
+                    self.linking_tbl.load()
+
+                reloaded = []
+                for name in self.reload_order(changed):
+                    module = sys.modules.get(name)
+                    if module is None:
+                        continue
+                    try:
+                        importlib.reload(module)
+                        reloaded.append(name)
+                        self.logger.info(f"Reloaded {name}")
+                    except Exception:
+                        self.logger.error(f"Failed to reload {name}, "
+                                          f"keeping the loaded version")
+                        self.logger.error(traceback.format_exc())
+                    self._mtimes[name] = _mtime(module)
+                self._functions.clear()
+
+        for callback in self._callbacks:
+            callback(reloaded, table_changed)
+        return reloaded
+
+    def start(self, interval=2.0):
+        """Check for changes every interval seconds in a background thread
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.track()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        daemon=True, name="reload-manager")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.reload_changed(timeout=interval)
+            except Exception:
+                self.logger.error(traceback.format_exc())
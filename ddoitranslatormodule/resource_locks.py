@@ -0,0 +1,243 @@
+"""
+Keyword level locks between concurrent translator executions.
+
+Functions declare the KTL keywords they write (``writes_keywords``, or
+``locked_keywords(args, cfg)`` when the set depends on the arguments) and
+``execute()`` locks them before the first phase that is not an overlap phase.
+Executions whose keyword sets overlap run one at a time; others run
+concurrently, in threads of one process or in separate processes (a GUI and a
+script).
+
+Every keyword is guarded by an in-process lock and by an ``flock`` on a lock
+file in ``DDOI_LOCK_DIR`` (default ``<tmp>/ddoi_locks``).  The locks of one
+acquisition are taken in sorted order, so executions that lock all their
+keywords at once cannot deadlock.  Nested executions reuse the locks their
+callers hold, but any further keywords they lock are taken while the caller
+keeps its own, so two nested executions can wait on each other; set
+``lock_timeout`` on such functions to turn the wait into a
+DDOIResourceLockTimeout.  A phase abandoned by the watchdog keeps its locks
+until its thread returns.  The time spent waiting is recorded in the context
+timings as ``lock_wait`` and summarised by ``locks.stats()``.
+"""
+
+import os
+import time
+import tempfile
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIResourceLockTimeout
+
+# Seconds between attempts to take a lock file held by another process
+POLL_INTERVAL = 0.02
+
+
+def resource_name(keyword):
+    """Name of the lock of a keyword
+
+    Parameters
+    ----------
+    keyword : tuple or str
+        (service, keyword), or "service.keyword"
+
+    Returns
+    -------
+    str
+        "service.keyword", lower case
+    """
+    if isinstance(keyword, str):
+        return keyword.lower()
+    service, name = keyword
+    return f"{service}.{name}".lower()
+
+
+class KeywordLockManager:
+    """Locks of keywords, within the process and across processes
+    """
+
+    def __init__(self, lock_dir=None, use_files=True):
+        """Create the manager
+
+        Parameters
+        ----------
+        lock_dir : str, optional
+            Directory of the lock files, by default DDOI_LOCK_DIR or
+            <tmp>/ddoi_locks
+        use_files : bool, optional
+            Also lock across processes, by default True (where fcntl is
+            available)
+        """
+        self.lock_dir = Path(lock_dir or os.environ.get('DDOI_LOCK_DIR')
+                             or Path(tempfile.gettempdir()) / 'ddoi_locks')
+        self.use_files = use_files and fcntl is not None
+        self._cond = threading.Condition()
+        # {resource: ExecutionContext holding it}
+        self._owners = {}
+        # {resource: open lock file descriptor}
+        self._fds = {}
+        self._stats = {'acquisitions': 0, 'contended': 0, 'wait_time': 0.0,
+                       'max_wait': 0.0}
+        self._contention = {}
+
+    def _held_by_caller(self, resource, ctx):
+        owner = self._owners.get(resource)
+        while ctx is not None:
+            if ctx is owner:
+                return True
+            ctx = ctx.parent
+        return False
+
+    def acquire(self, ctx, keywords, timeout=None):
+        """Lock keywords for an execution, in sorted order
+
+        Parameters
+        ----------
+        ctx : ExecutionContext
+            The execution taking the locks
+        keywords : iterable
+            (service, keyword) pairs or "service.keyword" names
+        timeout : float, optional
+            Seconds to wait for all the locks, by default forever
+
+        Returns
+        -------
+        Tuple[list, float]
+            The resources locked (to pass to release), and the seconds spent
+            waiting
+
+        Raises
+        ------
+        DDOIResourceLockTimeout
+            If the locks could not be taken in time
+        DDOIExecutionCancelled
+            If the execution was cancelled while waiting
+        """
+        resources = sorted(set(resource_name(kw) for kw in keywords))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        start = time.perf_counter()
+        held = []
+        contended = False
+        try:
+            for resource in resources:
+                with self._cond:
+                    if self._held_by_caller(resource, ctx):
+                        continue
+                if self._acquire_one(resource, ctx, deadline):
+                    contended = True
+                held.append(resource)
+        except BaseException:
+            self.release(held)
+            raise
+        wait = time.perf_counter() - start
+        with self._cond:
+            self._stats['acquisitions'] += 1
+            self._stats['wait_time'] += wait
+            self._stats['max_wait'] = max(self._stats['max_wait'], wait)
+            if contended:
+                self._stats['contended'] += 1
+        return held, wait
+
+    def _wait_step(self, resource, ctx, deadline):
+        ctx.check_cancelled()
+        if deadline is None:
+            return POLL_INTERVAL * 5
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DDOIResourceLockTimeout(resource, self._owner_name(resource))
+        return min(remaining, POLL_INTERVAL * 5)
+
+    def _owner_name(self, resource):
+        owner = self._owners.get(resource)
+        return repr(owner) if owner is not None else "another process"
+
+    def _acquire_one(self, resource, ctx, deadline):
+        """Take the in-process lock, then the lock file, of one resource
+
+        Returns
+        -------
+        bool
+            True if the resource was held by someone else first
+        """
+        contended = False
+        with self._cond:
+            while resource in self._owners:
+                if not contended:
+                    contended = True
+                    self._contention[resource] = \
+                        self._contention.get(resource, 0) + 1
+                self._cond.wait(self._wait_step(resource, ctx, deadline))
+            self._owners[resource] = ctx
+
+        if not self.use_files:
+            return contended
+        try:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.lock_dir / f"{resource}.lock",
+                         os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        contended = True
+                        with self._cond:
+                            step = self._wait_step(resource, ctx, deadline)
+                        time.sleep(min(step, POLL_INTERVAL))
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            with self._cond:
+                self._owners.pop(resource, None)
+                self._cond.notify_all()
+            raise
+        self._fds[resource] = fd
+        return contended
+
+    def release(self, resources):
+        """Unlock resources taken with acquire
+
+        Parameters
+        ----------
+        resources : list
+            As returned by acquire
+        """
+        for resource in reversed(resources):
+            fd = self._fds.pop(resource, None)
+            if fd is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+            with self._cond:
+                self._owners.pop(resource, None)
+                self._cond.notify_all()
+
+    def holders(self):
+        """{resource: ExecutionContext} of the locks held in this process"""
+        with self._cond:
+            return dict(self._owners)
+
+    def stats(self):
+        """Lock statistics of this process
+
+        Returns
+        -------
+        dict
+            acquisitions, contended (acquisitions that had to wait),
+            wait_time, max_wait, and per resource contention counts
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['per_resource'] = dict(self._contention)
+        return stats
+
+
+# The lock manager used by execute()
+locks = KeywordLockManager()
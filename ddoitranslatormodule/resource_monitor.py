@@ -0,0 +1,424 @@
+"""
+Resource instrumentation for processes that run many executions.
+
+Sequencers host translator functions for days.  Every ``execute()`` copies
+its arguments and creates a context, and helpers like
+``cli_interface.create_logger`` add logging handlers, so anything that is
+kept per execution shows up as slow growth.  ``ResourceMonitor`` is an
+execution observer that samples, after every top level execution, the
+memory traced by tracemalloc, the number of logging handlers, open file
+descriptors and threads, and reports the growth per execution:
+
+    monitor = ResourceMonitor()
+    with monitor:
+        for args in many_args:
+            Expose.execute(args, logger)
+    print(monitor.report().summary())
+
+``soak`` runs a function thousands of times against the simulated KTL
+services and raises DDOIResourceGrowth if any resource keeps growing.  Memory
+is measured at several checkpoints after the warm up, and judged by the
+median growth between them, so a one-off allocation (a cache or an interned
+string table resizing) does not count as a leak; a leak grows between every
+pair of checkpoints:
+
+    python -m ddoitranslatormodule.resource_monitor soak -n 5000
+"""
+
+import gc
+import os
+import sys
+import logging
+import argparse
+import threading
+import tracemalloc
+from collections import deque
+
+from ddoitranslatormodule import execution_context
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIResourceGrowth
+
+# Default growth allowed by soak, per execution for memory and over the
+# whole run for the counted resources
+GROWTH_LIMITS = {'memory': 256.0, 'handlers': 0, 'fds': 2, 'threads': 2}
+
+# Memory checkpoints taken by soak over the measured executions
+MEMORY_CHECKPOINTS = 10
+
+
+def handler_count():
+    """Number of handlers on all loggers, the root logger included"""
+    loggers = [logging.getLogger()]
+    loggers += [logger for logger in logging.Logger.manager.loggerDict.values()
+                if isinstance(logger, logging.Logger)]
+    return sum(len(logger.handlers) for logger in loggers)
+
+
+def fd_count():
+    """Number of open file descriptors of the process, None where it
+    cannot be counted"""
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            continue
+    return None
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+
+def _slope(values):
+    """Least squares growth per sample of a series"""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    num = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    den = sum((x - mean_x) ** 2 for x in range(n))
+    return num / den
+
+
+class ResourceSample:
+    """Resources in use after an execution
+    """
+    __slots__ = ('execution', 'function', 'memory', 'handlers', 'fds',
+                 'threads')
+
+    def __init__(self, execution, function):
+        self.execution = execution
+        self.function = function
+        self.memory = tracemalloc.get_traced_memory()[0] \
+            if tracemalloc.is_tracing() else None
+        self.handlers = handler_count()
+        self.fds = fd_count()
+        self.threads = threading.active_count()
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class GrowthReport:
+    """Growth of each resource over the sampled executions
+    """
+
+    def __init__(self, samples, executions, top_growth=(), traced_growth=None,
+                 checkpoints=()):
+        self.samples = list(samples)
+        # Total executions seen, older samples may have been dropped
+        self.executions = executions
+        # tracemalloc StatisticDiff of the lines that grew the most
+        self.top_growth = list(top_growth)
+        # Bytes allocated since the baseline snapshot and still alive, the
+        # monitor's own samples excluded; None without a baseline
+        self.traced_growth = traced_growth
+        # (executions, traced bytes) at each ResourceMonitor.checkpoint
+        self.checkpoints = list(checkpoints)
+
+    def _series(self, resource):
+        return [getattr(sample, resource) for sample in self.samples
+                if getattr(sample, resource) is not None]
+
+    def growth(self, resource):
+        """Growth from the first to the last sample
+
+        Parameters
+        ----------
+        resource : str
+            memory (bytes), handlers, fds or threads
+
+        Returns
+        -------
+        int or None
+            None if the resource was not measured
+        """
+        series = self._series(resource)
+        if not series:
+            return None
+        return series[-1] - series[0]
+
+    def memory_rates(self):
+        """Traced bytes per execution between consecutive checkpoints"""
+        return [(b1 - b0) / (e1 - e0) for (e0, b0), (e1, b1)
+                in zip(self.checkpoints, self.checkpoints[1:]) if e1 > e0]
+
+    def per_execution(self, resource):
+        """Growth per execution, None if not measured.  Memory is the median
+        growth between the checkpoints when there are at least two
+        intervals, else the traced growth since the baseline when there is
+        one; the other resources (and memory without either) the least
+        squares slope of the samples"""
+        if resource == 'memory':
+            rates = self.memory_rates()
+            if len(rates) >= 2:
+                return _median(rates)
+            if self.traced_growth is not None:
+                return self.traced_growth / max(self.executions, 1)
+        series = self._series(resource)
+        if not series:
+            return None
+        return _slope(series)
+
+    def exceeded(self, limits=None):
+        """Resources that grew more than allowed
+
+        Parameters
+        ----------
+        limits : dict, optional
+            {resource: limit}, the memory limit is in bytes per execution,
+            the others are the total growth allowed; by default GROWTH_LIMITS
+
+        Returns
+        -------
+        dict
+            {resource: growth} of the resources over their limit
+        """
+        limits = GROWTH_LIMITS if limits is None else limits
+        exceeded = {}
+        for resource, limit in limits.items():
+            if resource == 'memory':
+                growth = self.per_execution(resource)
+            else:
+                growth = self.growth(resource)
+            if growth is not None and growth > limit:
+                exceeded[resource] = growth
+        return exceeded
+
+    def summary(self):
+        parts = [f"{self.executions} executions"]
+        memory = self.per_execution('memory')
+        if memory is not None:
+            total = self.traced_growth if self.traced_growth is not None \
+                else self.growth('memory')
+            parts.append(f"memory {total:+d} B ({memory:+.1f} B/execution)")
+        for resource in ('handlers', 'fds', 'threads'):
+            growth = self.growth(resource)
+            if growth is not None:
+                parts.append(f"{resource} {growth:+d}")
+        lines = [", ".join(parts)]
+        for stat in self.top_growth:
+            lines.append(f"    {stat}")
+        return "\n".join(lines)
+
+
+class ResourceMonitor:
+    """Samples the resources of the process after every top level execution,
+    as an execution observer (see execution_context.add_observer)
+    """
+
+    def __init__(self, trace_memory=True, frames=1, max_samples=10000):
+        """Create the monitor
+
+        Parameters
+        ----------
+        trace_memory : bool, optional
+            Start tracemalloc (if not already tracing) while the monitor is
+            installed, by default True.  Tracing slows allocations down.
+        frames : int, optional
+            Frames kept per allocation by tracemalloc, by default 1
+        max_samples : int, optional
+            Samples kept, the oldest are dropped, by default 10000
+        """
+        self.trace_memory = trace_memory
+        self.frames = frames
+        self.samples = deque(maxlen=max_samples)
+        self.executions = 0
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        self._baseline = None
+        self.checkpoints = []
+
+    def install(self):
+        """Start tracing and observing executions"""
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        execution_context.add_observer(self)
+
+    def uninstall(self):
+        """Stop observing executions, and tracing if install started it"""
+        execution_context.remove_observer(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    def reset(self):
+        """Drop the samples, e.g. after warm up executions, and take the
+        baseline snapshot the report compares to"""
+        with self._lock:
+            self.samples.clear()
+            self.executions = 0
+            self.checkpoints = []
+        if tracemalloc.is_tracing():
+            gc.collect()
+            self._baseline = tracemalloc.take_snapshot()
+            self.checkpoint()
+
+    def _traced_snapshot(self):
+        """Snapshot of the traced memory, the monitor's own excluded"""
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, __file__)])
+
+    def checkpoint(self):
+        """Record the traced memory (the monitor's own excluded) after the
+        executions so far, see GrowthReport.memory_rates"""
+        if not tracemalloc.is_tracing():
+            return
+        size = sum(stat.size for stat in
+                   self._traced_snapshot().statistics('filename'))
+        with self._lock:
+            self.checkpoints.append((self.executions, size))
+
+    def sample(self, function=None):
+        """Record the current resources as one execution"""
+        with self._lock:
+            self.executions += 1
+            self.samples.append(ResourceSample(self.executions, function))
+
+    def report(self, top_n=5):
+        """Growth since the first sample (or reset)
+
+        Parameters
+        ----------
+        top_n : int, optional
+            Number of source lines that grew the most to list, if a baseline
+            was taken by reset, by default 5
+
+        Returns
+        -------
+        GrowthReport
+        """
+        top_growth = ()
+        traced_growth = None
+        if self._baseline is not None and tracemalloc.is_tracing():
+            snapshot = self._traced_snapshot()
+            stats = snapshot.compare_to(self._baseline, 'lineno')
+            traced_growth = sum(stat.size_diff for stat in stats)
+            top_growth = [stat for stat in stats if stat.size_diff > 0][:top_n]
+        with self._lock:
+            return GrowthReport(self.samples, self.executions, top_growth,
+                                traced_growth, self.checkpoints)
+
+    # Execution observer interface, nested executions are part of their
+    # caller's
+
+    def on_finish(self, ctx, error):
+        if ctx.parent is None:
+            self.sample(ctx.function.__name__)
+
+
+def soak(function, args, n=2000, warmup=100, logger=None, cfg=None,
+         limits=None, model=None):
+    """Run a function many times against the simulated KTL services and
+    check that no resource grows without bound
+
+    Parameters
+    ----------
+    function : TranslatorModuleFunction
+        The function to execute
+    args : dict
+        Arguments of every execution
+    n : int, optional
+        Executions measured, by default 2000
+    warmup : int, optional
+        Executions run first and not measured (caches, imports, lazily
+        created objects), by default 100
+    logger : logging.Logger, optional
+        Logger passed to the function, by default a silent one
+    cfg : str, optional
+        Config file of the function, by default its own
+    limits : dict, optional
+        Allowed growth, by default GROWTH_LIMITS (see GrowthReport.exceeded)
+    model : callable, optional
+        Called with the ktl_sim.SimulatedKTL to define the keywords the
+        function uses, e.g. mosfire_model
+
+    Returns
+    -------
+    GrowthReport
+        The growth over the measured executions
+
+    Raises
+    ------
+    DDOIResourceGrowth
+        If a resource grew more than allowed
+    """
+    from ddoitranslatormodule import ktl_sim
+
+    if logger is None:
+        logger = logging.getLogger('ddoi_soak')
+        logger.propagate = False
+        if not logger.handlers:
+            logger.addHandler(logging.NullHandler())
+
+    sim = ktl_sim.install()
+    monitor = ResourceMonitor()
+    try:
+        if model is not None:
+            model(sim)
+        with monitor:
+            for _ in range(warmup):
+                function.execute(dict(args), logger, cfg)
+            sim.writes.clear()
+            monitor.reset()
+            every = max(n // MEMORY_CHECKPOINTS, 1)
+            for i in range(1, n + 1):
+                function.execute(dict(args), logger, cfg)
+                # The simulator logs every write, which is not the
+                # function's memory
+                sim.writes.clear()
+                if i % every == 0:
+                    monitor.checkpoint()
+            report = monitor.report()
+    finally:
+        ktl_sim.uninstall()
+
+    exceeded = report.exceeded(limits)
+    if exceeded:
+        raise DDOIResourceGrowth(function.__name__, report.executions,
+                                 exceeded)
+    return report
+
+
+def _soak_mosfire(n, warmup):
+    from ddoitranslatormodule.examples.mosfire.expose import Expose
+    from ddoitranslatormodule.examples.mosfire.simulation import mosfire_model
+    args = {'exptime': 1, 'coadds': 1, 'sampmode': 'MCDS16',
+            'object': 'soak'}
+    return soak(Expose, args, n=n, warmup=warmup, model=mosfire_model)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Resource growth of repeated executions")
+    sub = parser.add_subparsers(dest='command', required=True)
+    soak_parser = sub.add_parser(
+        'soak', help="execute the MOSFIRE Expose example against the "
+                     "simulated services and check for growth")
+    soak_parser.add_argument('-n', type=int, default=2000,
+                             help="executions measured")
+    soak_parser.add_argument('--warmup', type=int, default=100,
+                             help="executions run before measuring")
+    parsed = parser.parse_args()
+
+    try:
+        report = _soak_mosfire(parsed.n, parsed.warmup)
+    except DDOIResourceGrowth as e:
+        print(e)
+        sys.exit(1)
+    print(report.summary())
+    sys.exit(0)
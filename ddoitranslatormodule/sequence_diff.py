@@ -0,0 +1,96 @@
+"""
+Changed arguments between consecutive sequences of an OB.
+
+``map_OB`` gives every sequence of an OB its full set of arguments, although
+consecutive sequences usually differ in a few of them (the exposure time, a
+dither position, the sequence number).  ``diff_args`` finds those:
+
+    delta = diff_args(map_OB(OB, 0), map_OB(OB, 1))
+    delta.changed     # {'exptime': 30, 'sequence_number': 1}
+    'coadds' in delta # False: unchanged, nothing to reconfigure
+
+Functions that set ``apply_delta = True`` get the delta of each sequence
+after the first through ``perform_delta(args, delta, logger, cfg)`` when
+SequenceRunner runs an OB, and can then reconfigure only what changed.  The
+first sequence of an OB (and every plain execute()) still runs ``perform``.
+"""
+
+_MISSING = object()
+
+
+class ArgDelta:
+    """Arguments that differ between two argument sets
+    """
+    __slots__ = ('changed', 'removed', 'unchanged')
+
+    def __init__(self, changed, removed, unchanged):
+        # {name: new value} of the new and changed arguments
+        self.changed = changed
+        # names of the arguments no longer given
+        self.removed = removed
+        # number of arguments with the same value
+        self.unchanged = unchanged
+
+    def __contains__(self, name):
+        return name in self.changed or name in self.removed
+
+    def __bool__(self):
+        return bool(self.changed or self.removed)
+
+    def __len__(self):
+        return len(self.changed) + len(self.removed)
+
+    def any(self, *names):
+        """True if any of the arguments changed"""
+        return any(name in self for name in names)
+
+    def __repr__(self):
+        removed = f", removed {sorted(self.removed)}" if self.removed else ""
+        return f"<ArgDelta {self.changed}{removed}, {self.unchanged} " \
+               f"unchanged>"
+
+
+def diff_args(previous, current):
+    """The arguments that changed from one sequence to the next
+
+    Parameters
+    ----------
+    previous : dict or ArgRecord
+        Arguments of sequence N
+    current : dict or ArgRecord
+        Arguments of sequence N+1
+
+    Returns
+    -------
+    ArgDelta
+        The changes
+    """
+    changed = {}
+    unchanged = 0
+    for name, value in current.items():
+        if previous.get(name, _MISSING) == value:
+            unchanged += 1
+        else:
+            changed[name] = value
+    removed = {name for name in previous.keys() if name not in current}
+    return ArgDelta(changed, removed, unchanged)
+
+
+def sequence_deltas(sequences):
+    """The delta of every sequence of an OB from the one before
+
+    Parameters
+    ----------
+    sequences : list
+        (sequence number, args) pairs in run order, as from
+        SequenceRunner.map_sequences
+
+    Returns
+    -------
+    list
+        One ArgDelta per sequence, None for the first
+    """
+    deltas = [None] * len(sequences)
+    for idx in range(1, len(sequences)):
+        deltas[idx] = diff_args(sequences[idx - 1][1], sequences[idx][1])
+    return deltas
@@ -0,0 +1,387 @@
+"""
+Pipelined execution of all the sequences of an OB.
+
+The runner maps every sequence of the OB through ``map_OB`` up front, then
+executes them in order.  As soon as the ``perform`` of sequence N has
+returned (e.g. the exposure has started), the phases of sequence N+1 that its
+function declares safe to overlap (``overlap_phases``) are started in a
+background thread, while sequence N finishes its post-condition and the
+readout wait (``wait_function``, e.g. ``MOSFIRE_WaitForExpose``).  Times
+are read from ``clock``, so a simulated run reports simulated time; there
+the overlapped phases run in the foreground, as threads share the simulated
+timeline.
+
+    runner = SequenceRunner(Expose, wait_function=MOSFIRE_WaitForExpose,
+                            logger=logger)
+    report = runner.run(OB)
+    logger.info(report.summary())
+
+Functions with ``apply_delta`` get, from the second sequence on, only the
+arguments that changed since the previous sequence (``perform_delta``, see
+``sequence_diff``); the report estimates the perform time this saved.
+
+Given a ``checkpoint.CheckpointStore``, every completed sequence is recorded,
+and ``resume=True`` skips the sequences of the OB an earlier (interrupted)
+run completed, once ``verify_completed`` of the function accepts them.
+"""
+
+import contextvars
+import threading
+from logging import getLogger
+
+from ddoitranslatormodule import clock
+from ddoitranslatormodule.sequence_diff import sequence_deltas
+from ddoitranslatormodule.checkpoint import DONE, FAILED
+from ddoitranslatormodule.ddoiexceptions.DDOIExceptions import DDOIInvalidArguments
+
+# Order in which the phases of a function are run
+PHASE_ORDER = ('pre_condition', 'perform', 'post_condition')
+
+
+def sequence_numbers(OB):
+    """List the sequence numbers of the observations in an OB, in OB order
+
+    Parameters
+    ----------
+    OB : dict
+        Observing Block, in dictionary form
+
+    Returns
+    -------
+    list
+        The sequence numbers
+    """
+    return [obs['metadata']['sequence_number']
+            for obs in OB.get('observations', [])]
+
+
+def overlap_phases(function):
+    """Leading phases of a function that may overlap the previous sequence
+
+    Parameters
+    ----------
+    function : class
+        The TranslatorModuleFunction
+
+    Returns
+    -------
+    tuple
+        The phases, in execution order.  Only an unbroken run of phases from
+        the start of PHASE_ORDER can be overlapped.
+    """
+    declared = set(function.overlap_phases)
+    unknown = declared - set(PHASE_ORDER)
+    if unknown:
+        raise DDOIInvalidArguments(
+            f"{function.__name__}.overlap_phases has unknown phases: {unknown}")
+    phases = []
+    for phase in PHASE_ORDER:
+        if phase not in declared:
+            break
+        phases.append(phase)
+    return tuple(phases)
+
+
+class SequenceResult:
+    """Outcome of one sequence of a SequenceRunner run
+    """
+    __slots__ = ('sequence_number', 'run_id', 'return_value', 'timings',
+                 'overlapped', 'overlap_saved', 'delta', 'perform_time')
+
+    def __init__(self, sequence_number, ctx, return_value, overlapped=(),
+                 overlap_saved=0.0):
+        self.sequence_number = sequence_number
+        self.run_id = ctx.run_id
+        self.return_value = return_value
+        self.timings = ctx.timings.as_dict()
+        self.overlapped = overlapped
+        self.overlap_saved = overlap_saved
+        # ArgDelta the sequence was performed with, None for a full perform
+        self.delta = ctx.delta if ctx.function.apply_delta else None
+        self.perform_time = ctx.timings.get('perform')
+
+    def __repr__(self):
+        return f"<SequenceResult {self.sequence_number} {self.run_id}>"
+
+
+class SequenceReport:
+    """Results of a SequenceRunner run
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.sequences = []
+        # Sequence numbers skipped as completed by an earlier run
+        self.skipped = []
+        self.wall_time = 0.0
+
+    @property
+    def overlap_saved(self):
+        """Seconds saved compared to running every phase serially"""
+        return sum(seq.overlap_saved for seq in self.sequences)
+
+    @property
+    def delta_saved(self):
+        """Estimated seconds saved by performing only the changes: the mean
+        time of the full performs less the time of each delta perform"""
+        full = [seq.perform_time for seq in self.sequences
+                if seq.delta is None and seq.perform_time is not None]
+        if not full:
+            return 0.0
+        mean_full = sum(full) / len(full)
+        return sum(max(mean_full - seq.perform_time, 0.0)
+                   for seq in self.sequences
+                   if seq.delta is not None and seq.perform_time is not None)
+
+    def summary(self):
+        summary = f"{self.function.__name__}: {len(self.sequences)} " \
+                  f"sequences in {self.wall_time:.2f} s, overlap saved " \
+                  f"{self.overlap_saved:.2f} s"
+        if any(seq.delta is not None for seq in self.sequences):
+            summary += f", delta perform saved {self.delta_saved:.2f} s"
+        if self.skipped:
+            summary += f", {len(self.skipped)} completed sequences skipped"
+        return summary
+
+
+class _PreparedSequence:
+    """The overlap-safe phases of a sequence, run in a background thread
+    """
+
+    def __init__(self, function, args, logger, cfg, timeout, phases, caller):
+        self.function = function
+        self.cfg = cfg
+        self.phases = phases
+        # Created and run in a copy of the runner's caller's context, so the
+        # sequence nests under that caller rather than under the previous
+        # sequence (whose deadline and cancellation are not its own)
+        self._context = caller.copy()
+        self.ctx = self._context.run(function._create_context, args, logger,
+                                     timeout=timeout)
+        self.error = None
+        self.duration = None
+        self.thread = None
+
+    def start(self):
+        if clock.is_virtual():
+            # Threads share the simulated timeline, so a background thread
+            # would be charged the time the foreground sleeps meanwhile
+            self._context.run(self._run)
+            return
+        self.thread = threading.Thread(
+            target=self._context.run, args=(self._run,), daemon=True,
+            name=f"prepare-{self.ctx.run_id}")
+        self.thread.start()
+
+    def _run(self):
+        start = clock.monotonic()
+        with self.ctx:
+            try:
+                self.function._setup_context(self.ctx, self.cfg)
+                for phase in self.phases:
+                    self.function._run_phase(self.ctx, phase)
+            except BaseException as e:
+                self.error = e
+                self.function._finish_context(self.ctx, e)
+            finally:
+                self.duration = clock.monotonic() - start
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+        return self.duration
+
+
+class SequenceRunner:
+    """Runs every sequence of an OB, overlapping the safe setup phases of
+    sequence N+1 with the post-condition and readout of sequence N.
+    """
+
+    def __init__(self, function, wait_function=None, logger=None, cfg=None,
+                 wait_cfg=None, timeout=None, overlap=True, checkpoints=None,
+                 resume=False):
+        """Create the runner
+
+        Parameters
+        ----------
+        function : class
+            TranslatorModuleFunction executed for every sequence
+        wait_function : class, optional
+            TranslatorModuleFunction executed after each sequence to wait for
+            its readout (e.g. MOSFIRE_WaitForExpose), by default None
+        logger : DDOILoggerClient, optional
+            The logger to use, by default the root logger
+        cfg : filepath or ConfigParser, optional
+            Config used to map the OB and execute function, by default the
+            function's default
+        wait_cfg : filepath or ConfigParser, optional
+            Config used to execute wait_function, by default its default
+        timeout : float, optional
+            Seconds allowed for each execution, by default None
+        overlap : bool, optional
+            False to run every phase serially, by default True
+        checkpoints : checkpoint.CheckpointStore, optional
+            Where the completed sequences are recorded, by default None (not
+            recorded)
+        resume : bool, optional
+            Skip the sequences recorded as completed in checkpoints, after
+            checking them with the function's verify_completed, by default
+            False
+        """
+        self.function = function
+        self.wait_function = wait_function
+        self.logger = logger if logger is not None else getLogger("")
+        self.cfg = cfg
+        self.wait_cfg = wait_cfg
+        self.timeout = timeout
+        self.overlap = overlap
+        self.checkpoints = checkpoints
+        self.resume = resume
+        self.report = None
+
+    def map_sequences(self, OB):
+        """Map all the sequences of an OB to function arguments
+
+        Parameters
+        ----------
+        OB : dict
+            Observing Block, in dictionary form
+
+        Returns
+        -------
+        list
+            (sequence number, args dict) for every sequence, in OB order
+        """
+        return [(num, self.function.map_OB(OB, num, cfg=self.cfg))
+                for num in sequence_numbers(OB)]
+
+    def _resume(self, checkpoint, sequences, report):
+        """The sequences still to run: those the checkpoint does not record
+        as completed, or whose completed state no longer verifies, and every
+        sequence after the first of them"""
+        function = self.function
+        for idx, (seq_num, args) in enumerate(sequences):
+            if not checkpoint.is_done(function.__name__, seq_num):
+                break
+            if not function.check_completed(args, self.logger, self.cfg):
+                self.logger.warning(f"Sequence {seq_num} was completed but "
+                                    f"no longer verifies, running it again")
+                break
+            report.skipped.append(seq_num)
+        else:
+            idx = len(sequences)
+        if report.skipped:
+            self.logger.info(f"Resuming {checkpoint.ob_hash}: skipping the "
+                             f"completed sequences {report.skipped}")
+        return sequences[idx:]
+
+    def run(self, OB, sequences=None):
+        """Execute every sequence of the OB
+
+        Parameters
+        ----------
+        OB : dict
+            Observing Block, in dictionary form
+        sequences : list, optional
+            Already mapped (sequence number, args) pairs, by default the
+            output of map_sequences(OB)
+
+        Returns
+        -------
+        SequenceReport
+            Per-sequence results and the time saved by overlapping.  Also
+            kept in self.report when an exception interrupts the run.
+        """
+        if sequences is None:
+            sequences = self.map_sequences(OB)
+        function = self.function
+        report = self.report = SequenceReport(function)
+        checkpoint = None
+        if self.checkpoints is not None:
+            checkpoint = self.checkpoints.for_ob(OB)
+            if self.resume:
+                sequences = self._resume(checkpoint, sequences, report)
+        phases = overlap_phases(function) if self.overlap else ()
+        deltas = sequence_deltas(sequences) if function.apply_delta \
+            else [None] * len(sequences)
+        start = clock.monotonic()
+        caller = contextvars.copy_context()
+
+        self.logger.info(f"Running {len(sequences)} sequences with "
+                         f"{function.__name__}, overlapping {phases or 'nothing'}")
+
+        prepared = None
+        for idx, (seq_num, args) in enumerate(sequences):
+            done = ()
+            if prepared is not None:
+                if prepared.error is not None:
+                    raise prepared.error
+                ctx = prepared.ctx
+                done = prepared.phases
+            else:
+                ctx = function._create_context(args, self.logger,
+                                               timeout=self.timeout)
+            # the previous sequence was performed, only its changes remain
+            ctx.delta = deltas[idx]
+
+            next_prepared = None
+            overlap_start = None
+            with ctx:
+                try:
+                    if not done:
+                        function._setup_context(ctx, self.cfg)
+                    return_value = None
+                    remaining = [p for p in PHASE_ORDER if p not in done]
+                    # Run up to and including perform before starting on the
+                    # next sequence
+                    while remaining and remaining[0] != 'post_condition':
+                        phase = remaining.pop(0)
+                        result = function._run_phase(ctx, phase)
+                        if phase == 'perform':
+                            return_value = result
+
+                    if phases and idx + 1 < len(sequences):
+                        next_prepared = _PreparedSequence(
+                            function, sequences[idx + 1][1], self.logger,
+                            self.cfg, self.timeout, phases, caller)
+                        next_prepared.start()
+                        overlap_start = clock.monotonic()
+
+                    for phase in remaining:
+                        result = function._run_phase(ctx, phase)
+                        if phase == 'perform':
+                            return_value = result
+                    if self.wait_function is not None:
+                        self.wait_function.execute(args, ctx.logger,
+                                                   cfg=self.wait_cfg)
+                except BaseException as e:
+                    function._finish_context(ctx, e)
+                    if checkpoint is not None:
+                        checkpoint.record(function.__name__, seq_num, FAILED,
+                                          ctx.run_id, e)
+                    if next_prepared is not None:
+                        next_prepared.ctx.cancel(
+                            f"sequence {seq_num} failed")
+                        next_prepared.join()
+                    raise
+                function._finish_context(ctx)
+            if checkpoint is not None:
+                checkpoint.record(function.__name__, seq_num, DONE,
+                                  ctx.run_id)
+
+            saved = 0.0
+            if next_prepared is not None:
+                foreground = clock.monotonic() - overlap_start
+                background = next_prepared.join()
+                if next_prepared.error is None:
+                    # serial would take foreground + background
+                    saved = min(foreground, background)
+
+            report.sequences.append(
+                SequenceResult(seq_num, ctx, return_value, done, saved))
+            report.wall_time = clock.monotonic() - start
+            prepared = next_prepared
+
+        report.wall_time = clock.monotonic() - start
+        self.logger.info(report.summary())
+        return report
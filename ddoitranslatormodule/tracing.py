@@ -0,0 +1,331 @@
+"""
+Span based tracing of translator function executions.
+
+When enabled, every execute() opens a span for the function and one for each
+of its phases.  Nested execute() calls (a telescope acquisition calling other
+translator functions) become child spans of the phase they were called from,
+including when the nested call runs in another thread that was started with
+the caller's contextvars (``propagate``, SequenceRunner).  KTL reads and
+writes made through ``ktl_access`` are recorded as child events of the phase
+that made them.
+
+Traces are written in the Chrome trace-event JSON array format, which can be
+opened in Perfetto (ui.perfetto.dev), chrome://tracing or speedscope.  The
+events recorded are appended to the file, one per line, after every top level
+execution and dropped from memory, so long running processes neither grow nor
+rewrite the file; the closing bracket (optional for the viewers) is added by
+``disable`` or at exit::
+
+    from ddoitranslatormodule import tracing
+    tracing.enable('/tmp/expose_trace.json')
+
+or set ``DDOI_TRACE_FILE`` in the environment before the base class is
+imported.  ``{pid}`` in the file name is replaced with the process id.  When
+tracing is not enabled the only cost is a check of ``tracing.tracer``.
+"""
+
+import atexit
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from ddoitranslatormodule.execution_context import add_observer, remove_observer, current_context
+
+# The active Tracer, None when tracing is disabled
+tracer = None
+
+# Span opened with Tracer.span() that is current in this thread/context
+_custom_span = contextvars.ContextVar('ddoi_trace_span', default=None)
+
+
+class Span:
+    """An open interval of the trace
+    """
+    __slots__ = ('span_id', 'name', 'category', 'parent', 'start', 'tid',
+                 'args')
+
+    def __init__(self, span_id, name, category, parent, start, tid, args):
+        self.span_id = span_id
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.start = start
+        self.tid = tid
+        self.args = args
+
+
+class Tracer:
+    """Collects spans and writes them as trace events
+    """
+
+    def __init__(self, path):
+        """Create the tracer
+
+        Parameters
+        ----------
+        path : str
+            File the trace is written to
+        """
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        # Held while writing, keeps the events of concurrent flushes in order
+        self._file_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # Events not yet written to the file
+        self._events = []
+        self._started = False
+        self._closed = False
+        self._named_threads = set()
+        self._t0 = time.perf_counter_ns()
+        # {run_id: Span} for executions and their current phase
+        self._function_spans = {}
+        self._phase_spans = {}
+
+    def _now(self):
+        """Microseconds since the tracer was created"""
+        return (time.perf_counter_ns() - self._t0) / 1000
+
+    def _add(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def _context_span(self, ctx):
+        """Innermost open span of an execution"""
+        if ctx is None:
+            return None
+        with self._lock:
+            span = self._phase_spans.get(ctx.run_id)
+            if span is None:
+                span = self._function_spans.get(ctx.run_id)
+        return span
+
+    def current_span(self, ctx=None):
+        """The span new spans should be children of
+
+        Parameters
+        ----------
+        ctx : ExecutionContext, optional
+            Execution to look in, by default the current one
+        """
+        if ctx is None:
+            ctx = current_context()
+        exec_span = self._context_span(ctx)
+        custom = _custom_span.get()
+        if custom is None:
+            return exec_span
+        if exec_span is None or custom.start >= exec_span.start:
+            return custom
+        return exec_span
+
+    def start_span(self, name, category, parent=None, **args):
+        """Open a span, returning it
+
+        Parameters
+        ----------
+        name : str
+            Name shown in the viewer
+        category : str
+            Category, e.g. "function", "phase", "ktl"
+        parent : Span, optional
+            Parent span, by default no parent
+        """
+        tid = threading.get_ident()
+        span = Span(next(self._ids), name, category, parent, self._now(),
+                    tid, args)
+        if parent is not None and parent.tid != tid:
+            # flow arrow from the parent's thread to the child's
+            self._add({'name': 'spawn', 'cat': category, 'ph': 's',
+                       'id': span.span_id, 'pid': self.pid,
+                       'tid': parent.tid, 'ts': span.start})
+            self._add({'name': 'spawn', 'cat': category, 'ph': 'f', 'bp': 'e',
+                       'id': span.span_id, 'pid': self.pid, 'tid': tid,
+                       'ts': span.start})
+        return span
+
+    def end_span(self, span, error=None):
+        """Close a span and record it as a complete event
+
+        Parameters
+        ----------
+        span : Span
+            The span returned by start_span
+        error : Exception, optional
+            Exception raised inside the span, by default None
+        """
+        args = dict(span.args)
+        args['span_id'] = span.span_id
+        if span.parent is not None:
+            args['parent_id'] = span.parent.span_id
+        if error is not None:
+            args['error'] = f"{type(error).__name__}: {error}"
+        self._add({'name': span.name, 'cat': span.category, 'ph': 'X',
+                   'ts': span.start, 'dur': self._now() - span.start,
+                   'pid': self.pid, 'tid': span.tid, 'args': args})
+
+    @contextmanager
+    def span(self, name, category='custom', **args):
+        """Context manager tracing a block as a child of the current span
+        """
+        span = self.start_span(name, category, self.current_span(), **args)
+        token = _custom_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _custom_span.reset(token)
+            self.end_span(span, error)
+
+    def instant(self, name, category='custom', **args):
+        """Record a point in time as a child of the current span"""
+        parent = self.current_span()
+        if parent is not None:
+            args['parent_id'] = parent.span_id
+        self._add({'name': name, 'cat': category, 'ph': 'i', 's': 't',
+                   'ts': self._now(), 'pid': self.pid,
+                   'tid': threading.get_ident(), 'args': args})
+
+    # Execution observer interface
+
+    def on_start(self, ctx):
+        parent = self._context_span(ctx.parent)
+        span = self.start_span(ctx.name, 'function', parent,
+                               run_id=ctx.run_id,
+                               module=ctx.function.__module__)
+        with self._lock:
+            self._function_spans[ctx.run_id] = span
+
+    def on_phase_start(self, ctx, phase):
+        with self._lock:
+            parent = self._function_spans.get(ctx.run_id)
+        span = self.start_span(f"{ctx.name}.{phase}", 'phase', parent,
+                               run_id=ctx.run_id)
+        with self._lock:
+            self._phase_spans[ctx.run_id] = span
+
+    def on_phase_end(self, ctx, phase, error):
+        with self._lock:
+            span = self._phase_spans.pop(ctx.run_id, None)
+        if span is not None:
+            self.end_span(span, error)
+
+    def on_finish(self, ctx, error):
+        with self._lock:
+            phase_span = self._phase_spans.pop(ctx.run_id, None)
+            span = self._function_spans.pop(ctx.run_id, None)
+        if phase_span is not None:
+            self.end_span(phase_span, error)
+        if span is not None:
+            self.end_span(span, error)
+        if ctx.parent is None:
+            self.flush()
+
+    def flush(self):
+        """Append the events recorded since the last flush to the trace file
+        """
+        with self._file_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if self._closed:
+                return
+            meta = []
+            if not self._started:
+                meta.append({'name': 'process_name', 'ph': 'M',
+                             'pid': self.pid,
+                             'args': {'name': f"ddoi {self.pid}"}})
+            for thread in threading.enumerate():
+                if thread.ident not in self._named_threads:
+                    self._named_threads.add(thread.ident)
+                    meta.append({'name': 'thread_name', 'ph': 'M',
+                                 'pid': self.pid, 'tid': thread.ident,
+                                 'args': {'name': thread.name}})
+            lines = [json.dumps(event) for event in meta + events]
+            if not lines:
+                return
+            if self._started:
+                with open(self.path, 'a') as f:
+                    f.write(''.join(f",\n{line}" for line in lines))
+            else:
+                with open(self.path, 'w') as f:
+                    f.write("[\n" + ",\n".join(lines))
+                self._started = True
+
+    def close(self):
+        """Write the remaining events and end the JSON array
+        """
+        self.flush()
+        with self._file_lock:
+            if self._started and not self._closed:
+                with open(self.path, 'a') as f:
+                    f.write("\n]\n")
+            self._closed = True
+
+
+def enable(path):
+    """Start tracing executions to a file
+
+    Parameters
+    ----------
+    path : str
+        Trace file, "{pid}" is replaced with the process id
+
+    Returns
+    -------
+    Tracer
+        The active tracer
+    """
+    global tracer
+    if tracer is not None:
+        disable()
+    tracer = Tracer(path)
+    add_observer(tracer)
+    atexit.register(tracer.close)
+    return tracer
+
+
+def disable():
+    """Stop tracing, writing out what was recorded"""
+    global tracer
+    if tracer is None:
+        return
+    remove_observer(tracer)
+    atexit.unregister(tracer.close)
+    tracer.close()
+    tracer = None
+
+
+@contextmanager
+def span(name, category='custom', **args):
+    """Trace a block of code as a child of the current span, if tracing is
+    enabled
+    """
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, category, **args) as sp:
+        yield sp
+
+
+def propagate(func):
+    """Wrap a function so that, when called in another thread, its spans and
+    execute() calls are children of the span current at wrapping time
+
+        Thread(target=tracing.propagate(work)).start()
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        # a Context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+if os.environ.get('DDOI_TRACE_FILE'):
+    enable(os.environ['DDOI_TRACE_FILE'])